@@ -0,0 +1,233 @@
+"""Admission control for the Azure OpenAI quotas.
+
+Every deployment has a tokens-per-minute and a requests-per-minute quota. Calls are
+admitted through a token bucket per quota: a call reserves its estimated tokens
+(prompt plus `max_tokens`, as Azure counts them) and the reservation is settled with
+the actual usage afterwards. Calls that would exceed the quota wait in a FIFO queue
+for a bounded time, and are rejected with `AdmissionRejected` (503) when the queue is
+full or the wait would be too long. A 429 blocks the deployment for its Retry-After.
+"""
+import asyncio
+import contextvars
+import itertools
+import json
+import os
+import time
+import weakref
+from typing import Awaitable, Callable
+
+import openai
+from constants import OPENAI_QUOTA_PER_MINUTE
+from rich import print
+from tracing import span
+
+# Quotas per minute by deployment as JSON, e.g. '{"gpt-4": {"tokens": 40000, "requests": 240}}'
+OPENAI_QUOTAS = {**OPENAI_QUOTA_PER_MINUTE, **json.loads(os.environ.get("OPENAI_QUOTAS") or "{}")}
+ADMISSION_MAX_QUEUE = int(os.environ.get("ADMISSION_MAX_QUEUE") or 50)
+ADMISSION_MAX_WAIT_IN_SEC = float(os.environ.get("ADMISSION_MAX_WAIT_IN_SEC") or 10)
+OPENAI_MAX_RETRIES = int(os.environ.get("OPENAI_MAX_RETRIES") or 2)
+DEFAULT_RETRY_AFTER_IN_SEC = 1.0
+
+# Admissions of the current request, for monitoring
+ADMISSIONS = contextvars.ContextVar("admissions", default=None)
+
+
+class AdmissionRejected(Exception):
+    """Raised when a call cannot be admitted within the quota."""
+
+    def __init__(self, message: str, retry_after: float):
+        """Initialize class."""
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    """Bucket refilled continuously up to its per-minute capacity."""
+
+    def __init__(self, per_minute: float):
+        """Initialize class."""
+        self.capacity = per_minute
+        self.rate = per_minute / 60
+        self.level = per_minute
+        self.updated_at = time.monotonic()
+
+    def refill(self) -> None:
+        """Add the tokens accrued since the last update."""
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def time_until(self, amount: float) -> float:
+        """Return the seconds until `amount` tokens are available."""
+        self.refill()
+        # A call larger than the capacity is admitted once the bucket is full
+        amount = min(amount, self.capacity)
+        return max(0.0, (amount - self.level) / self.rate)
+
+    def take(self, amount: float) -> None:
+        """Remove tokens; the level may become negative for calls larger than the capacity."""
+        self.refill()
+        self.level -= amount
+
+    def give(self, amount: float) -> None:
+        """Return tokens, e.g. when a reservation was larger than the actual usage."""
+        self.refill()
+        self.level = min(self.capacity, self.level + amount)
+
+
+class DeploymentLimiter:
+    """Token buckets and FIFO queue of one Azure OpenAI deployment."""
+
+    def __init__(self, deployment: str, tokens_per_minute: int, requests_per_minute: int):
+        """Initialize class."""
+        self.deployment = deployment
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.requests = TokenBucket(requests_per_minute)
+        self.blocked_until = 0.0
+        # FIFO locks per event loop, as asyncio primitives cannot be shared across loops
+        self.locks = weakref.WeakKeyDictionary()
+
+        self.num_waiting = 0
+        self.num_admitted = 0
+        self.num_rejected = 0
+        self.num_throttled = 0
+        self.total_wait_time = 0.0
+
+    def time_until(self, tokens: int) -> float:
+        """Return the seconds until a call of `tokens` tokens can be admitted."""
+        return max(
+            self.blocked_until - time.monotonic(),
+            self.tokens.time_until(tokens),
+            self.requests.time_until(1),
+        )
+
+    def reject(self, reason: str, retry_after: float) -> AdmissionRejected:
+        """Count and create a rejection."""
+        self.num_rejected += 1
+        return AdmissionRejected(
+            f"Azure OpenAI deployment '{self.deployment}' is over its quota ({reason}), "
+            f"retry in {retry_after:.0f}s",
+            retry_after,
+        )
+
+    async def acquire(self, tokens: int) -> float:
+        """Wait until a call of `tokens` tokens fits the quota and reserve it, returning the wait time."""
+        if self.num_waiting >= ADMISSION_MAX_QUEUE:
+            raise self.reject("queue is full", self.time_until(tokens) or DEFAULT_RETRY_AFTER_IN_SEC)
+
+        start_time = time.monotonic()
+        queue_depth = self.num_waiting
+        self.num_waiting += 1
+        try:
+            async with self.locks.setdefault(asyncio.get_running_loop(), asyncio.Lock()):
+                while (wait_time := self.time_until(tokens)) > 0:
+                    if time.monotonic() - start_time + wait_time > ADMISSION_MAX_WAIT_IN_SEC:
+                        raise self.reject("wait is too long", wait_time)
+                    await asyncio.sleep(wait_time)
+                self.tokens.take(tokens)
+                self.requests.take(1)
+        finally:
+            self.num_waiting -= 1
+
+        wait_time = time.monotonic() - start_time
+        self.num_admitted += 1
+        self.total_wait_time += wait_time
+        if (admissions := ADMISSIONS.get()) is not None:
+            admissions.append(
+                {"deployment": self.deployment, "wait_time": wait_time, "queue_depth": queue_depth}
+            )
+        return wait_time
+
+    def settle(self, reserved_tokens: int, used_tokens: int) -> None:
+        """Correct a reservation with the actual usage."""
+        self.tokens.give(reserved_tokens - used_tokens)
+
+    def back_off(self, retry_after: float) -> None:
+        """Stop admitting calls until Azure OpenAI accepts them again."""
+        self.num_throttled += 1
+        self.blocked_until = max(self.blocked_until, time.monotonic() + retry_after)
+        print(f"[WARNING] Azure OpenAI deployment '{self.deployment}' throttled for {retry_after}s")
+
+    def stats(self) -> dict:
+        """Return admission metrics."""
+        return {
+            "admitted": self.num_admitted,
+            "rejected": self.num_rejected,
+            "throttled": self.num_throttled,
+            "waiting": self.num_waiting,
+            "wait_time_avg": (
+                round(self.total_wait_time / self.num_admitted, 4) if self.num_admitted else 0.0
+            ),
+            "tokens_available": round(self.tokens.level),
+            "requests_available": round(self.requests.level),
+        }
+
+
+LIMITERS = {}
+
+
+def get_limiter(deployment: str) -> DeploymentLimiter:
+    """Return the limiter of a deployment."""
+    limiter = LIMITERS.get(deployment)
+    if limiter is None:
+        # Unknown deployments get the smallest known quota
+        quota = OPENAI_QUOTAS.get(deployment) or min(
+            OPENAI_QUOTAS.values(), key=lambda quota: quota["tokens"]
+        )
+        limiter = LIMITERS[deployment] = DeploymentLimiter(deployment, quota["tokens"], quota["requests"])
+    return limiter
+
+
+def get_retry_after(e: openai.error.OpenAIError) -> float:
+    """Return the wait requested by a 429 response."""
+    # Header names are case-insensitive in both requests and aiohttp responses
+    headers = e.headers or {}
+    try:
+        if "retry-after-ms" in headers:
+            return float(headers["retry-after-ms"]) / 1000
+        return float(headers.get("retry-after") or DEFAULT_RETRY_AFTER_IN_SEC)
+    except ValueError:
+        return DEFAULT_RETRY_AFTER_IN_SEC
+
+
+async def admit(
+    deployment: str, estimated_tokens: int, call: Callable[[], Awaitable], usage: Callable
+) -> any:
+    """Make an Azure OpenAI call within the deployment's quota, retrying after 429s.
+
+    `usage(response)` returns the total tokens actually used by the call.
+    """
+    limiter = get_limiter(deployment)
+    for attempt in itertools.count():
+        with span("admission", deployment=deployment, tokens=estimated_tokens, attempt=attempt) as s:
+            wait_time = await limiter.acquire(estimated_tokens)
+            if s:
+                s.set(wait_time=round(wait_time, 4))
+        try:
+            response = await call()
+        except openai.error.RateLimitError as e:
+            retry_after = get_retry_after(e)
+            limiter.settle(estimated_tokens, 0)
+            limiter.back_off(retry_after)
+            if attempt >= OPENAI_MAX_RETRIES:
+                raise limiter.reject("throttled by Azure OpenAI", retry_after) from e
+            continue
+        except BaseException:
+            limiter.settle(estimated_tokens, 0)
+            raise
+        limiter.settle(estimated_tokens, usage(response))
+        return response
+
+
+def summarize_admissions(admissions: list) -> dict:
+    """Summarize the admissions of a request for monitoring."""
+    return {
+        "calls": len(admissions),
+        "wait_time": round(sum(admission["wait_time"] for admission in admissions), 2),
+        "max_queue_depth": max((admission["queue_depth"] for admission in admissions), default=0),
+    }
+
+
+def admission_stats() -> dict:
+    """Return admission metrics of all deployments."""
+    return {deployment: limiter.stats() for deployment, limiter in LIMITERS.items()}
@@ -1,30 +1,23 @@
 """Backend logic."""
-import logging
+import json
 import os
-import time
-from datetime import datetime
 
 import openai
-from approaches.retrieve_read import RetrieveReadApproach
-from approaches.retrieve_read_read import RetrieveReadReadApproach
-from approaches.retrieve_read_retry import RetrieveReadRetryApproach
-from approaches.retrieve_reformulate_retrieve_read import RetrieveReformulateRetrieveReadApproach
-# from azure.identity import DefaultAzureCredential
-from azure.search.documents import SearchClient
+from azure.core.credentials import AzureKeyCredential
+from azure.search.documents.aio import SearchClient
 from constants import ACSIndex
-from flask import Flask, jsonify, request
-from requests import get
+from dotenv import find_dotenv, load_dotenv
+from fanout import SEARCH_INDEXES
 from rich import print
+from server import create_app
+from transport import OPENAI_POOL, SEARCH_POOL, PooledAioHttpTransport
 
-from azure.core.credentials import AzureKeyCredential
-from dotenv import find_dotenv, load_dotenv
 load_dotenv(find_dotenv())
 
 # Replace these with your own values, either in environment variables or directly here
 AZURE_SEARCH_SERVICE = os.environ.get("AZURE_SEARCH_SERVICE")
 AZURE_SEARCH_INDEX = os.environ.get("AZURE_SEARCH_INDEX")
 AZURE_OPENAI_SERVICE = os.environ.get("AZURE_OPENAI_SERVICE")
-AZURE_OPENAI_GPT_DEPLOYMENT_DEFAULT = "gpt-35-turbo"
 
 KB_FIELDS_CONTENT = os.environ.get("KB_FIELDS_CONTENT") or "content"
 KB_FIELDS_CATEGORY = os.environ.get("KB_FIELDS_CATEGORY") or "category"
@@ -43,6 +36,7 @@ KB_FIELDS_SOURCEPAGE = os.environ.get("KB_FIELDS_SOURCEPAGE") or "sourcepage"
 openai.api_type = "azure"
 openai.api_base = "https://jp-oai-jpe-dev-kit-chat-001.openai.azure.com/"
 openai.api_version = "2023-07-01-preview"
+OPENAI_POOL.warmup_url = openai.api_base
 
 # Comment these two lines out if using keys, set your API key in the
 # OPENAI_API_KEY environment variable instead
@@ -52,78 +46,25 @@ print(openai.api_key)
 print(os.getenv("SEARCH_API_KEY"))
 
 # Set up clients for Cognitive Search
+AZURE_SEARCH_ENDPOINT = f"https://{AZURE_SEARCH_SERVICE}.search.windows.net"
+SEARCH_POOL.warmup_url = AZURE_SEARCH_ENDPOINT
+# One client per searched index; AZURE_SEARCH_INDEX names the index of SEARCH_ALL
 SEARCH_CLIENTS = {
-    ACSIndex.SEARCH_ALL: SearchClient(
-        endpoint=f"https://{AZURE_SEARCH_SERVICE}.search.windows.net",
-        index_name=AZURE_SEARCH_INDEX,
-        credential=AzureKeyCredential(os.environ.get("SEARCH_API_KEY"))
+    index: SearchClient(
+        endpoint=AZURE_SEARCH_ENDPOINT,
+        index_name=AZURE_SEARCH_INDEX if index == ACSIndex.SEARCH_ALL else index.value,
+        credential=AzureKeyCredential(os.environ.get("SEARCH_API_KEY")),
+        transport=PooledAioHttpTransport(SEARCH_POOL),
     )
+    for index in SEARCH_INDEXES
 }
 
-app = Flask(__name__)
-
-
-def proxy(host, path):
-    """Finalize HTTP response for serving static files."""
-    response = get(f"{host}{path}")
-    excluded_headers = [
-        "content-encoding",
-        "content-length",
-        "transfer-encoding",
-        "connection",
-    ]
-    headers = {
-        name: value
-        for name, value in response.raw.headers.items()
-        if name.lower() not in excluded_headers
-    }
-    return (response.content, response.status_code, headers)
-
-
-@app.route("/", defaults={"path": "index.html"})
-@app.route("/<path:path>")
-def static_file(path: str):
-    """Send target file to the user."""
-    print(f"[DEBUG] {datetime.now().strftime('%Y-%m-%d %H:%M:%S')} | static_file")
-    if os.environ.get("FLASK_DEBUG"):
-        return proxy("http://localhost:5173", request.path)
-    return app.send_static_file(path)
-
-
-@app.route("/ask", methods=["POST"])
-def ask():
-    """Respond user questions."""
-    print(f"[DEBUG] {datetime.now().strftime('%Y-%m-%d %H:%M:%S')} | ask")
-    # ensure_openai_token()
-    approach = request.json.get("approach", RetrieveReadApproach.KEY)
-    deployment = request.json.get("deployment", AZURE_OPENAI_GPT_DEPLOYMENT_DEFAULT)
-    index = ACSIndex.SEARCH_ALL
-
-    # Create approach instance
-    if approach == RetrieveReadApproach.KEY:
-        prompting_strategy = RetrieveReadApproach(SEARCH_CLIENTS[index], deployment)
-    elif approach == RetrieveReformulateRetrieveReadApproach.KEY:
-        prompting_strategy = RetrieveReformulateRetrieveReadApproach(SEARCH_CLIENTS[index], deployment)
-    elif approach == RetrieveReadReadApproach.KEY:
-        prompting_strategy = RetrieveReadReadApproach(SEARCH_CLIENTS[index], deployment)
-    elif approach == RetrieveReadRetryApproach.KEY:
-        prompting_strategy = RetrieveReadRetryApproach(SEARCH_CLIENTS[index], deployment)
-    else:
-        return jsonify({"error": "unknown approach"}), 400
-
-    try:
-        r = prompting_strategy.run(request.json["question"], request.json.get("overrides") or {})
-        print(f"[DEBUG] : Without Jsonify")
-        print(r)
-        import json
-        with open('../../output/result.json', 'w') as fp:
-            json.dump(r, fp)
-        print(f"[DEBUG] : With Jsonify")
-        print(jsonify(r))
-        return jsonify(r)
-    except Exception as e:
-        logging.exception("Exception in /ask")
-        return jsonify({"error": str(e)}), 500
+def dump_result(r: dict):
+    """Keep the latest response on disk for debugging."""
+    print(f"[DEBUG] : Without Jsonify")
+    print(r)
+    with open('../../output/result.json', 'w') as fp:
+        json.dump(r, fp)
 
 
 # def ensure_openai_token():
@@ -134,5 +75,8 @@ def ask():
 #         openai.api_key = openai_token.token
 
 
+app = create_app(SEARCH_CLIENTS, after_ask=dump_result)
+
+
 if __name__ == "__main__":
     app.run()
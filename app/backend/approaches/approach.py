@@ -1,16 +1,146 @@
 """Base class for prompting strategies."""
+import asyncio
+import dataclasses
+import functools
+import hashlib
+import json
+import os
 import re
 import time
+from typing import Callable, Optional
 
-from azure.search.documents import SearchClient
+from approaches.steps import Step, StopRun
+from azure.search.documents.aio import SearchClient
 from azure.search.documents.models import QueryType, Vector
-from constants import AnalysisPanelLabel, SearchOption
+from caching import IndexVersion, create_retrieval_cache
+from coalescing import SingleFlight
+from compression import Compression, compress_chunks
+from constants import (
+    AnalysisPanelLabel,
+    INSUFFICIENT_INFORMATION_ANSWER,
+    RETRIEVAL_SCORE_THRESHOLD,
+    SearchOption,
+)
+from packing import Chunk, PackedContext, get_context_length, pack_messages
 from rich import print
-from utils import calculate_cost, generate_embeddings, nonewlines
+from tracing import span
+from utils import (
+    calculate_cost,
+    count_tokens,
+    create_chat_completion,
+    detect_language,
+    generate_embeddings,
+    nonewlines,
+)
+
+
+# Approach classes by KEY, filled as subclasses are defined
+APPROACH_CLASSES = {}
+# Identical searches share one ACS request across concurrent requests
+SEARCH_FLIGHT = SingleFlight("search")
+# Results of recent searches, dropped when prepdocs.py repopulates the index
+RETRIEVAL_CACHE = create_retrieval_cache(IndexVersion())
+# Index-time `lang` values by language code (prepdocs.py writes "jp" for Japanese)
+LANGUAGE_CODES = {"en": "en", "ja": "ja", "jp": "ja"}
+# Index fields of the data points; the embeddings are left out of the search results
+SEARCH_FIELDS = [
+    "id", "parent_id", "title", "content", "source_path", "lang", "page_num", "num_tokens",
+    "modified_from_source",
+]
+# Score thresholds by search option name as JSON, e.g. '{"BM25": 4.5, "Vector": 0.82}'
+RETRIEVAL_SCORE_THRESHOLDS = {
+    **RETRIEVAL_SCORE_THRESHOLD,
+    **{
+        SearchOption[name]: threshold
+        for name, threshold in json.loads(os.environ.get("RETRIEVAL_SCORE_THRESHOLDS") or "{}").items()
+    },
+}
+
+
+@dataclasses.dataclass
+class RequestContext:
+    """Per-request state of a prompting strategy.
+
+    Approach instances are shared across concurrent requests, so anything that
+    varies per request lives here and is passed down explicitly.
+    """
+
+    item_prefix: str = ""
+    item_suffix: str = ""
+    # Queue of (event, data) pairs, set when the answer is streamed to the user
+    events: Optional[asyncio.Queue] = None
+    # Predicate on the answer generated so far; once it returns true, the answer is cut short
+    abort_answer: Optional[Callable[[str], bool]] = None
+
+    def nested(self, item_prefix: str = "", item_suffix: str = "") -> "RequestContext":
+        """Create a context for a nested step whose labels get an extra prefix/suffix."""
+        return dataclasses.replace(
+            self,
+            item_prefix=self.item_prefix + item_prefix,
+            item_suffix=item_suffix + self.item_suffix,
+        )
+
+    def emit(self, event: str, data=None) -> None:
+        """Publish a streaming event if the answer is being streamed."""
+        if self.events is not None:
+            self.events.put_nowait((event, data))
+
+
+class SearchHit:
+    """Data point of a retrieved document, serialized to a dict only in the response."""
+
+    __slots__ = ["score", *SEARCH_FIELDS]
+
+    def __init__(self, score: float, **fields):
+        """Initialize class."""
+        self.score = score
+        for name in SEARCH_FIELDS:
+            setattr(self, name, fields.get(name, ""))
+
+    @classmethod
+    def from_document(cls, doc: dict) -> "SearchHit":
+        """Create a data point from an ACS search result."""
+        return cls(doc["@search.score"], **{name: doc.get(name, "") for name in SEARCH_FIELDS})
+
+    def to_dict(self) -> dict:
+        """Return the data point as a dict."""
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+def serialize_data_points(data_points: list) -> list:
+    """Convert data points to dicts, leaving those of a nested approach's response as they are."""
+    return [
+        data_point.to_dict() if isinstance(data_point, SearchHit) else data_point
+        for data_point in data_points
+    ]
+
+
+class RetrievalGated(StopRun):
+    """Raised by a retrieval step when no retrieved content is relevant enough to answer from."""
+
+    def __init__(self, data_points: list, gate: dict):
+        """Initialize class."""
+        super().__init__()
+        self.data_points = data_points
+        self.gate = gate
+
+
+def trace_run(run):
+    """Wrap Approach.run in a span, so that nested approaches show up as child spans."""
+    @functools.wraps(run)
+    async def traced_run(self, q: str, overrides: dict, ctx: RequestContext) -> any:
+        label = ctx.item_prefix.strip()
+        with span("approach", approach=self.KEY, deployment=self.openai_deployment, label=label):
+            return await run(self, q, overrides, ctx)
+    return traced_run
 
 
 class Approach:
-    """Base class for prompting strategies."""
+    """Base class for prompting strategies.
+
+    Instances hold no per-request state and are shared across requests.
+    Subclasses with a KEY register themselves in APPROACH_CLASSES.
+    """
 
     KEY = ""
 
@@ -22,35 +152,130 @@ class Approach:
         self.search_client = search_client
         self.openai_deployment = openai_deployment
 
-        self.item_prefix = ""
-        self.item_suffix = ""
+    def __init_subclass__(cls, **kwargs):
+        """Register the prompting strategy and trace its runs."""
+        super().__init_subclass__(**kwargs)
+        if cls.KEY:
+            APPROACH_CLASSES[cls.KEY] = cls
+        if "run" in cls.__dict__:
+            cls.run = trace_run(cls.run)
 
-    def run(self, q: str, use_summaries: bool) -> any:
+    async def run(self, q: str, overrides: dict, ctx: RequestContext) -> any:
         """Orchestrate execution of the prompting strategy."""
         raise NotImplementedError
 
-    def create_label(self, label: str) -> str:
+    async def create_answer_completion(self, ctx: RequestContext, **kwargs):
+        """Generate the user-facing answer, streaming its tokens if requested."""
+        on_token = (lambda token: ctx.emit("delta", token)) if ctx.events is not None else None
+        return await create_chat_completion(on_token=on_token, should_abort=ctx.abort_answer, **kwargs)
+
+    def create_label(self, ctx: RequestContext, label: str) -> str:
         """Create a label."""
-        return self.item_prefix + label + self.item_suffix
+        return ctx.item_prefix + label + ctx.item_suffix
 
-    def create_time_item(self, label: str, start_time) -> dict:
+    def create_time_item(self, ctx: RequestContext, label: str, start_time) -> dict:
         """Create an item for monitoring.time."""
-        return {"label": self.create_label(label), "value": round(time.time() - start_time, 2)}
+        return {"label": self.create_label(ctx, label), "value": round(time.time() - start_time, 2)}
 
-    def create_cost_item(self, label: str, usage: dict) -> dict:
+    def create_cost_item(self, ctx: RequestContext, label: str, usage: dict) -> dict:
         """Create an item for monitoring.cost."""
-        return {"label": self.create_label(label), "value": calculate_cost(self.openai_deployment, usage)}
+        return {
+            "label": self.create_label(ctx, label),
+            "value": calculate_cost(self.openai_deployment, usage),
+        }
 
-    def create_usage_item(self, label: str, usage) -> dict:
+    def create_usage_item(self, ctx: RequestContext, label: str, usage) -> dict:
         """Create an item for monitoring.usage."""
-        return {"label": self.create_label(label), "value": usage}
+        return {"label": self.create_label(ctx, label), "value": usage}
 
-    def create_thought_item(self, label: str, value = "") -> dict:
+    def create_thought_item(self, ctx: RequestContext, label: str, value = "") -> dict:
         """Create an item for monitoring.prompts."""
-        return {"label": self.create_label(label), "value": value}
+        return {"label": self.create_label(ctx, label), "value": value}
+
+    def is_vector_search(self, overrides: dict) -> bool:
+        """Return true if the search option needs an embedding of the question."""
+        search_option = overrides.get("search_option", SearchOption.BM25)
+        return search_option in {SearchOption.Vector, SearchOption.VectorBM25, SearchOption.VectorSemantic}
+
+    def create_retrieval_steps(
+        self,
+        name: str,
+        overrides: dict,
+        ctx: RequestContext,
+        question: Optional[str] = None,
+        after: Optional[str] = None,
+        emit: bool = False,
+        gate: bool = False,
+    ) -> list:
+        """Create the steps that embed a question (for vector search) and retrieve documents from ACS.
+
+        The question is either given or the result of the step `after`. The result of the
+        step `name` is the data points and the source chunks; with `emit`, the data points
+        are streamed as soon as they are retrieved. With `gate`, the step raises RetrievalGated
+        if the retrieved contents score below the threshold of the search option. A search
+        found in the retrieval cache skips both the embedding and the ACS request.
+        """
+        dependencies = (after,) if after else ()
+        steps = []
+        if RETRIEVAL_CACHE is not None:
+            steps.append(Step(
+                f"{name}_cache",
+                lambda **results: self.lookup_retrieval(results.get(after, question), overrides),
+                after=dependencies,
+                # The store may be a SQLite file
+                blocking=True,
+            ))
+            dependencies += (f"{name}_cache",)
+        if self.is_vector_search(overrides):
+            steps.append(Step(
+                f"{name}_embedding",
+                lambda **results: generate_embeddings(results.get(after, question)),
+                after=dependencies,
+                label=AnalysisPanelLabel.VECTORIZATION,
+                ctx=ctx,
+                when=lambda **results: results.get(f"{name}_cache") is None,
+            ))
+            dependencies += (f"{name}_embedding",)
+
+        async def retrieve(**results) -> tuple:
+            data_points, chunks = await self.retrieve(
+                results.get(after, question), overrides, results.get(f"{name}_embedding"),
+                cached=results.get(f"{name}_cache"),
+            )
+            decision = self.gate_retrieval(data_points, overrides) if gate else None
+            gated = decision is not None and not decision["passed"]
+            if emit or gated:
+                ctx.emit("data_points", serialize_data_points(data_points))
+            if gated:
+                raise RetrievalGated(data_points, decision)
+            return data_points, chunks
+
+        steps.append(Step(name, retrieve, after=dependencies, label=AnalysisPanelLabel.RETRIEVAL, ctx=ctx))
+        return steps
+
+    def create_search_key(self, question: str, overrides: dict) -> str:
+        """Create a key of a search: the index, the search text and the settings that change its results."""
+        payload, use_captions = self.create_search_payload(question, overrides)
+        key = {
+            "index": self.search_client._index_name,
+            "question": question,
+            "search_option": int(overrides.get("search_option", SearchOption.BM25)),
+            "use_captions": use_captions,
+            # The vector query is the embedding of the question, so the question stands for it
+            "payload": repr({k: v for k, v in payload.items() if k != "vectors"}),
+        }
+        return hashlib.sha256(json.dumps(key, sort_keys=True, ensure_ascii=False).encode()).hexdigest()
 
-    def retrieve(self, question: str, overrides: dict) -> list:
-        """Retreve documents from ACS."""
+    def lookup_retrieval(self, question: str, overrides: dict) -> Optional[tuple]:
+        """Return the cached data points and contents of a search, or None; blocks on a SQLite store."""
+        if RETRIEVAL_CACHE is None:
+            return None
+        return RETRIEVAL_CACHE.get_results(self.create_search_key(question, overrides))
+
+    def create_search_payload(
+        self, question: str, overrides: dict, embedding: Optional[list] = None
+    ) -> tuple:
+        """Create the ACS search payload and whether the contents are the semantic captions."""
         top = overrides.get("top") or 3
         search_option = overrides.get("search_option", SearchOption.BM25)
         use_semantic_captions = True if overrides.get("semantic_captions") else False
@@ -59,8 +284,6 @@ class Approach:
             exclude_category.replace("'", "''")
         ) if exclude_category else None
 
-        monitoring = {"time": [], "cost": []}
-
         # Construct
         payload = {
             "filter": filter_,
@@ -74,18 +297,14 @@ class Approach:
                 "semantic_configuration_name": "default",
                 "query_caption": "extractive|highlight-false" if use_semantic_captions else None,
             }
-        if search_option in {SearchOption.Vector, SearchOption.VectorBM25, SearchOption.VectorSemantic}:
-            start_time_embeddings = time.time()
+        if self.is_vector_search(overrides):
             payload["vectors"] = [
                 Vector(
-                    value=generate_embeddings(question),
+                    value=embedding,
                     k=top,
                     fields="content_embedding",
                 )
             ]
-            monitoring["time"].append(self.create_time_item(
-                AnalysisPanelLabel.VECTORIZATION, start_time_embeddings)
-            )
 
         if search_option == SearchOption.Vector:
             payload["search_text"] = None
@@ -93,48 +312,203 @@ class Approach:
         else:
             payload["search_text"] = question
             payload["search_fields"] = ["content"]
+        payload["select"] = SEARCH_FIELDS
+
+        use_captions = use_semantic_captions and search_option in {
+            SearchOption.Semantic, SearchOption.VectorSemantic
+        }
+        return payload, use_captions
+
+    async def retrieve(
+        self,
+        question: str,
+        overrides: dict,
+        embedding: Optional[list] = None,
+        cached: Optional[tuple] = None,
+    ) -> tuple:
+        """Retreve documents from ACS, returning the data points and the source chunks.
+
+        `cached` is the result of lookup_retrieval, if any, which is used instead of searching.
+        """
+        top = overrides.get("top") or 3
+        search_option = overrides.get("search_option", SearchOption.BM25)
+        use_semantic_captions = True if overrides.get("semantic_captions") else False
+        payload, use_captions = self.create_search_payload(question, overrides, embedding)
 
         print(f"[DEBUG] search_option: '{search_option}' ({SearchOption(search_option).name})")
         print(f"[DEBUG] use_semantic_captions: {use_semantic_captions}")
         print(f"[DEBUG] payload: '{payload}'")
         print(f"[DEBUG] search_index: '{self.search_client._index_name}'")
 
-        # Retrieve relevant documents from ACS
-        start_time_retrieval= time.time()
-        search_results = self.search_client.search(**payload)
+        # Retrieve relevant documents from ACS, sharing identical in-flight searches
+        search_key = self.create_search_key(question, overrides)
+        with span(
+            "search", index=self.search_client._index_name, search_option=int(search_option), top=top
+        ) as s:
+            if cached is not None:
+                data_points, contents = cached
+                data_points, coalesced = [SearchHit(**data_point) for data_point in data_points], False
+                print(f"[DEBUG] Retrieval cache hit: {len(data_points)} documents")
+            else:
+                (data_points, contents), coalesced = await SEARCH_FLIGHT.do(
+                    search_key, lambda: self.search(payload, use_captions)
+                )
+                # The request that did the search caches it
+                if RETRIEVAL_CACHE is not None and not coalesced:
+                    await asyncio.to_thread(
+                        RETRIEVAL_CACHE.set_results,
+                        search_key,
+                        serialize_data_points(data_points),
+                        contents,
+                    )
+            if s:
+                s.set(results=len(data_points), coalesced=coalesced, cached=cached is not None)
+
+        # The token counts stored at index time are those of the whole contents, not of the captions
+        chunks = [
+            Chunk(content, None if use_captions else data_point.num_tokens)
+            for data_point, content in zip(data_points, contents)
+        ]
+
+        return data_points, chunks
+
+    async def search(self, payload: dict, use_captions: bool) -> tuple:
+        """Search ACS and parse the results into data points and source contents."""
+        search_results = await self.search_client.search(**payload)
 
-        # Parse search results
         data_points = []
         contents = []
-        for doc in search_results:
-            data_points.append(
-                {
-                    "score": doc["@search.score"],
-                    "id": doc["id"],
-                    "parent_id": doc["parent_id"],
-                    "title": doc.get("title", ""),
-                    "content": doc.get("content", ""),
-                    "source_path": doc.get("source_path", ""),
-                    "lang": doc.get("lang", ""),
-                    "page_num": doc.get("page_num", ""),
-                    "num_tokens": doc.get("num_tokens", ""),
-                    "modified_from_source": doc.get("modified_from_source", ""),
-                }
-            )
-            if (
-                use_semantic_captions
-                and search_option in {SearchOption.Semantic, SearchOption.VectorSemantic}
-            ):
+        async for doc in search_results:
+            data_points.append(SearchHit.from_document(doc))
+            if use_captions:
                 contents.append("- " + nonewlines("。".join([c.text for c in doc["@search.captions"]])))
             else:
                 contents.append("- " + nonewlines(doc["content"]))
+        return data_points, contents
 
-        monitoring["time"].append(self.create_time_item(AnalysisPanelLabel.RETRIEVAL, start_time_retrieval))
+    def pack_messages(
+        self,
+        ctx: RequestContext,
+        label: str,
+        create_messages: Callable[[str], list],
+        chunks: list,
+        max_tokens: int,
+        context_items: list,
+        question: str,
+        compression_max_tokens: Optional[int] = None,
+    ) -> list:
+        """Create chat messages with as many retrieved chunks as the context window leaves room for.
+
+        With `compression_max_tokens`, the chunks are first compressed to their sentences most
+        relevant to the question (see compression.py). The packing is reported as an item for
+        monitoring.context in `context_items`.
+        """
+        compression = None
+        if compression_max_tokens is not None:
+            with span("compression", chunks=len(chunks), max_tokens=compression_max_tokens):
+                chunks, compression = compress_chunks(question, chunks, compression_max_tokens)
+        messages, packed = pack_messages(
+            create_messages, chunks, get_context_length(self.openai_deployment), max_tokens
+        )
+        context_items.append(self.create_context_item(ctx, label, packed, compression))
+        return messages
+
+    def create_context_item(
+        self,
+        ctx: RequestContext,
+        label: str,
+        packed: PackedContext,
+        compression: Optional[Compression] = None,
+    ) -> dict:
+        """Create an item for monitoring.context."""
+        value = {
+            "num_tokens": packed.num_tokens,
+            "budget": packed.budget,
+            "num_chunks": packed.num_chunks,
+            "truncated": packed.truncated,
+        }
+        if compression is not None:
+            value["compression"] = dataclasses.asdict(compression)
+        return {"label": self.create_label(ctx, label), "value": value}
+
+    def create_compression_thoughts(self, ctx: RequestContext, context_items: list) -> list:
+        """Create the thought items reporting the tokens of the contents before and after compression."""
+        return [
+            self.create_thought_item(
+                ctx, AnalysisPanelLabel.CONTEXT_COMPRESSION,
+                f"{item['label']}: "
+                f"{compression['num_tokens_before']} → {compression['num_tokens_after']} トークン "
+                f"({compression['num_kept_sentences']}/{compression['num_sentences']} 文)",
+            )
+            for item in context_items
+            if (compression := item["value"].get("compression")) is not None
+        ]
+
+    def gate_retrieval(self, data_points: list, overrides: dict) -> Optional[dict]:
+        """Decide whether the retrieved contents are relevant enough to answer from.
 
-        # TODO: For now, limit the content length < 1750 to avoid the maximum-context-length error
-        content = "\n".join(contents)[:1500]
+        Returns None if the search option has no score threshold, otherwise the top score,
+        the threshold and whether the top score passed it.
+        """
+        search_option = SearchOption(overrides.get("search_option", SearchOption.BM25))
+        threshold = overrides.get("score_threshold", RETRIEVAL_SCORE_THRESHOLDS.get(search_option))
+        if threshold is None:
+            return None
+        score = max((data_point.score for data_point in data_points), default=None)
+        return {"score": score, "threshold": threshold, "passed": score is not None and score >= threshold}
 
-        return data_points, content, monitoring
+    def create_gate_thoughts(self, ctx: RequestContext, gate: Optional[dict]) -> list:
+        """Create the thought items reporting the decision of the retrieval score gate, if any."""
+        if gate is None:
+            return []
+        if gate["passed"]:
+            result = AnalysisPanelLabel.RETRIEVAL_GATE_PASSED
+        else:
+            result = AnalysisPanelLabel.RETRIEVAL_GATE_BLOCKED
+        return [self.create_thought_item(
+            ctx, AnalysisPanelLabel.RETRIEVAL_GATE,
+            f"{result.value} (score: {gate['score']}, threshold: {gate['threshold']})",
+        )]
+
+    async def create_gated_response(
+        self, q: str, ctx: RequestContext, gated: RetrievalGated, start_time: float
+    ) -> dict:
+        """Answer that there is not enough information, without calling OpenAI."""
+        language = await detect_language(q)
+        answer = INSUFFICIENT_INFORMATION_ANSWER.get(language, INSUFFICIENT_INFORMATION_ANSWER["ja"])
+        ctx.emit("delta", answer)
+        return self.create_response(
+            data_points=gated.data_points,
+            answer=answer,
+            thoughts=self.create_gate_thoughts(ctx, gated.gate),
+            start_time=start_time,
+            monitoring_time_items=gated.time_items,
+            monitoring_cost_items=[],
+            usage=[],
+            gate=gated.gate,
+        )
+
+    def vote_language(self, data_points: list) -> Optional[str]:
+        """Return the language of the retrieved contents by a vote of their index-time `lang`.
+
+        Chunks vote with their number of tokens. Returns None if the chunks without a known
+        `lang` could change the outcome, so that the language is detected instead.
+        """
+        votes = {}
+        unknown = 0
+        for data_point in data_points:
+            weight = data_point.num_tokens
+            if not isinstance(weight, int) or weight <= 0:
+                weight = count_tokens(data_point.content)
+            language = LANGUAGE_CODES.get(data_point.lang)
+            if language is None:
+                unknown += weight
+            else:
+                votes[language] = votes.get(language, 0) + weight
+        ranking = sorted(votes.values(), reverse=True) + [0, 0]
+        if ranking[0] <= ranking[1] + unknown:
+            return None
+        return max(votes, key=votes.get)
 
     def clean_text(self, text: str) -> str:
         """Clean up input text."""
@@ -150,22 +524,32 @@ class Approach:
         monitoring_time_items: list,
         monitoring_cost_items: list,
         usage: dict,
+        gate: Optional[dict] = None,
+        context: Optional[list] = None,
     ) -> dict:
         """Create response for /ask endpoint."""
-        return {
-            "approach": self.KEY,
-            "data_points": data_points,
-            "answer": self.clean_text(answer),
-            "thoughts": thoughts,
-            "monitoring": {
-                "time": {
-                    "total": round(time.time() - start_time, 2),
-                    "items": sorted(monitoring_time_items, key=lambda item: item["value"], reverse=True),
-                },
-                "cost": {
-                    "total": round(sum(item["value"] for item in monitoring_cost_items), 2),
-                    "items": sorted(monitoring_cost_items, key=lambda item: item["value"], reverse=True)
-                },
-                "usage": usage,
+        with span("create_response"):
+            r = {
+                "approach": self.KEY,
+                "data_points": serialize_data_points(data_points),
+                "answer": self.clean_text(answer),
+                "thoughts": thoughts,
+                "monitoring": {
+                    "time": {
+                        "total": round(time.time() - start_time, 2),
+                        "items": sorted(
+                            monitoring_time_items, key=lambda item: item["value"], reverse=True
+                        ),
+                    },
+                    "cost": {
+                        "total": round(sum(item["value"] for item in monitoring_cost_items), 2),
+                        "items": sorted(monitoring_cost_items, key=lambda item: item["value"], reverse=True)
+                    },
+                    "usage": usage,
+                }
             }
-        }
+            if gate is not None:
+                r["monitoring"]["gate"] = gate
+            if context is not None:
+                r["monitoring"]["context"] = context
+            return r
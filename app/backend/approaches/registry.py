@@ -0,0 +1,38 @@
+"""Registry of prompting strategies shared across requests.
+
+Every module in this package is imported on startup, so a new approach only needs a
+subclass of `Approach` with a unique KEY to become available through /ask.
+"""
+import importlib
+import pkgutil
+from typing import Iterable, Optional
+
+import approaches
+from approaches.approach import APPROACH_CLASSES, Approach
+from azure.search.documents.aio import SearchClient
+
+
+def load_approaches() -> dict:
+    """Import all modules of the approaches package and return the registered classes."""
+    for module in pkgutil.iter_modules(approaches.__path__):
+        importlib.import_module(f"{approaches.__name__}.{module.name}")
+    return APPROACH_CLASSES
+
+
+class ApproachRegistry:
+    """Build each approach once per deployment and share the instances."""
+
+    def __init__(self, search_client: SearchClient, deployments: Iterable[str]):
+        """Initialize class."""
+        self.search_client = search_client
+        self.classes = load_approaches()
+        # Only the deployments known at startup are served, so requests cannot add instances
+        self.approaches = {
+            (key, deployment): cls(search_client, deployment)
+            for key, cls in self.classes.items()
+            for deployment in deployments
+        }
+
+    def get(self, key: str, deployment: str) -> Optional[Approach]:
+        """Return the shared instance of the approach, or None if the approach or deployment is unknown."""
+        return self.approaches.get((key, deployment))
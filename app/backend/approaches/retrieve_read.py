@@ -6,8 +6,9 @@
 """
 import time
 
-import openai
-from approaches.approach import Approach
+from approaches.approach import Approach, RequestContext, RetrievalGated
+from approaches.steps import Step, StepGraph
+from compression import CONTEXT_COMPRESSION_MAX_TOKENS
 from constants import (
     AnalysisPanelLabel,
     SYSTEM_PROMPT_GENERATE_ANSWER,
@@ -18,37 +19,68 @@ from constants import (
 class RetrieveReadApproach(Approach):
     KEY = "rr"
 
-    def run(self, q: str, overrides: dict) -> any:
+    async def run(self, q: str, overrides: dict, ctx: RequestContext) -> any:
         start_time = time.time()
         temperature = overrides.get('temperature', 0.6)
+        max_tokens = 1024
+        compression_max_tokens = overrides.get("compression_max_tokens", CONTEXT_COMPRESSION_MAX_TOKENS)
 
-        monitoring_time_items = []
         monitoring_cost_items = []
+        context_items = []
 
         print(f"[DEBUG] openai_deployment={self.openai_deployment}")
         print(f"[DEBUG] {temperature=}")
 
-        # Step 1: Retrieve contents based on the input question
-        data_points, retrieved, monitoring = self.retrieve(q, overrides)
-        monitoring_time_items += monitoring["time"]
+        def create_answer_message(retrieval: tuple) -> list:
+            _, chunks = retrieval
+            return self.pack_messages(
+                ctx, AnalysisPanelLabel.ANSWER_GENERATION,
+                lambda source: [
+                    {"role": "system", "content": SYSTEM_PROMPT_GENERATE_ANSWER},
+                    {
+                        "role": "user",
+                        "content": USER_PROMPT_GENERATE_ANSWER.format(source=source, question=q),
+                    },
+                ],
+                chunks, max_tokens, context_items, q, compression_max_tokens,
+            )
 
-        # Step 2: Generate answer based on the reformulated question
-        message = [
-            {"role": "system", "content": SYSTEM_PROMPT_GENERATE_ANSWER},
-            {"role": "user", "content": USER_PROMPT_GENERATE_ANSWER.format(source=retrieved, question=q)},
-        ]
-        start_time_answer = time.time()
-        completion = openai.ChatCompletion.create(
-            engine=self.openai_deployment,
-            messages=message,
-            temperature=temperature,
-            max_tokens=1024,
-            n=1,
+        graph = StepGraph([
+            # Step 1: Retrieve contents based on the input question
+            *self.create_retrieval_steps("retrieval", overrides, ctx, question=q, emit=True, gate=True),
+            # Step 2: Generate answer based on the retrieved contents
+            Step("answer_message", create_answer_message, after=("retrieval",)),
+            Step(
+                "answer",
+                lambda answer_message: self.create_answer_completion(
+                    ctx,
+                    engine=self.openai_deployment,
+                    messages=answer_message,
+                    temperature=temperature,
+                    max_tokens=max_tokens,
+                    n=1,
+                ),
+                after=("answer_message",),
+                label=AnalysisPanelLabel.ANSWER_GENERATION,
+            ),
+        ])
+        try:
+            results, monitoring_time_items = await graph.run(self, ctx)
+        except RetrievalGated as gated:
+            return await self.create_gated_response(q, ctx, gated, start_time)
+        data_points, _ = results["retrieval"]
+        message, completion = results["answer_message"], results["answer"]
+        gate = self.gate_retrieval(data_points, overrides)
+
+        monitoring_cost_items.append(
+            self.create_cost_item(ctx, AnalysisPanelLabel.ANSWER_GENERATION, completion["usage"])
         )
-        monitoring_time_items.append(self.create_time_item(AnalysisPanelLabel.ANSWER_GENERATION, start_time_answer))
-        monitoring_cost_items.append(self.create_cost_item(AnalysisPanelLabel.ANSWER_GENERATION, completion["usage"]))
-        thoughts = [self.create_thought_item(AnalysisPanelLabel.ANSWER_GENERATION_PROMPT, message)]
-        usage = [self.create_usage_item(AnalysisPanelLabel.ANSWER_GENERATION, completion["usage"])]
+        thoughts = [
+            *self.create_gate_thoughts(ctx, gate),
+            *self.create_compression_thoughts(ctx, context_items),
+            self.create_thought_item(ctx, AnalysisPanelLabel.ANSWER_GENERATION_PROMPT, message),
+        ]
+        usage = [self.create_usage_item(ctx, AnalysisPanelLabel.ANSWER_GENERATION, completion["usage"])]
 
         return self.create_response(
             data_points=data_points,
@@ -58,4 +90,6 @@ class RetrieveReadApproach(Approach):
             monitoring_time_items=monitoring_time_items,
             monitoring_cost_items=monitoring_cost_items,
             usage=usage,
+            gate=gate,
+            context=context_items,
         )
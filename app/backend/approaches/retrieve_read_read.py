@@ -8,8 +8,9 @@ Steps.
 
 import time
 
-import openai
-from approaches.approach import Approach
+from approaches.approach import Approach, RequestContext, RetrievalGated
+from approaches.steps import Step, StepGraph
+from compression import CONTEXT_COMPRESSION_MAX_TOKENS
 from constants import (
     SYSTEM_PROMPT_ENG_ENG,
     SYSTEM_PROMPT_ENG_JP,
@@ -20,7 +21,7 @@ from constants import (
     USER_PROMPT_GENERATE_ANSWER,
     AnalysisPanelLabel
 )
-from utils import detect_language
+from utils import create_chat_completion, detect_language
 
 
 class RetrieveReadReadApproach(Approach):
@@ -28,122 +29,152 @@ class RetrieveReadReadApproach(Approach):
 
     KEY = "rrr"
 
-    def run(self, q: str, overrides: dict) -> any:
+    async def run(self, q: str, overrides: dict, ctx: RequestContext) -> any:
         """Orchestrate execution of the prompting strategy."""
         start_time = time.time()
         temperature = overrides.get('temperature', 0.6)
+        max_tokens = 1024
+        compression_max_tokens = overrides.get("compression_max_tokens", CONTEXT_COMPRESSION_MAX_TOKENS)
 
-        monitoring_time_items = []
         monitoring_cost_items = []
         monitoring_usage = []
+        context_items = []
         thoughts = []
 
         print(f"[DEBUG] openai_deployment={self.openai_deployment}")
         print(f"[DEBUG] {temperature=}")
 
-
-        # Step 0: Question language detection
-        ques_lang = detect_language(q)
-        print(f"[DEBUG] {ques_lang=}")
-
-
-
-        # Step 1: Retrieve contents based on the input question
-        data_points, retrieved, monitoring = self.retrieve(q, overrides)
-        monitoring_time_items += monitoring["time"]
-        context_lang = detect_language(retrieved)
-        print(f"[DEBUG] {context_lang=}")
-        print("\n\n")
-        print(f"[DEBUG] {retrieved=}")
+        async def detect_context_language(retrieval: tuple) -> str:
+            data_points, chunks = retrieval
+            retrieved = "\n".join(chunk.text for chunk in chunks)
+            print("\n\n")
+            print(f"[DEBUG] {retrieved=}")
+            # The language of the contents is known from the index; detect it only for chunks without one
+            return self.vote_language(data_points) or await detect_language(retrieved)
 
         # Step 2: Message selection of static prompts based on language detected
+        def create_answer_message(question_language: str, context_language: str, retrieval: tuple) -> list:
+            print(f"[DEBUG] {question_language=}")
+            print(f"[DEBUG] {context_language=}")
+            _, chunks = retrieval
+
+            if question_language == "en" and context_language == "en":
+                message = [
+                    {"role": "system", "content": SYSTEM_PROMPT_ENG_ENG}
+                ]
+            elif question_language == "en" and context_language == "ja":
+                message = [
+                    {"role": "system", "content": SYSTEM_PROMPT_ENG_JP}
+                ]
+            elif question_language == "ja" and context_language == "en":
+                message = [
+                    {"role": "system", "content": SYSTEM_PROMPT_JP_ENG}
+                ]
+            else:
+                message = [
+                    {"role": "system", "content": SYSTEM_PROMPT_JP_JP}
+                ]
+
+            return self.pack_messages(
+                ctx, AnalysisPanelLabel.ANSWER_GENERATION,
+                lambda source: message + [
+                    {
+                        "role": "user",
+                        "content": USER_PROMPT_GENERATE_ANSWER.format(source=source, question=q),
+                    }
+                ],
+                chunks, max_tokens, context_items, q, compression_max_tokens,
+            )
 
-        if ques_lang == "en" and context_lang == "en":
-            message = [
-                {"role": "system", "content": SYSTEM_PROMPT_ENG_ENG}
-            ]
-        elif ques_lang == "en" and context_lang == "ja":
-            message = [
-                {"role": "system", "content": SYSTEM_PROMPT_ENG_JP}
-            ]
-        elif ques_lang == "ja" and context_lang == "en":
-            message = [
-                {"role": "system", "content": SYSTEM_PROMPT_JP_ENG}
-            ]
-        else:
-            message = [
-                {"role": "system", "content": SYSTEM_PROMPT_JP_JP}
+        # Step 3: Confirm that the generated answer is acceptable
+        def create_confirmation_message(question_language: str, answer_language: str, answer) -> list:
+            answer = answer.choices[0].message.content
+            if question_language == "en" and answer_language == "en":
+                return [
+                    {"role": "system", "content": USER_PROMPT_CONFIRMING_ANSWER_ENG.format(
+                        answer=answer, question=q)}
+                ]
+            return [
+                {"role": "system", "content": USER_PROMPT_CONFIRMING_ANSWER_JP.format(
+                    answer=answer, question=q)}
             ]
 
-        message.append({"role": "user", "content": USER_PROMPT_GENERATE_ANSWER.format(
-            source=retrieved, question=q)}
-        )
-    
-        start_time_answer = time.time()
-        completion = openai.ChatCompletion.create(
-            engine=self.openai_deployment,
-            messages=message,
-            temperature=temperature,
-            max_tokens=1024,
-            n=1,
-        )
-        answer = completion.choices[0].message.content
+        graph = StepGraph([
+            # Step 0 & 1: Detect question language while retrieving contents based on the input question
+            Step("question_language", lambda: detect_language(q)),
+            *self.create_retrieval_steps("retrieval", overrides, ctx, question=q, emit=True, gate=True),
+            Step("context_language", detect_context_language, after=("retrieval",)),
+            Step(
+                "answer_message", create_answer_message,
+                after=("question_language", "context_language", "retrieval"),
+            ),
+            Step(
+                "answer",
+                lambda answer_message: self.create_answer_completion(
+                    ctx,
+                    engine=self.openai_deployment,
+                    messages=answer_message,
+                    temperature=temperature,
+                    max_tokens=max_tokens,
+                    n=1,
+                ),
+                after=("answer_message",),
+                label=AnalysisPanelLabel.ANSWER_GENERATION,
+            ),
+            Step(
+                "answer_language", lambda answer: detect_language(answer.choices[0].message.content),
+                after=("answer",),
+            ),
+            Step(
+                "confirmation_message", create_confirmation_message,
+                after=("question_language", "answer_language", "answer"),
+            ),
+            Step(
+                "confirmation",
+                lambda confirmation_message: create_chat_completion(
+                    engine=self.openai_deployment,
+                    messages=confirmation_message,
+                    temperature=temperature,
+                    max_tokens=max_tokens,
+                    n=1,
+                ),
+                after=("confirmation_message",),
+                label=AnalysisPanelLabel.ANSWER_CONFIRMATION,
+            ),
+        ])
+        try:
+            results, monitoring_time_items = await graph.run(self, ctx)
+        except RetrievalGated as gated:
+            return await self.create_gated_response(q, ctx, gated, start_time)
+        data_points, _ = results["retrieval"]
+        gate = self.gate_retrieval(data_points, overrides)
+        thoughts += self.create_gate_thoughts(ctx, gate)
+        message = results["answer_message"]
+        answer = results["answer"].choices[0].message.content
+        completion = results["confirmation"]
         print("\n\n")
         print(f"[DEBUG] {answer=}")
-        monitoring_time_items.append(
-            self.create_time_item(AnalysisPanelLabel.ANSWER_GENERATION, start_time_answer)
-        )
-        monitoring_cost_items.append(
-            self.create_cost_item(AnalysisPanelLabel.ANSWER_GENERATION, completion["usage"])
-        )
-        monitoring_usage.append(
-            self.create_usage_item(AnalysisPanelLabel.ANSWER_GENERATION, completion["usage"])
-        )
-        thoughts.append(
-            self.create_thought_item(AnalysisPanelLabel.ANSWER_GENERATION_PROMPT, message)
-        )
-
-        # Step 3: Confirm that the generated answer is acceptable
-        ans_lang = detect_language(answer)
-        if ques_lang == "en" and ans_lang == "en":
 
-            confirm_message = [
-                {"role": "system", "content": USER_PROMPT_CONFIRMING_ANSWER_ENG.format(
-                    answer=answer, question=q)}
-            ]
-        else:
-            confirm_message = [
-                {"role": "system", "content": USER_PROMPT_CONFIRMING_ANSWER_JP.format(
-                    answer=answer, question=q)}
-            ]
-            
-        start_time_answer = time.time()
-        completion = openai.ChatCompletion.create(
-            engine=self.openai_deployment,
-            messages=confirm_message,
-            temperature=temperature,
-            max_tokens=1024,
-            n=1,
+        for label, step in [
+            (AnalysisPanelLabel.ANSWER_GENERATION, "answer"),
+            (AnalysisPanelLabel.ANSWER_CONFIRMATION, "confirmation"),
+        ]:
+            monitoring_cost_items.append(self.create_cost_item(ctx, label, results[step]["usage"]))
+            monitoring_usage.append(self.create_usage_item(ctx, label, results[step]["usage"]))
+        thoughts += self.create_compression_thoughts(ctx, context_items)
+        thoughts.append(
+            self.create_thought_item(ctx, AnalysisPanelLabel.ANSWER_GENERATION_PROMPT, message)
         )
         confirmation_response = self.clean_text(completion.choices[0].message.content)
-        monitoring_time_items.append(
-            self.create_time_item(AnalysisPanelLabel.ANSWER_CONFIRMATION, start_time_answer)
-            )
-        monitoring_cost_items.append(
-            self.create_cost_item(AnalysisPanelLabel.ANSWER_CONFIRMATION, completion["usage"])
-            )
-        monitoring_usage.append(
-            self.create_usage_item(AnalysisPanelLabel.ANSWER_CONFIRMATION, completion["usage"])
-            )
         thoughts.append(
-            self.create_thought_item(AnalysisPanelLabel.ANSWER_CONFIRMATION_PROMPT, message)
+            self.create_thought_item(ctx, AnalysisPanelLabel.ANSWER_CONFIRMATION_PROMPT, message)
             )
         print(f"[DEBUG] {confirmation_response=}")
 
         if confirmation_response == "Yes" or confirmation_response == "はい":
             thoughts.append(
                 self.create_thought_item(
-                    AnalysisPanelLabel.ANSWER_CONFIRMATION_RESULT,
+                    ctx, AnalysisPanelLabel.ANSWER_CONFIRMATION_RESULT,
                     AnalysisPanelLabel.ANSWER_CONFIRMATION_RESULT_YES
                 )
             )
@@ -155,15 +186,21 @@ class RetrieveReadReadApproach(Approach):
                 monitoring_time_items=monitoring_time_items,
                 monitoring_cost_items=monitoring_cost_items,
                 usage=monitoring_usage,
+                gate=gate,
+                context=context_items,
             )
 
         thoughts.append(
             self.create_thought_item(
-                AnalysisPanelLabel.ANSWER_CONFIRMATION_RESULT,
+                ctx, AnalysisPanelLabel.ANSWER_CONFIRMATION_RESULT,
                 AnalysisPanelLabel.ANSWER_CONFIRMATION_RESULT_NO
             )
         )
-        thoughts.append(self.create_thought_item(AnalysisPanelLabel.ORIGINAL_ANSWER, answer))
+        thoughts.append(self.create_thought_item(ctx, AnalysisPanelLabel.ORIGINAL_ANSWER, answer))
+
+        # Replace the streamed answer with the rewritten one
+        ctx.emit("reset")
+        ctx.emit("delta", completion.choices[0].message.content)
 
         return self.create_response(
             data_points=data_points,
@@ -173,4 +210,6 @@ class RetrieveReadReadApproach(Approach):
             monitoring_time_items=monitoring_time_items,
             monitoring_cost_items=monitoring_cost_items,
             usage=monitoring_usage,
+            gate=gate,
+            context=context_items,
         )
@@ -1,58 +1,248 @@
 """
 Steps:
 
-1. Do Approach 1
+1. Do Approach 1, cutting its answer short as soon as it starts with a refusal
 2. If Approach 1 doesn't produce an answer, do Approach 2
+
+If the retrieval score gate of Approach 1 finds nothing relevant, Approach 2 (which
+searches for the same question first) is skipped as well.
+
+With RRRT_HEDGE_AFTER_IN_SEC (or the override `hedge_after_in_sec`) set, Approach 2 is
+hedged: it starts that many seconds after Approach 1 (0 starts both together), its
+answer is streamed into a buffer, and its result is only used if Approach 1's answer is
+insufficient. Otherwise it is cancelled, and the tokens it already spent, including the
+answer tokens streamed so far, are reported in monitoring.cost.
 """
+import asyncio
+import dataclasses
+import os
 import re
 import time
+from typing import Optional
 
-from approaches.approach import Approach
+from approaches.approach import Approach, RequestContext
 from approaches.retrieve_read import RetrieveReadApproach
 from approaches.retrieve_reformulate_retrieve_read import RetrieveReformulateRetrieveReadApproach
+from approaches.steps import Step, StepGraph
+from azure.search.documents.aio import SearchClient
 from constants import AnalysisPanelLabel
+from tracing import span
+from utils import COMPLETION_USAGE
+
+RRRT_HEDGE_AFTER_IN_SEC = (
+    float(os.environ["RRRT_HEDGE_AFTER_IN_SEC"]) if os.environ.get("RRRT_HEDGE_AFTER_IN_SEC") else None
+)
+
+# Answers saying that there is not enough information to answer
+INSUFFICIENT_ANSWER_PATTERNS = [
+    re.compile(r"^わかりません.*"),
+    re.compile(r".*わかりません。?$"),
+    re.compile(r"^I (?:don't|don’t|do not) know.*", re.IGNORECASE),
+    re.compile(r".*I (?:don't|don’t|do not) know\.?$", re.IGNORECASE),
+]
+# Beginnings of such answers, detected while Approach 1 is generating
+REFUSAL_PREFIXES = ["わかりません", "分かりません", "i don't know", "i don’t know", "i do not know"]
+REFUSAL_PREFIX_MAX_LENGTH = max(len(prefix) for prefix in REFUSAL_PREFIXES)
+
+
+class RefusalDetector:
+    """Detect an answer that starts with a refusal while it is being generated."""
+
+    def __init__(self):
+        """Initialize class."""
+        self.detected = False
+
+    def __call__(self, content: str) -> bool:
+        """Return true if the content generated so far starts with a refusal."""
+        content = content.lstrip(" \n「\"").casefold()
+        if len(content) > REFUSAL_PREFIX_MAX_LENGTH + 1:
+            # Past the prefixes (and the predicate is no longer called after a refusal)
+            return False
+        self.detected = any(content.startswith(prefix) for prefix in REFUSAL_PREFIXES)
+        return self.detected
+
+
+class EventBuffer:
+    """Hold the streaming events of a hedged approach until its answer is used."""
+
+    def __init__(self):
+        """Initialize class."""
+        self.events = []
+        self.released = False
+        self.target = None
+
+    def put_nowait(self, event: tuple) -> None:
+        """Buffer an event, or forward it once released."""
+        if not self.released:
+            self.events.append(event)
+        elif self.target is not None:
+            self.target.put_nowait(event)
+
+    def release(self, target: Optional[asyncio.Queue]) -> None:
+        """Forward the buffered events and all further ones, or drop them if the request is not streamed."""
+        if target is not None:
+            for event in self.events:
+                target.put_nowait(event)
+        self.events = []
+        self.released = True
+        self.target = target
+
+
+class HedgedRun:
+    """Run of an approach started before it is known to be needed."""
+
+    def __init__(self, approach: Approach, q: str, overrides: dict, ctx: RequestContext, delay: float):
+        """Initialize class."""
+        self.ctx = ctx
+        # Always streamed, so that the answer tokens received before a cancel can be counted
+        self.buffer = EventBuffer()
+        self.usage = []
+        # Whether the run started before it was known to be needed
+        self.early = False
+        self.needed = asyncio.Event()
+        self.task = asyncio.create_task(
+            self.run(approach, q, overrides, dataclasses.replace(ctx, events=self.buffer), delay)
+        )
+
+    async def run(
+        self, approach: Approach, q: str, overrides: dict, ctx: RequestContext, delay: float
+    ) -> dict:
+        """Wait for the delay (or until the run is needed) and run the approach, collecting its usage."""
+        COMPLETION_USAGE.set(self.usage)
+        try:
+            await asyncio.wait_for(self.needed.wait(), delay)
+        except asyncio.TimeoutError:
+            pass
+        self.early = not self.needed.is_set()
+        with span("hedge", approach=approach.KEY, delay=delay):
+            return await approach.run(q, overrides, ctx)
+
+    async def result(self) -> dict:
+        """Use the run: stream its events from now on and wait for its response."""
+        self.needed.set()
+        self.buffer.release(self.ctx.events)
+        return await self.task
+
+    async def cancel(self) -> Optional[dict]:
+        """Cancel the run, returning the usage it already spent, if any."""
+        self.task.cancel()
+        await asyncio.gather(self.task, return_exceptions=True)
+        if not self.usage:
+            return None
+        return {
+            key: sum(usage.get(key, 0) for usage in self.usage)
+            for key in ["prompt_tokens", "completion_tokens", "total_tokens"]
+        }
 
 
 class RetrieveReadRetryApproach(Approach):
     KEY = "rrrt"
 
+    def __init__(self, search_client: SearchClient, openai_deployment: str):
+        """Initialize class."""
+        super().__init__(search_client, openai_deployment)
+        self.approach1 = RetrieveReadApproach(search_client, openai_deployment)
+        self.approach2 = RetrieveReformulateRetrieveReadApproach(search_client, openai_deployment)
+
     def is_sufficient_answer(self, answer: str) -> bool:
         """Return true if answer is sufficient."""
-        return not bool(re.match(r"^わかりません.*", answer) or re.match(r".*わかりません。?$", answer))
+        return not any(pattern.match(answer) for pattern in INSUFFICIENT_ANSWER_PATTERNS)
+
+    def is_gated(self, r: dict) -> bool:
+        """Return true if the retrieval score gate ended the approach without an answer."""
+        gate = r["monitoring"].get("gate")
+        return gate is not None and not gate["passed"]
 
-    def run(self, q: str, overrides: dict) -> any:
+    async def run(self, q: str, overrides: dict, ctx: RequestContext) -> any:
         start_time = time.time()
+        # Approach 1 is cut short as soon as its answer starts with a refusal
+        refusal = RefusalDetector()
+        ctx1 = dataclasses.replace(ctx.nested(item_prefix="[Approach 1] "), abort_answer=refusal)
+        ctx2 = ctx.nested(item_prefix="[Approach 2] ")
+        hedge_after_in_sec = overrides.get("hedge_after_in_sec", RRRT_HEDGE_AFTER_IN_SEC)
+        hedge = None
+        if hedge_after_in_sec is not None:
+            hedge = HedgedRun(self.approach2, q, overrides, ctx2, hedge_after_in_sec)
 
-        thoughts = []
-
-        approach1 = RetrieveReadApproach(self.search_client, self.openai_deployment)
-        approach1.item_prefix = "[Approach 1] "
-        resp1 = approach1.run(q, overrides)
-
-        if self.is_sufficient_answer(resp1["answer"]):
-            resp1["thoughts"].append(self.create_thought_item(
-                AnalysisPanelLabel.ANSWER_CONFIRMATION_RESULT,
-                AnalysisPanelLabel.DO_NOT_PROCEEDS_WITH_APPROACH_2
-            ))
-            return resp1
-
-        thoughts += resp1["thoughts"]
-        thoughts.append(self.create_thought_item(AnalysisPanelLabel.ANSWER_FROM_APPROACH_1, resp1['answer']))
-        thoughts.append(self.create_thought_item(
-            AnalysisPanelLabel.ANSWER_CONFIRMATION_RESULT,
-            AnalysisPanelLabel.PROCEEDS_WITH_APPROACH_2
-        ))
-
-        approach2 = RetrieveReformulateRetrieveReadApproach(self.search_client, self.openai_deployment)
-        approach2.item_prefix = "[Approach 2] "
-        resp2 = approach2.run(q, overrides)
-        
-        return self.create_response(
-            data_points=resp2["data_points"],
-            answer=resp2["answer"],
-            thoughts=thoughts + resp2["thoughts"],
-            start_time=start_time,
-            monitoring_time_items=resp1["monitoring"]["time"]["items"] + resp2["monitoring"]["time"]["items"],
-            monitoring_cost_items=resp1["monitoring"]["cost"]["items"] + resp2["monitoring"]["cost"]["items"],
-            usage=resp1["monitoring"]["usage"] + resp2["monitoring"]["usage"],
-        )
+        async def run_approach2(approach1: dict) -> Optional[dict]:
+            if self.is_gated(approach1):
+                return None
+            if not refusal.detected and self.is_sufficient_answer(approach1["answer"]):
+                return None
+            # Discard the streamed answer of Approach 1
+            ctx.emit("reset")
+            if hedge is not None:
+                return await hedge.result()
+            return await self.approach2.run(q, overrides, ctx2)
+
+        graph = StepGraph([
+            Step("approach1", lambda: self.approach1.run(q, overrides, ctx1)),
+            Step("approach2", run_approach2, after=("approach1",)),
+        ])
+        try:
+            results, _ = await graph.run(self, ctx)
+        except BaseException:
+            if hedge is not None:
+                await hedge.cancel()
+            raise
+        resp1, resp2 = results["approach1"], results["approach2"]
+
+        if resp2 is None:
+            if not self.is_gated(resp1):
+                resp1["thoughts"].append(self.create_thought_item(
+                    ctx, AnalysisPanelLabel.ANSWER_CONFIRMATION_RESULT,
+                    AnalysisPanelLabel.DO_NOT_PROCEEDS_WITH_APPROACH_2
+                ))
+            hedge_usage = await hedge.cancel() if hedge is not None else None
+            if hedge_usage is not None:
+                # The tokens spent by the cancelled Approach 2 are paid for all the same
+                # The label names Approach 2 already, so it takes no "[Approach 2]" prefix
+                resp1["thoughts"].append(self.create_thought_item(
+                    ctx, AnalysisPanelLabel.HEDGED_APPROACH_2,
+                    AnalysisPanelLabel.HEDGED_APPROACH_2_CANCELLED
+                ))
+                cost = resp1["monitoring"]["cost"]
+                hedge_cost = self.create_cost_item(ctx, AnalysisPanelLabel.HEDGED_APPROACH_2, hedge_usage)
+                cost["items"] = sorted(
+                    cost["items"] + [hedge_cost], key=lambda item: item["value"], reverse=True,
+                )
+                cost["total"] = round(sum(item["value"] for item in cost["items"]), 2)
+                resp1["monitoring"]["usage"].append(
+                    self.create_usage_item(ctx, AnalysisPanelLabel.HEDGED_APPROACH_2, hedge_usage)
+                )
+            r = resp1
+            r["monitoring"]["fallback"] = False
+        else:
+            thoughts = resp1["thoughts"] + [
+                self.create_thought_item(ctx, AnalysisPanelLabel.ANSWER_FROM_APPROACH_1, resp1['answer']),
+            ]
+            if refusal.detected:
+                thoughts.append(self.create_thought_item(
+                    ctx1, AnalysisPanelLabel.ANSWER_ABORTED, AnalysisPanelLabel.ANSWER_ABORTED_REFUSAL
+                ))
+            thoughts += [
+                self.create_thought_item(
+                    ctx, AnalysisPanelLabel.ANSWER_CONFIRMATION_RESULT,
+                    AnalysisPanelLabel.PROCEEDS_WITH_APPROACH_2
+                ),
+            ]
+            monitoring1, monitoring2 = resp1["monitoring"], resp2["monitoring"]
+            r = self.create_response(
+                data_points=resp2["data_points"],
+                answer=resp2["answer"],
+                thoughts=thoughts + resp2["thoughts"],
+                start_time=start_time,
+                monitoring_time_items=monitoring1["time"]["items"] + monitoring2["time"]["items"],
+                monitoring_cost_items=monitoring1["cost"]["items"] + monitoring2["cost"]["items"],
+                usage=resp1["monitoring"]["usage"] + resp2["monitoring"]["usage"],
+                gate=resp1["monitoring"].get("gate"),
+                context=resp1["monitoring"].get("context", []) + resp2["monitoring"].get("context", []),
+            )
+            # Whether Approach 2 was needed, for the request ledger
+            r["monitoring"]["fallback"] = True
+
+        if hedge is not None:
+            r["monitoring"]["hedge"] = {
+                "after": hedge_after_in_sec, "early": hedge.early, "used": resp2 is not None
+            }
+        return r
@@ -7,96 +7,149 @@ Steps:
 """
 import time
 
-import openai
-from approaches.approach import Approach
+from approaches.approach import Approach, RequestContext, RetrievalGated
+from approaches.steps import Step, StepGraph
+from compression import CONTEXT_COMPRESSION_MAX_TOKENS
 from constants import (
     AnalysisPanelLabel,
     SYSTEM_PROMPT_GENERATE_ANSWER,
     USER_PROMPT_GENERATE_QUESTION,
     USER_PROMPT_GENERATE_ANSWER,
 )
+from utils import create_chat_completion
 
 
 class RetrieveReformulateRetrieveReadApproach(Approach):
     KEY = "rrrr"
 
-    def run(self, q: str, overrides: dict) -> any:
+    async def run(self, q: str, overrides: dict, ctx: RequestContext) -> any:
         start_time = time.time()
         temperature = overrides.get('temperature', 0.6)
+        max_tokens = 1024
+        compression_max_tokens = overrides.get("compression_max_tokens", CONTEXT_COMPRESSION_MAX_TOKENS)
 
-        monitoring_time_items = []
         monitoring_cost_items = []
         monitoring_usage = []
-        thoughts = []
+        context_items = []
 
         print(f"[DEBUG] openai_deployment={self.openai_deployment}")
         print(f"[DEBUG] {temperature=}")
 
-        # Step 1: Retrieve contents based on the input question
-        self.item_suffix = f" ({AnalysisPanelLabel.QUESTION_REFORMULATION})"
-        _, content, monitoring = self.retrieve(q, overrides)
-        monitoring_time_items += monitoring["time"]
-        self.item_suffix = ""
+        def create_question_message(question_retrieval: tuple) -> list:
+            _, chunks = question_retrieval
+            return self.pack_messages(
+                ctx, AnalysisPanelLabel.QUESTION_REFORMULATION,
+                lambda content: [
+                    {
+                        "role": "user",
+                        "content": USER_PROMPT_GENERATE_QUESTION.format(content=content, question=q),
+                    },
+                ],
+                chunks, max_tokens, context_items, q, compression_max_tokens,
+            )
 
-        # Step 2: Generate/reformulate question based on the input question
-        message = [
-            {"role": "user", "content": USER_PROMPT_GENERATE_QUESTION.format(content=content, question=q)},
-        ]
-        start_time_question = time.time()
-        completion = openai.ChatCompletion.create(
-            engine=self.openai_deployment,
-            messages=message,
-            temperature=temperature,
-            max_tokens=1024,
-            n=1,
-            stop=["\n"]
-        )
-        reformulated_question = self.clean_text(completion.choices[0].message.content)
-        monitoring_time_items.append(self.create_time_item(AnalysisPanelLabel.QUESTION_REFORMULATION, start_time_question))
-        monitoring_cost_items.append(self.create_cost_item(AnalysisPanelLabel.QUESTION_REFORMULATION, completion["usage"]))
-        monitoring_usage.append(self.create_usage_item(AnalysisPanelLabel.QUESTION_REFORMULATION, completion["usage"]))
-        thoughts = [
-            self.create_thought_item(AnalysisPanelLabel.QUESTION_REFORMULATION_PROMPT, message),
-            self.create_thought_item(AnalysisPanelLabel.REFORMULATED_QUESTION, reformulated_question)
-        ]
-        print(f"[DEBUG] {reformulated_question=}")
+        def create_answer_message(reformulated_question: str, retrieval: tuple) -> list:
+            _, chunks = retrieval
+            return self.pack_messages(
+                ctx, AnalysisPanelLabel.ANSWER_GENERATION,
+                lambda source: [
+                    {"role": "system", "content": SYSTEM_PROMPT_GENERATE_ANSWER},
+                    {
+                        "role": "user",
+                        "content": USER_PROMPT_GENERATE_ANSWER.format(
+                            source=source,
+                            question=reformulated_question
+                        )
+                    },
+                ],
+                chunks, max_tokens, context_items, reformulated_question, compression_max_tokens,
+            )
 
-        # Step 3: Retrieve contents based on the reformulated question
-        self.item_suffix = f" ({AnalysisPanelLabel.ANSWER_GENERATION})"
-        data_points, retrieved, monitoring = self.retrieve(reformulated_question, overrides)
-        monitoring_time_items += monitoring["time"]
-        self.item_suffix = ""
+        graph = StepGraph([
+            # Step 1: Retrieve contents based on the input question
+            *self.create_retrieval_steps(
+                "question_retrieval", overrides,
+                ctx.nested(item_suffix=f" ({AnalysisPanelLabel.QUESTION_REFORMULATION})"),
+                question=q, gate=True,
+            ),
+            # Step 2: Generate/reformulate question based on the input question
+            Step("question_message", create_question_message, after=("question_retrieval",)),
+            Step(
+                "question",
+                lambda question_message: create_chat_completion(
+                    engine=self.openai_deployment,
+                    messages=question_message,
+                    temperature=temperature,
+                    max_tokens=max_tokens,
+                    n=1,
+                    stop=["\n"]
+                ),
+                after=("question_message",),
+                label=AnalysisPanelLabel.QUESTION_REFORMULATION,
+            ),
+            Step(
+                "reformulated_question",
+                lambda question: self.clean_text(question.choices[0].message.content),
+                after=("question",),
+            ),
+            # Step 3: Retrieve contents based on the reformulated question
+            *self.create_retrieval_steps(
+                "retrieval", overrides,
+                ctx.nested(item_suffix=f" ({AnalysisPanelLabel.ANSWER_GENERATION})"),
+                after="reformulated_question", emit=True,
+            ),
+            # Step 4: Generate answer based on the reformulated question
+            Step("answer_message", create_answer_message, after=("reformulated_question", "retrieval")),
+            Step(
+                "answer",
+                lambda answer_message: self.create_answer_completion(
+                    ctx,
+                    engine=self.openai_deployment,
+                    messages=answer_message,
+                    temperature=temperature,
+                    max_tokens=max_tokens,
+                    n=1,
+                ),
+                after=("answer_message",),
+                label=AnalysisPanelLabel.ANSWER_GENERATION,
+            ),
+        ])
+        try:
+            results, monitoring_time_items = await graph.run(self, ctx)
+        except RetrievalGated as gated:
+            return await self.create_gated_response(q, ctx, gated, start_time)
+        data_points, _ = results["retrieval"]
+        reformulated_question = results["reformulated_question"]
+        # The gate applies to the contents retrieved for the question of the user
+        gate = self.gate_retrieval(results["question_retrieval"][0], overrides)
+        print(f"[DEBUG] {reformulated_question=}")
 
-        # Step 4: Generate answer based on the reformulated question
-        start_time_answer = time.time()
-        message = [
-            {"role": "system", "content": SYSTEM_PROMPT_GENERATE_ANSWER},
-            {
-                "role": "user",
-                "content": USER_PROMPT_GENERATE_ANSWER.format(
-                    source=retrieved,
-                    question=reformulated_question
-                )
-            },
+        for label, message, completion in [
+            (AnalysisPanelLabel.QUESTION_REFORMULATION, results["question_message"], results["question"]),
+            (AnalysisPanelLabel.ANSWER_GENERATION, results["answer_message"], results["answer"]),
+        ]:
+            monitoring_cost_items.append(self.create_cost_item(ctx, label, completion["usage"]))
+            monitoring_usage.append(self.create_usage_item(ctx, label, completion["usage"]))
+        thoughts = [
+            *self.create_gate_thoughts(ctx, gate),
+            *self.create_compression_thoughts(ctx, context_items),
+            self.create_thought_item(
+                ctx, AnalysisPanelLabel.QUESTION_REFORMULATION_PROMPT, results["question_message"]
+            ),
+            self.create_thought_item(ctx, AnalysisPanelLabel.REFORMULATED_QUESTION, reformulated_question),
+            self.create_thought_item(
+                ctx, AnalysisPanelLabel.ANSWER_GENERATION_PROMPT, results["answer_message"]
+            ),
         ]
-        completion = openai.ChatCompletion.create(
-            engine=self.openai_deployment,
-            messages=message,
-            temperature=temperature,
-            max_tokens=1024,
-            n=1,
-        )
-        monitoring_time_items.append(self.create_time_item(AnalysisPanelLabel.ANSWER_GENERATION, start_time_answer))
-        monitoring_cost_items.append(self.create_cost_item(AnalysisPanelLabel.ANSWER_GENERATION, completion["usage"]))
-        monitoring_usage.append(self.create_usage_item(AnalysisPanelLabel.ANSWER_GENERATION, completion["usage"]))
-        thoughts.append(self.create_thought_item(AnalysisPanelLabel.ANSWER_GENERATION_PROMPT, message))
-    
+
         return self.create_response(
             data_points=data_points,
-            answer=self.clean_text(completion.choices[0].message.content),
+            answer=self.clean_text(results["answer"].choices[0].message.content),
             thoughts=thoughts,
             start_time=start_time,
             monitoring_time_items=monitoring_time_items,
             monitoring_cost_items=monitoring_cost_items,
             usage=monitoring_usage,
+            gate=gate,
+            context=context_items,
         )
@@ -0,0 +1,129 @@
+"""Execution of approach steps as a dependency graph.
+
+An approach declares its steps and the steps each one depends on. Every step starts as
+soon as its dependencies are done, so independent steps (e.g. detecting the question
+language while the question is embedded and searched) run concurrently and the time of
+a request approaches its critical path. Steps that block run in the default thread pool.
+A step may raise StopRun to skip all remaining steps, e.g. when there is nothing to answer.
+"""
+import asyncio
+import dataclasses
+import inspect
+import time
+from typing import TYPE_CHECKING, Callable, Iterable, Optional
+
+from tracing import span
+
+if TYPE_CHECKING:
+    from approaches.approach import Approach, RequestContext
+
+
+@dataclasses.dataclass
+class Step:
+    """Step of an approach.
+
+    `func` is called with the results of the steps in `after` as keyword arguments and
+    may return a value or an awaitable. If `when` is given, it is called with the same
+    arguments and the step is skipped (its result is None) unless it returns true.
+    Steps with a `label` report their time in monitoring.time, labelled within `ctx`.
+    """
+
+    name: str
+    func: Callable
+    after: tuple = ()
+    label: Optional[str] = None
+    ctx: Optional["RequestContext"] = None
+    when: Optional[Callable[..., bool]] = None
+    blocking: bool = False
+
+
+class StopRun(Exception):
+    """Raised by a step to end the run early, skipping the steps that are not done yet.
+
+    StepGraph.run re-raises it with the time items of the labelled steps done so far,
+    including the step that raised it.
+    """
+
+    def __init__(self):
+        """Initialize class."""
+        super().__init__()
+        self.time_items = []
+
+
+class StepGraph:
+    """Steps of one request, run concurrently in dependency order."""
+
+    def __init__(self, steps: Iterable[Step]):
+        """Initialize class."""
+        self.steps = {}
+        for step in steps:
+            if step.name in self.steps:
+                raise ValueError(f"Duplicate step '{step.name}'")
+            self.steps[step.name] = step
+        self.order = self.sort()
+
+    def sort(self) -> list:
+        """Return the steps in dependency order, rejecting unknown dependencies and cycles."""
+        order = []
+        state = {}  # "visiting" or "done" by step name
+
+        def visit(name: str, path: tuple) -> None:
+            if state.get(name) == "done":
+                return
+            if state.get(name) == "visiting":
+                raise ValueError(f"Steps depend on each other: {' -> '.join(path + (name,))}")
+            if name not in self.steps:
+                raise ValueError(f"Step '{path[-1]}' depends on unknown step '{name}'")
+            state[name] = "visiting"
+            for dependency in self.steps[name].after:
+                visit(dependency, path + (name,))
+            state[name] = "done"
+            order.append(self.steps[name])
+
+        for name in self.steps:
+            visit(name, ())
+        return order
+
+    async def run(self, approach: "Approach", ctx: "RequestContext") -> tuple:
+        """Run all steps, returning their results by name and the time items of labelled steps."""
+        tasks = {}
+        time_items = []
+
+        def add_time_item(step: Step, start_time: float) -> None:
+            if step.label:
+                time_items.append(approach.create_time_item(step.ctx or ctx, step.label, start_time))
+
+        async def run_step(step: Step):
+            kwargs = {dependency: await tasks[dependency] for dependency in step.after}
+            if step.when is not None and not step.when(**kwargs):
+                return None
+            start_time = time.time()
+            try:
+                with span("step", step=step.name):
+                    if step.blocking:
+                        result = await asyncio.to_thread(step.func, **kwargs)
+                    else:
+                        result = step.func(**kwargs)
+                        if inspect.isawaitable(result):
+                            result = await result
+            except StopRun:
+                # The step did its work before ending the run, so its time is reported too
+                add_time_item(step, start_time)
+                raise
+            add_time_item(step, start_time)
+            return result
+
+        # Dependencies come first, so every step finds the tasks it waits for
+        for step in self.order:
+            tasks[step.name] = asyncio.ensure_future(run_step(step))
+        try:
+            await asyncio.gather(*tasks.values())
+        except BaseException as e:
+            # A step failed or stopped the run, or the request was cancelled: stop the other steps
+            for task in tasks.values():
+                task.cancel()
+            await asyncio.gather(*tasks.values(), return_exceptions=True)
+            if isinstance(e, StopRun):
+                e.time_items = time_items
+            raise
+        return {name: task.result() for name, task in tasks.items()}, time_items
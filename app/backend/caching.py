@@ -0,0 +1,455 @@
+"""Caches of /ask responses and of search results.
+
+`AnswerCache` matches questions exactly after normalization. `SemanticCache`, which
+is off unless SEMANTIC_CACHE=on, also matches paraphrases by the cosine similarity of
+their embeddings; a lower threshold also matches translations such as
+「介護休業は何日取れますか」 and "How many days of family care leave can I take?".
+Questions with different numbers (e.g. days, years or dates) never match, as their
+embeddings are close but their answers differ. `RetrievalCache` holds the results of ACS searches, so
+that a repeated search skips both the embedding of the question and the ACS request.
+
+Cached entries become stale when `prepdocs.py` repopulates the search index. It
+writes a marker file (INDEX_VERSION_FILE) with a new version after every indexing
+run, and caches drop their entries as soon as they see the version change.
+"""
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from datetime import datetime
+from pathlib import Path
+from typing import Optional, Tuple
+
+import numpy as np
+from constants import AnalysisPanelLabel
+from rich import print
+
+INDEX_VERSION_FILE = os.environ.get("INDEX_VERSION_FILE") or str(
+    Path(__file__).resolve().parents[2].joinpath("output", "index_version.json")
+)
+INDEX_VERSION_CHECK_INTERVAL_IN_SEC = 10
+
+ANSWER_CACHE_BACKEND = os.environ.get("ANSWER_CACHE") or "memory"  # "memory", "sqlite" or "off"
+ANSWER_CACHE_PATH = os.environ.get("ANSWER_CACHE_PATH") or "answer_cache.sqlite3"
+ANSWER_CACHE_TTL_IN_SEC = float(os.environ.get("ANSWER_CACHE_TTL_IN_SEC") or 6 * 60 * 60)
+ANSWER_CACHE_MAX_SIZE = int(os.environ.get("ANSWER_CACHE_MAX_SIZE") or 1000)
+
+SEMANTIC_CACHE_ENABLED = (os.environ.get("SEMANTIC_CACHE") or "off") == "on"
+SEMANTIC_CACHE_TTL_IN_SEC = float(os.environ.get("SEMANTIC_CACHE_TTL_IN_SEC") or ANSWER_CACHE_TTL_IN_SEC)
+SEMANTIC_CACHE_MAX_SIZE = int(os.environ.get("SEMANTIC_CACHE_MAX_SIZE") or 1000)
+# Minimum cosine similarity of a paraphrase, optionally per approach as JSON, e.g. '{"rrrt": 0.97}'
+SEMANTIC_CACHE_THRESHOLD = float(os.environ.get("SEMANTIC_CACHE_THRESHOLD") or 0.95)
+SEMANTIC_CACHE_THRESHOLDS = json.loads(os.environ.get("SEMANTIC_CACHE_THRESHOLDS") or "{}")
+
+RETRIEVAL_CACHE_BACKEND = os.environ.get("RETRIEVAL_CACHE") or "memory"  # "memory", "sqlite" or "off"
+RETRIEVAL_CACHE_PATH = os.environ.get("RETRIEVAL_CACHE_PATH") or "retrieval_cache.sqlite3"
+# Search results only change when the index is repopulated, which drops them anyway
+RETRIEVAL_CACHE_TTL_IN_SEC = float(os.environ.get("RETRIEVAL_CACHE_TTL_IN_SEC") or 24 * 60 * 60)
+RETRIEVAL_CACHE_MAX_SIZE = int(os.environ.get("RETRIEVAL_CACHE_MAX_SIZE") or 1000)
+
+# Overrides that change the answer
+CACHE_KEY_OVERRIDES = [
+    "top", "search_option", "semantic_captions", "exclude_category", "temperature", "score_threshold",
+    "compression_max_tokens",
+]
+
+
+def normalize_question(question: str) -> str:
+    """Normalize a question so that trivially different spellings share a cache entry.
+
+    NFKC folds full-width alphanumerics and half-width katakana, whitespace runs are
+    collapsed and Latin letters are case-folded.
+    """
+    question = unicodedata.normalize("NFKC", question)
+    question = re.sub(r"\s+", " ", question).strip()
+    return question.casefold()
+
+
+def extract_numbers(question: str) -> str:
+    """Extract the numbers of a question, in Arabic or kanji numerals, as a comparable key."""
+    return ",".join(re.findall(r"[0-9]+|[〇一二三四五六七八九十百千万]+", normalize_question(question)))
+
+
+def create_settings_key(approach: str, deployment: str, overrides: dict) -> str:
+    """Create a key of the settings that change an answer."""
+    settings = {
+        "approach": approach,
+        "deployment": deployment,
+        "overrides": {name: overrides.get(name) for name in CACHE_KEY_OVERRIDES},
+    }
+    return json.dumps(settings, sort_keys=True, ensure_ascii=False)
+
+
+def create_cache_key(question: str, approach: str, deployment: str, overrides: dict) -> str:
+    """Create a cache key of a question and the settings that change its answer."""
+    key = normalize_question(question) + "\n" + create_settings_key(approach, deployment, overrides)
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+class IndexVersion:
+    """Version of the search index, read from the marker file written by prepdocs.py."""
+
+    def __init__(
+        self,
+        path: str = INDEX_VERSION_FILE,
+        check_interval_in_sec: float = INDEX_VERSION_CHECK_INTERVAL_IN_SEC,
+    ):
+        """Initialize class."""
+        self.path = path
+        self.check_interval_in_sec = check_interval_in_sec
+        self.checked_at = 0.0
+        self.mtime = None
+        self.version = ""
+
+    def current(self) -> str:
+        """Return the current version, re-reading the marker file at most every few seconds."""
+        now = time.time()
+        if now - self.checked_at < self.check_interval_in_sec:
+            return self.version
+        self.checked_at = now
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except FileNotFoundError:
+            return self.version
+        if mtime != self.mtime:
+            self.mtime = mtime
+            try:
+                with open(self.path, mode="r") as fin:
+                    self.version = str(json.load(fin)["version"])
+            except (OSError, ValueError, KeyError) as e:
+                print(f"[WARNING] Failed to read index version from '{self.path}': {e}")
+        return self.version
+
+
+def write_index_version(index_name: str, path: str = INDEX_VERSION_FILE) -> str:
+    """Record a new version of the index, invalidating the caches of running backends."""
+    version = datetime.now().strftime("%Y%m%d_%H%M%S_%f")
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Replace atomically so that backends never read a partial file
+    with open(f"{path}.tmp", mode="w") as fout:
+        json.dump({"index_name": index_name, "version": version}, fout)
+    os.replace(f"{path}.tmp", path)
+    return version
+
+
+class MemoryStore:
+    """In-process LRU store with TTL."""
+
+    def __init__(self, ttl_in_sec: float, max_size: int):
+        """Initialize class."""
+        self.ttl_in_sec = ttl_in_sec
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[str]:
+        """Return the value of a live entry."""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            value, created_at = entry
+            if time.time() - created_at > self.ttl_in_sec:
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: str) -> None:
+        """Store a value, evicting the least recently used entries beyond max_size."""
+        with self.lock:
+            self.entries[key] = (value, time.time())
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def clear(self, keep_prefix: str = "") -> None:
+        """Drop all entries except those whose key starts with keep_prefix."""
+        with self.lock:
+            for key in [key for key in self.entries if not (keep_prefix and key.startswith(keep_prefix))]:
+                del self.entries[key]
+
+
+class SqliteStore:
+    """LRU store with TTL in a local SQLite file, shared by all workers on the host."""
+
+    def __init__(self, path: str, ttl_in_sec: float, max_size: int):
+        """Initialize class."""
+        self.ttl_in_sec = ttl_in_sec
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=5, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT NOT NULL, "
+            "created_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+        )
+
+    def get(self, key: str) -> Optional[str]:
+        """Return the value of a live entry."""
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT value FROM cache WHERE key = ? AND created_at > ?", (key, now - self.ttl_in_sec)
+            ).fetchone()
+            if row is None:
+                return None
+            self.conn.execute("UPDATE cache SET accessed_at = ? WHERE key = ?", (now, key))
+            return row[0]
+
+    def set(self, key: str, value: str) -> None:
+        """Store a value, evicting expired and least recently used entries beyond max_size."""
+        now = time.time()
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?)", (key, value, now, now)
+            )
+            self.conn.execute("DELETE FROM cache WHERE created_at <= ?", (now - self.ttl_in_sec,))
+            self.conn.execute(
+                "DELETE FROM cache WHERE key IN "
+                "(SELECT key FROM cache ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_size,),
+            )
+
+    def clear(self, keep_prefix: str = "") -> None:
+        """Drop all entries except those whose key starts with keep_prefix."""
+        with self.lock:
+            if keep_prefix:
+                # Other workers may have cached entries of the new version already
+                self.conn.execute(
+                    "DELETE FROM cache WHERE substr(key, 1, ?) != ?", (len(keep_prefix), keep_prefix)
+                )
+            else:
+                self.conn.execute("DELETE FROM cache")
+
+
+def create_store(backend: str, path: str, ttl_in_sec: float, max_size: int):
+    """Create a cache store, or None if caching is off."""
+    if backend == "memory":
+        return MemoryStore(ttl_in_sec, max_size)
+    if backend == "sqlite":
+        return SqliteStore(path, ttl_in_sec, max_size)
+    if backend == "off":
+        return None
+    raise ValueError(f"Unknown cache backend '{backend}'")
+
+
+class VersionedCache:
+    """Cache of JSON-serializable values that is cleared whenever the index version changes."""
+
+    def __init__(self, store, index_version: IndexVersion):
+        """Initialize class."""
+        self.store = store
+        self.index_version = index_version
+        self.version = None
+
+    def check_version(self) -> str:
+        """Drop all entries if the index has been repopulated since the last lookup."""
+        version = self.index_version.current()
+        if version != self.version:
+            if self.version is not None:
+                print(f"[DEBUG] Index version changed to '{version}', clearing cache")
+                self.store.clear(keep_prefix=f"{version}:")
+            self.version = version
+        return version
+
+    def get(self, key: str) -> Optional[dict]:
+        """Return a cached value."""
+        version = self.check_version()
+        value = self.store.get(f"{version}:{key}")
+        return json.loads(value) if value is not None else None
+
+    def set(self, key: str, value: dict) -> None:
+        """Cache a value."""
+        version = self.check_version()
+        self.store.set(f"{version}:{key}", json.dumps(value, ensure_ascii=False))
+
+
+class AnswerCache(VersionedCache):
+    """Exact-match cache of /ask responses."""
+
+    def get_response(self, key: str, start_time: float) -> Optional[dict]:
+        """Return a cached response marked as served from cache, or None."""
+        entry = self.get(key)
+        if entry is None:
+            return None
+        cache_info = {"type": "exact", "age": round(time.time() - entry["cached_at"])}
+        return mark_cache_hit(entry["response"], start_time, cache_info)
+
+    def set_response(self, key: str, response: dict) -> None:
+        """Cache a response."""
+        self.set(key, {"response": response, "cached_at": time.time()})
+
+
+class RetrievalCache(VersionedCache):
+    """Exact-match cache of ACS search results (data points and source contents)."""
+
+    def get_results(self, key: str) -> Optional[Tuple[list, list]]:
+        """Return the cached data points and contents of a search, or None."""
+        entry = self.get(key)
+        if entry is None:
+            return None
+        return entry["data_points"], entry["contents"]
+
+    def set_results(self, key: str, data_points: list, contents: list) -> None:
+        """Cache the data points and contents of a search."""
+        self.set(key, {"data_points": data_points, "contents": contents})
+
+
+class SemanticCache:
+    """Answer cache that also matches paraphrases, by cosine similarity of question embeddings.
+
+    Normalized embeddings live in one preallocated matrix, so a lookup is a single
+    matrix-vector product. Only entries with the same settings key and the same numbers
+    in the question are candidates.
+    Entries expire after a TTL; when the table is full, the least recently used entry
+    is replaced.
+    """
+
+    def __init__(
+        self,
+        index_version: IndexVersion,
+        ttl_in_sec: float = SEMANTIC_CACHE_TTL_IN_SEC,
+        max_size: int = SEMANTIC_CACHE_MAX_SIZE,
+        threshold: float = SEMANTIC_CACHE_THRESHOLD,
+        thresholds: Optional[dict] = None,
+    ):
+        """Initialize class."""
+        self.index_version = index_version
+        self.ttl_in_sec = ttl_in_sec
+        self.max_size = max_size
+        self.threshold = threshold
+        self.thresholds = thresholds if thresholds is not None else SEMANTIC_CACHE_THRESHOLDS
+        self.version = None
+        self.lock = threading.Lock()
+
+        # Allocated on the first insert, when the embedding size is known
+        self.embeddings = None
+        self.settings_keys = np.empty(max_size, dtype=object)
+        self.numbers = np.empty(max_size, dtype=object)
+        self.questions = [None] * max_size
+        self.responses = [None] * max_size
+        self.created_at = np.full(max_size, -np.inf)
+        self.used_at = np.full(max_size, -np.inf)
+
+    def get_threshold(self, approach: str) -> float:
+        """Return the similarity threshold of an approach."""
+        return float(self.thresholds.get(approach, self.threshold))
+
+    def check_version(self) -> None:
+        """Drop all entries if the index has been repopulated since the last lookup."""
+        version = self.index_version.current()
+        if version != self.version:
+            if self.version is not None:
+                print(f"[DEBUG] Index version changed to '{version}', clearing semantic cache")
+                self.created_at[:] = -np.inf
+                self.used_at[:] = -np.inf
+            self.version = version
+
+    def get_response(
+        self, settings_key: str, approach: str, question: str, embedding: list, start_time: float
+    ) -> Tuple[Optional[dict], Optional[float]]:
+        """Return the response to the most similar cached question and its similarity.
+
+        The response is None if no cached question is similar enough.
+        """
+        now = time.time()
+        with self.lock:
+            self.check_version()
+            if self.embeddings is None:
+                return None, None
+            candidates = (
+                (self.settings_keys == settings_key)
+                & (self.numbers == extract_numbers(question))
+                & (self.created_at > now - self.ttl_in_sec)
+            )
+            if not candidates.any():
+                return None, None
+            similarities = np.where(candidates, self.embeddings @ normalize_vector(embedding), -np.inf)
+            i = int(np.argmax(similarities))
+            similarity = round(float(similarities[i]), 4)
+            if similarity < self.get_threshold(approach):
+                return None, similarity
+            self.used_at[i] = now
+            cached_question, cached_at = self.questions[i], self.created_at[i]
+            response = json.loads(self.responses[i])
+
+        cache_info = {
+            "type": "semantic",
+            "similarity": similarity,
+            "question": cached_question,
+            "age": round(now - cached_at),
+        }
+        return mark_cache_hit(response, start_time, cache_info), similarity
+
+    def set_response(self, settings_key: str, question: str, embedding: list, response: dict) -> None:
+        """Cache a response, replacing an expired or the least recently used entry."""
+        now = time.time()
+        vector = normalize_vector(embedding)
+        with self.lock:
+            self.check_version()
+            if self.embeddings is None:
+                self.embeddings = np.zeros((self.max_size, len(vector)), dtype=np.float32)
+            expired = self.created_at <= now - self.ttl_in_sec
+            i = int(np.argmax(expired)) if expired.any() else int(np.argmin(self.used_at))
+            self.embeddings[i] = vector
+            self.settings_keys[i] = settings_key
+            self.numbers[i] = extract_numbers(question)
+            self.questions[i] = question
+            self.responses[i] = json.dumps(response, ensure_ascii=False)
+            self.created_at[i] = now
+            self.used_at[i] = now
+
+
+def normalize_vector(embedding: list) -> np.ndarray:
+    """Scale an embedding to unit length, so that dot products are cosine similarities."""
+    vector = np.asarray(embedding, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm > 0 else vector
+
+
+def mark_cache_hit(response: dict, start_time: float, cache_info: dict) -> dict:
+    """Report a cached response in monitoring: lookup time only and zero cost."""
+    elapsed_time = round(time.time() - start_time, 2)
+    # The profile belongs to the request that ran the approach
+    response["monitoring"].pop("profile", None)
+    response["monitoring"] = {
+        **response["monitoring"],
+        "time": {
+            "total": elapsed_time,
+            "items": [{"label": AnalysisPanelLabel.ANSWER_CACHE, "value": elapsed_time}],
+        },
+        "cost": {"total": 0, "items": []},
+        "usage": [],
+        "cache": {"hit": True, **cache_info},
+    }
+    response["thoughts"] = [
+        {"label": AnalysisPanelLabel.ANSWER_CACHE, "value": AnalysisPanelLabel.ANSWER_CACHE_HIT}
+    ] + response["thoughts"]
+    return response
+
+
+def create_answer_cache(index_version: IndexVersion) -> Optional[AnswerCache]:
+    """Create the answer cache configured by the environment, or None if it is off."""
+    store = create_store(
+        ANSWER_CACHE_BACKEND, ANSWER_CACHE_PATH, ANSWER_CACHE_TTL_IN_SEC, ANSWER_CACHE_MAX_SIZE
+    )
+    return AnswerCache(store, index_version) if store is not None else None
+
+
+def create_semantic_cache(index_version: IndexVersion) -> Optional[SemanticCache]:
+    """Create the semantic cache configured by the environment, or None if it is off."""
+    return SemanticCache(index_version) if SEMANTIC_CACHE_ENABLED else None
+
+
+def create_retrieval_cache(index_version: IndexVersion) -> Optional[RetrievalCache]:
+    """Create the retrieval cache configured by the environment, or None if it is off."""
+    store = create_store(
+        RETRIEVAL_CACHE_BACKEND, RETRIEVAL_CACHE_PATH, RETRIEVAL_CACHE_TTL_IN_SEC, RETRIEVAL_CACHE_MAX_SIZE
+    )
+    return RetrievalCache(store, index_version) if store is not None else None
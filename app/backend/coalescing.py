@@ -0,0 +1,67 @@
+"""Single-flight coalescing of identical in-flight work.
+
+When many users ask the same question at once, only the first request runs the
+approach (and the first retrieval or embedding of a text calls ACS or Azure OpenAI);
+the others wait for that execution and share its result.
+"""
+import asyncio
+import weakref
+from typing import Awaitable, Callable, Hashable, Tuple
+
+# All single flights by name, for reporting
+FLIGHTS = {}
+
+
+class SingleFlight:
+    """Run a coroutine at most once per key at a time, sharing the result with concurrent callers.
+
+    The execution is cancelled only when every caller waiting for it has been cancelled,
+    e.g. when all clients asking the question went away.
+    """
+
+    def __init__(self, name: str):
+        """Initialize class."""
+        self.name = name
+        # In-flight tasks and their number of waiters by key, per event loop
+        self.flights = weakref.WeakKeyDictionary()
+        FLIGHTS[name] = self
+
+        self.num_calls = 0
+        self.num_coalesced = 0
+
+    async def do(self, key: Hashable, func: Callable[[], Awaitable]) -> Tuple[any, bool]:
+        """Return the result of `func()` and whether it was shared with an in-flight call."""
+        flights = self.flights.setdefault(asyncio.get_running_loop(), {})
+        self.num_calls += 1
+        flight = flights.get(key)
+        coalesced = flight is not None
+        if coalesced:
+            self.num_coalesced += 1
+        else:
+            task = asyncio.ensure_future(func())
+            flight = flights[key] = [task, 0]
+            task.add_done_callback(lambda _: flights.pop(key, None))
+
+        task = flight[0]
+        flight[1] += 1
+        try:
+            return await asyncio.shield(task), coalesced
+        except asyncio.CancelledError:
+            if not task.done() and flight[1] == 1:
+                task.cancel()
+            raise
+        finally:
+            flight[1] -= 1
+
+    def stats(self) -> dict:
+        """Return coalescing counters."""
+        return {
+            "calls": self.num_calls,
+            "coalesced": self.num_coalesced,
+            "in_flight": sum(len(flights) for flights in self.flights.values()),
+        }
+
+
+def coalescing_stats() -> dict:
+    """Return counters of all single flights."""
+    return {name: flight.stats() for name, flight in FLIGHTS.items()}
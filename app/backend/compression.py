@@ -0,0 +1,121 @@
+"""Extractive compression of the retrieved contents before they are packed into a prompt.
+
+The sentences of the retrieved chunks are scored against the question with BM25 and only
+the highest-scoring ones are kept, up to a token budget, in their original order. Terms
+are words for Latin text and character bigrams for Japanese, which has no spaces between
+words, so the scoring needs neither a tokenizer model nor a network call.
+
+Compression is off unless CONTEXT_COMPRESSION_MAX_TOKENS (or the override
+`compression_max_tokens`) sets the budget.
+"""
+import dataclasses
+import math
+import os
+import re
+import unicodedata
+from collections import Counter
+from typing import List, Tuple
+
+from packing import SENTENCE, Chunk, count_tokens
+
+CONTEXT_COMPRESSION_MAX_TOKENS = (
+    int(os.environ["CONTEXT_COMPRESSION_MAX_TOKENS"])
+    if os.environ.get("CONTEXT_COMPRESSION_MAX_TOKENS")
+    else None
+)
+# BM25 parameters
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+BULLET = "- "
+# Runs of Latin letters or digits, and runs of kana and kanji
+LATIN_TERMS = re.compile(r"[a-z0-9]+")
+JA_RUNS = re.compile(r"[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff]+")
+
+
+@dataclasses.dataclass
+class Compression:
+    """Result of the compression of the retrieved contents."""
+
+    num_tokens_before: int
+    num_tokens_after: int
+    num_sentences: int
+    num_kept_sentences: int
+
+
+def extract_terms(text: str) -> List[str]:
+    """Extract the terms of a text: Latin words and Japanese character bigrams."""
+    text = unicodedata.normalize("NFKC", text).lower()
+    terms = LATIN_TERMS.findall(text)
+    for run in JA_RUNS.findall(text):
+        terms += [run] if len(run) == 1 else [run[i:i + 2] for i in range(len(run) - 1)]
+    return terms
+
+
+def score_sentences(question: str, sentences: List[str]) -> List[float]:
+    """Score sentences against the question with BM25, the sentences being the corpus."""
+    query = set(extract_terms(question))
+    documents = [Counter(extract_terms(sentence)) for sentence in sentences]
+    lengths = [sum(document.values()) for document in documents]
+    average_length = sum(lengths) / len(lengths) or 1
+    frequencies = Counter(term for document in documents for term in document if term in query)
+
+    scores = []
+    for document, length in zip(documents, lengths):
+        score = 0.0
+        for term in query:
+            tf = document.get(term, 0)
+            if not tf:
+                continue
+            idf = math.log(1 + (len(documents) - frequencies[term] + 0.5) / (frequencies[term] + 0.5))
+            norm = 1 - BM25_B + BM25_B * length / average_length
+            score += idf * tf * (BM25_K1 + 1) / (tf + BM25_K1 * norm)
+        scores.append(score)
+    return scores
+
+
+def compress_chunks(question: str, chunks: List[Chunk], max_tokens: int) -> Tuple[List[Chunk], Compression]:
+    """Keep the sentences of the chunks most relevant to the question, up to max_tokens.
+
+    The chunks are kept as they are if they already fit or if no sentence shares a term
+    with the question, e.g. an English question on Japanese contents, which is left for
+    the model to read.
+    """
+    # (chunk index, sentence, tokens) in the order of the contents
+    sentences = []
+    for index, chunk in enumerate(chunks):
+        text = chunk.text[len(BULLET):] if chunk.text.startswith(BULLET) else chunk.text
+        sentences += [(index, sentence, count_tokens(sentence)) for sentence in SENTENCE.findall(text)]
+    num_tokens_before = sum(num_tokens for _, _, num_tokens in sentences)
+    uncompressed = Compression(num_tokens_before, num_tokens_before, len(sentences), len(sentences))
+    if num_tokens_before <= max_tokens:
+        return chunks, uncompressed
+    scores = score_sentences(question, [sentence for _, sentence, _ in sentences])
+    if not any(scores):
+        return chunks, uncompressed
+
+    # Greedily keep the best sentences that still fit; ties (e.g. sentences unrelated to the
+    # question) are kept in the order of the contents, i.e. of the search ranking
+    kept = set()
+    num_tokens = 0
+    for position in sorted(range(len(sentences)), key=lambda position: -scores[position]):
+        if num_tokens + sentences[position][2] <= max_tokens:
+            kept.add(position)
+            num_tokens += sentences[position][2]
+
+    compressed = []
+    for index, chunk in enumerate(chunks):
+        kept_sentences = [
+            sentences[position] for position in sorted(kept) if sentences[position][0] == index
+        ]
+        if kept_sentences:
+            compressed.append(Chunk(
+                BULLET + "".join(sentence for _, sentence, _ in kept_sentences).strip(),
+                sum(num_sentence_tokens for _, _, num_sentence_tokens in kept_sentences),
+            ))
+    return compressed, Compression(
+        num_tokens_before=num_tokens_before,
+        num_tokens_after=num_tokens,
+        num_sentences=len(sentences),
+        num_kept_sentences=len(kept),
+    )
@@ -22,6 +22,19 @@ OPENAI_PRICING_PER_TOKEN = {
     }
 }
 
+# Context windows (prompt + completion) in tokens
+OPENAI_CONTEXT_LENGTH = {
+    OPENAI_DEPLOYMENT_GPT_35_TURBO: 4096,
+    OPENAI_DEPLOYMENT_GPT_4: 8192,
+}
+
+# Azure OpenAI quotas per minute (default deployment quotas, overridable by OPENAI_QUOTAS)
+OPENAI_QUOTA_PER_MINUTE = {
+    OPENAI_DEPLOYMENT_GPT_35_TURBO: {"tokens": 120_000, "requests": 720},
+    OPENAI_DEPLOYMENT_GPT_4: {"tokens": 20_000, "requests": 120},
+    OPENAI_DEPLOYMENT_TEXT_EMBEDDING_ADA_002: {"tokens": 120_000, "requests": 720},
+}
+
 
 # Azure Cognitive Search - Search options
 class SearchOption(IntEnum):
@@ -34,6 +47,18 @@ class SearchOption(IntEnum):
     VectorSemantic = 4
 
 
+# Minimum `@search.score` of the top document for a question to be answered, by search option
+# (overridable by RETRIEVAL_SCORE_THRESHOLDS). The scales differ by option, so calibrate each one
+# with the `score_threshold` reported by scripts/evaluate_acs.py; None answers every question.
+RETRIEVAL_SCORE_THRESHOLD = {
+    SearchOption.BM25: None,
+    SearchOption.Semantic: None,
+    SearchOption.Vector: None,
+    SearchOption.VectorBM25: None,
+    SearchOption.VectorSemantic: None,
+}
+
+
 # Prompt templates
 SYSTEM_PROMPT_ENG_ENG = """
 You are an AI assistant. Please output your answer in English based only on the information 
@@ -85,6 +110,13 @@ USER_PROMPT_CONFIRMING_ANSWER_JP = """
 """
 
 
+# Answers given without calling OpenAI when no retrieved content is relevant enough, by language
+INSUFFICIENT_INFORMATION_ANSWER = {
+    "en": "I don't know. No information relevant to your question was found.",
+    "ja": "わかりません。ご質問に関連する情報が見つかりませんでした。",
+}
+
+
 SELF_SERVED_MODELS_URL = "http://40.81.203.154:6000/embed/"
 
 
@@ -94,6 +126,7 @@ class AnalysisPanelLabel(str, Enum):
     ANSWER_CONFIRMATION_RESULT = "回答の確認結果"
     ANSWER_GENERATION = "回答の作成"
     ANSWER_GENERATION_PROMPT = "回答作成用のプロンプト"
+    CONTEXT_COMPRESSION = "コンテキストの圧縮"
     RETRIEVAL = "コンテントの検索"
     VECTORIZATION = "ベクトル化"
     TOKEN_COMPLETION = "完了トークン"
@@ -116,6 +149,21 @@ class AnalysisPanelLabel(str, Enum):
     ANSWER_FROM_APPROACH_1 = "Approach 1 の回答"
     DO_NOT_PROCEEDS_WITH_APPROACH_2 = "Approach 1 で十分な回答が得られたため、ここで終了する。"
     PROCEEDS_WITH_APPROACH_2 = "Approach 1 で十分な回答が得られなかったため、Approach 2 へ切り替える。"
+    ANSWER_ABORTED = "回答作成の打ち切り"
+    ANSWER_ABORTED_REFUSAL = "回答が「わかりません」で始まったため、回答の作成を打ち切った。"
+    HEDGED_APPROACH_2 = "Approach 2 の先行実行"
+    HEDGED_APPROACH_2_CANCELLED = (
+        "Approach 1 で十分な回答が得られたため、先行実行した Approach 2 をキャンセルした。"
+    )
+
+    # Retrieval score gate
+    RETRIEVAL_GATE = "検索スコアによる判定"
+    RETRIEVAL_GATE_PASSED = "関連する情報が見つかったため、回答を作成する。"
+    RETRIEVAL_GATE_BLOCKED = "関連する情報が見つからなかったため、回答を作成せずに終了する。"
+
+    # Caches
+    ANSWER_CACHE = "回答キャッシュ"
+    ANSWER_CACHE_HIT = "同じ質問への回答をキャッシュから返却した。"
 
 
 # ACS Index options
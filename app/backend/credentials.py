@@ -0,0 +1,82 @@
+"""Background refresh of Azure AD tokens.
+
+Shared by the backend and `scripts/prepdocs.py`, so this module must not import
+anything from the backend.
+"""
+import threading
+import time
+from typing import Callable, Optional
+
+from rich import print
+
+COGNITIVE_SERVICES_SCOPE = "https://cognitiveservices.azure.com/.default"
+
+
+class TokenRefresher:
+    """Keep an Azure AD token fresh from a daemon thread.
+
+    The token is renewed `refresh_margin_in_sec` before it expires and swapped in with a
+    single assignment, so readers only ever see a complete, valid token and never wait
+    for a round trip to Azure AD.
+    """
+
+    def __init__(
+        self,
+        credential,
+        scope: str = COGNITIVE_SERVICES_SCOPE,
+        on_refresh: Optional[Callable[[str], None]] = None,
+        refresh_margin_in_sec: float = 600,
+        retry_interval_in_sec: float = 30,
+    ):
+        """Initialize class and fetch the first token."""
+        self.credential = credential
+        self.scope = scope
+        self.on_refresh = on_refresh
+        self.refresh_margin_in_sec = refresh_margin_in_sec
+        self.retry_interval_in_sec = retry_interval_in_sec
+
+        self.access_token = None
+        self.wake_up = threading.Event()
+        self.stopped = False
+        self.thread = threading.Thread(target=self.run, name="token-refresher", daemon=True)
+        self.refresh()
+
+    @property
+    def token(self) -> str:
+        """Return the cached token."""
+        return self.access_token.token
+
+    def refresh(self) -> None:
+        """Fetch a new token and swap it in."""
+        access_token = self.credential.get_token(self.scope)
+        self.access_token = access_token
+        if self.on_refresh:
+            self.on_refresh(access_token.token)
+        expires_on = time.ctime(access_token.expires_on)
+        print(f"[DEBUG] Token for '{self.scope}' refreshed, expires on {expires_on}")
+
+    def start(self) -> "TokenRefresher":
+        """Start refreshing in the background."""
+        self.thread.start()
+        return self
+
+    def stop(self) -> None:
+        """Stop refreshing."""
+        self.stopped = True
+        self.wake_up.set()
+
+    def run(self) -> None:
+        """Refresh the token shortly before it expires, retrying on failure."""
+        while not self.stopped:
+            wait_time = self.access_token.expires_on - self.refresh_margin_in_sec - time.time()
+            if wait_time > 0 and self.wake_up.wait(wait_time):
+                self.wake_up.clear()
+                continue
+            if self.stopped:
+                return
+            try:
+                self.refresh()
+            except Exception as e:
+                print(f"[WARNING] Failed to refresh token for '{self.scope}': {e}")
+                self.wake_up.wait(self.retry_interval_in_sec)
+                self.wake_up.clear()
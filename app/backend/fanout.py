@@ -0,0 +1,101 @@
+"""Fan-out of searches to several ACS indexes, merged by reciprocal-rank fusion.
+
+With SEARCH_INDEXES naming more than one index (e.g. "SEARCH_PDF,SEARCH_HTML"), every
+search is sent to all of them concurrently and the ranked lists are merged with
+reciprocal-rank fusion (RRF): a document scores the sum of 1 / (RRF_K + rank) over the
+lists it is in, so documents ranked high by several indexes come first. An index that
+fails or does not answer within SEARCH_INDEX_TIMEOUT_IN_SEC is left out of the results,
+so a slow index delays a request by the timeout at most.
+
+Documents keep the `@search.score` of their index, which the retrieval score gate
+compares with the threshold of the search option.
+"""
+import asyncio
+import os
+from typing import List
+
+from azure.search.documents.aio import SearchClient
+from constants import ACSIndex
+from rich import print
+from tracing import span
+
+# Indexes searched by the approaches, by ACSIndex name
+SEARCH_INDEXES = [
+    ACSIndex[name.strip()] for name in (os.environ.get("SEARCH_INDEXES") or "SEARCH_ALL").split(",")
+]
+SEARCH_INDEX_TIMEOUT_IN_SEC = float(os.environ.get("SEARCH_INDEX_TIMEOUT_IN_SEC") or 5)
+# Rank offset of RRF, damping the weight of the top ranks
+RRF_K = 60
+
+
+class FusedResults:
+    """Search results merged from several indexes, iterated like those of SearchClient.search."""
+
+    def __init__(self, docs: list):
+        """Initialize class."""
+        self.docs = docs
+
+    async def __aiter__(self):
+        for doc in self.docs:
+            yield doc
+
+
+def fuse_rankings(rankings: List[list], top: int, k: int = RRF_K) -> list:
+    """Merge ranked lists of documents by reciprocal-rank fusion, keeping the top documents."""
+    scores = {}
+    docs = {}
+    for ranking in rankings:
+        for rank, doc in enumerate(ranking, start=1):
+            scores[doc["id"]] = scores.get(doc["id"], 0.0) + 1 / (k + rank)
+            docs.setdefault(doc["id"], doc)
+    # Ties keep the order of the indexes
+    return [docs[key] for key in sorted(scores, key=lambda key: -scores[key])[:top]]
+
+
+class FanOutSearchClient:
+    """Search client that searches several indexes concurrently and fuses their results."""
+
+    def __init__(
+        self, search_clients: List[SearchClient], timeout_in_sec: float = SEARCH_INDEX_TIMEOUT_IN_SEC
+    ):
+        """Initialize class."""
+        self.search_clients = search_clients
+        self.timeout_in_sec = timeout_in_sec
+        # Identifies the set of indexes in logs, traces and cache keys
+        self._index_name = "+".join(client._index_name for client in search_clients)
+
+    async def search_index(self, search_client: SearchClient, **payload) -> list:
+        """Search one index and read all of its results."""
+        with span("search_index", index=search_client._index_name) as s:
+            search_results = await search_client.search(**payload)
+            docs = [doc async for doc in search_results]
+            if s:
+                s.set(results=len(docs))
+            return docs
+
+    async def search(self, **payload) -> FusedResults:
+        """Search all indexes, leaving out those that fail or time out unless all of them do."""
+        rankings = await asyncio.gather(
+            *[
+                asyncio.wait_for(self.search_index(search_client, **payload), self.timeout_in_sec)
+                for search_client in self.search_clients
+            ],
+            return_exceptions=True,
+        )
+        errors = [ranking for ranking in rankings if isinstance(ranking, BaseException)]
+        for search_client, ranking in zip(self.search_clients, rankings):
+            index_name = search_client._index_name
+            if isinstance(ranking, asyncio.TimeoutError):
+                print(f"[WARNING] Search of '{index_name}' timed out after {self.timeout_in_sec}s")
+            elif isinstance(ranking, BaseException):
+                print(f"[WARNING] Search of '{index_name}' failed: {ranking!r}")
+        if len(errors) == len(rankings):
+            raise errors[0]
+        rankings = [ranking for ranking in rankings if not isinstance(ranking, BaseException)]
+        return FusedResults(fuse_rankings(rankings, payload.get("top") or 3))
+
+
+def create_search_client(search_clients: dict):
+    """Return the client searching SEARCH_INDEXES: the client of the index, or a fan-out to all of them."""
+    clients = [search_clients[index] for index in SEARCH_INDEXES]
+    return clients[0] if len(clients) == 1 else FanOutSearchClient(clients)
@@ -0,0 +1,192 @@
+"""Persistent ledger of answered requests.
+
+The monitoring block of every /ask and /ask/stream request (approach, deployment,
+search option, step timings, token usage, cost, cache status and whether `rrrt` fell
+back to Approach 2) is appended to a local SQLite database, so that capacity and
+default approaches can be sized from real traffic. Rows are written in batches from a
+background thread and never block a request; `scripts/report_ledger.py` reports rollups.
+"""
+import os
+import queue
+import sqlite3
+import threading
+import time
+from enum import Enum
+from pathlib import Path
+from typing import Optional
+
+from rich import print
+
+LEDGER = os.environ.get("LEDGER") or "sqlite"  # "sqlite" or "off"
+LEDGER_PATH = os.environ.get("LEDGER_PATH") or str(
+    Path(__file__).resolve().parents[2].joinpath("output", "ledger.sqlite3")
+)
+LEDGER_RETENTION_IN_DAYS = float(os.environ.get("LEDGER_RETENTION_IN_DAYS") or 90)
+LEDGER_BATCH_SIZE = 100
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS requests (
+    id INTEGER PRIMARY KEY,
+    created_at REAL NOT NULL,
+    approach TEXT,
+    deployment TEXT,
+    search_option TEXT,
+    status INTEGER NOT NULL,
+    time_total REAL,
+    cost_total REAL,
+    prompt_tokens INTEGER,
+    completion_tokens INTEGER,
+    cache TEXT,
+    similarity REAL,
+    coalesced INTEGER,
+    fallback INTEGER,
+    quota_wait REAL,
+    trace_id TEXT
+);
+CREATE INDEX IF NOT EXISTS requests_created_at ON requests (created_at);
+CREATE TABLE IF NOT EXISTS steps (
+    request_id INTEGER NOT NULL REFERENCES requests (id) ON DELETE CASCADE,
+    kind TEXT NOT NULL,
+    step TEXT NOT NULL,
+    value REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS steps_request_id ON steps (request_id);
+"""
+
+
+def get_label(item: dict) -> str:
+    """Return the label of a monitoring item, which may be an AnalysisPanelLabel."""
+    label = item["label"]
+    return label.value if isinstance(label, Enum) else label
+
+
+def create_entry(labels: dict, status: int, r: Optional[dict] = None) -> dict:
+    """Flatten a request and its monitoring block into a ledger entry."""
+    entry = {**labels, "created_at": time.time(), "status": status, "steps": []}
+    if r is None:
+        return entry
+
+    monitoring = r["monitoring"]
+    cache = monitoring.get("cache") or {}
+    usage = [item["value"] for item in monitoring["usage"]]
+    entry.update({
+        "time_total": monitoring["time"]["total"],
+        "cost_total": monitoring["cost"]["total"],
+        "prompt_tokens": sum(item.get("prompt_tokens", 0) for item in usage),
+        "completion_tokens": sum(item.get("completion_tokens", 0) for item in usage),
+        "cache": cache.get("type") if cache.get("hit") else None,
+        "similarity": cache.get("similarity"),
+        "coalesced": monitoring.get("coalesced"),
+        "fallback": monitoring.get("fallback"),
+        "quota_wait": (monitoring.get("admission") or {}).get("wait_time"),
+        "trace_id": monitoring.get("trace_id"),
+    })
+    entry["steps"] += [("time", get_label(item), item["value"]) for item in monitoring["time"]["items"]]
+    if entry["cache"] or entry["coalesced"]:
+        # The tokens were spent, and the fallback decided, by the request that ran the approach
+        entry.update({"cost_total": 0, "prompt_tokens": 0, "completion_tokens": 0, "fallback": None})
+        return entry
+    entry["steps"] += [("cost", get_label(item), item["value"]) for item in monitoring["cost"]["items"]]
+    for item in monitoring["usage"]:
+        for kind in ["prompt_tokens", "completion_tokens"]:
+            entry["steps"].append((kind, get_label(item), item["value"].get(kind, 0)))
+    return entry
+
+
+def connect(path: str = LEDGER_PATH) -> sqlite3.Connection:
+    """Open the ledger database, creating its tables if needed."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    connection = sqlite3.connect(path)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA foreign_keys=ON")
+    connection.executescript(SCHEMA)
+    return connection
+
+
+class RequestLedger:
+    """Append ledger entries to SQLite from a daemon thread, off the request path."""
+
+    COLUMNS = [
+        "created_at", "approach", "deployment", "search_option", "status", "time_total", "cost_total",
+        "prompt_tokens", "completion_tokens", "cache", "similarity", "coalesced", "fallback", "quota_wait",
+        "trace_id",
+    ]
+
+    def __init__(self, path: str):
+        """Initialize class."""
+        self.path = path
+        self.entries = queue.Queue(maxsize=10000)
+        self.thread = threading.Thread(target=self.run, name="request-ledger", daemon=True)
+        self.thread.start()
+
+    def submit(self, entry: dict) -> None:
+        """Queue an entry, dropping it if the writer falls behind."""
+        try:
+            self.entries.put_nowait(entry)
+        except queue.Full:
+            print("[WARNING] Request ledger queue is full, dropping an entry")
+
+    def run(self) -> None:
+        """Write queued entries in batches."""
+        connection = None
+        while True:
+            batch = [self.entries.get()]
+            while len(batch) < LEDGER_BATCH_SIZE and not self.entries.empty():
+                batch.append(self.entries.get_nowait())
+            try:
+                if connection is None:
+                    connection = connect(self.path)
+                    self.prune(connection)
+                self.write(connection, batch)
+            except Exception as e:
+                print(f"[WARNING] Failed to write {len(batch)} request ledger entries: {e}")
+
+    def write(self, connection: sqlite3.Connection, batch: list) -> None:
+        """Insert a batch of entries in one transaction."""
+        placeholders = ", ".join("?" * len(self.COLUMNS))
+        with connection:
+            for entry in batch:
+                cursor = connection.execute(
+                    f"INSERT INTO requests ({', '.join(self.COLUMNS)}) VALUES ({placeholders})",
+                    [entry.get(column) for column in self.COLUMNS],
+                )
+                connection.executemany(
+                    "INSERT INTO steps (request_id, kind, step, value) VALUES (?, ?, ?, ?)",
+                    [(cursor.lastrowid, *step) for step in entry["steps"]],
+                )
+
+    def prune(self, connection: sqlite3.Connection) -> None:
+        """Delete entries older than the retention period."""
+        with connection:
+            expires_at = time.time() - LEDGER_RETENTION_IN_DAYS * 86400
+            connection.execute("DELETE FROM requests WHERE created_at < ?", (expires_at,))
+
+
+# Started on the first record, so that importing this module (e.g. from scripts/report_ledger.py)
+# opens no connection and starts no thread
+LEDGER_WRITER = None
+LEDGER_WRITER_LOCK = threading.Lock()
+
+
+def get_ledger_writer() -> Optional[RequestLedger]:
+    """Return the ledger writer, starting it on first use, or None if the ledger is off."""
+    global LEDGER_WRITER
+    if LEDGER != "sqlite":
+        return None
+    if LEDGER_WRITER is None:
+        with LEDGER_WRITER_LOCK:
+            if LEDGER_WRITER is None:
+                LEDGER_WRITER = RequestLedger(LEDGER_PATH)
+    return LEDGER_WRITER
+
+
+def record_response(labels: dict, r: dict) -> None:
+    """Record an answered request."""
+    if (writer := get_ledger_writer()) is not None:
+        writer.submit(create_entry(labels, 200, r))
+
+
+def record_error(labels: dict, status: int) -> None:
+    """Record a failed request."""
+    if (writer := get_ledger_writer()) is not None:
+        writer.submit(create_entry(labels, status))
@@ -0,0 +1,118 @@
+"""Prometheus metrics of /ask, exposed on /metrics.
+
+Every response already reports its per-step timings, token usage and cost in
+`monitoring`; they are aggregated here into histograms and counters labelled by
+approach, deployment and search option, so that percentiles per pipeline step can be
+watched under production load. Connection pool, coalescing and admission counters are
+exported as gauges at scrape time.
+"""
+from enum import Enum
+
+from admission import admission_stats
+from coalescing import coalescing_stats
+from constants import SearchOption
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, Counter, Histogram, generate_latest
+from prometheus_client.core import GaugeMetricFamily
+from transport import pool_stats
+
+LABELS = ["approach", "deployment", "search_option"]
+DURATION_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2, 4, 8, 16, 32, 64)
+
+REQUESTS = Counter(
+    "hr_buddy_requests", "Questions by HTTP status and source of the answer", LABELS + ["status", "source"]
+)
+REQUEST_DURATION = Histogram(
+    "hr_buddy_request_duration_seconds", "Time to answer a question", LABELS, buckets=DURATION_BUCKETS
+)
+STEP_DURATION = Histogram(
+    "hr_buddy_step_duration_seconds", "Time of a pipeline step (monitoring.time.items)", LABELS + ["step"],
+    buckets=DURATION_BUCKETS,
+)
+TOKENS = Counter(
+    "hr_buddy_tokens", "Azure OpenAI tokens (monitoring.usage)", LABELS + ["step", "kind"]
+)
+COST = Counter(
+    "hr_buddy_cost", "Estimated Azure OpenAI cost (monitoring.cost.items)", LABELS + ["step"]
+)
+QUOTA_WAIT = Histogram(
+    "hr_buddy_quota_wait_seconds", "Time waited for the Azure OpenAI quota (monitoring.admission)", LABELS,
+    buckets=DURATION_BUCKETS,
+)
+
+
+def get_labels(approach: str, deployment: str, overrides: dict) -> dict:
+    """Return the metric labels of a request."""
+    search_option = overrides.get("search_option", SearchOption.BM25)
+    try:
+        search_option = SearchOption(search_option).name
+    except ValueError:
+        search_option = str(search_option)
+    return {"approach": approach, "deployment": deployment, "search_option": search_option}
+
+
+def get_step(item: dict) -> str:
+    """Return the step of a monitoring item, whose label may be an AnalysisPanelLabel."""
+    label = item["label"]
+    return label.value if isinstance(label, Enum) else label
+
+
+def get_source(monitoring: dict) -> str:
+    """Return where an answer came from: the approach, a cache or a coalesced execution."""
+    cache = monitoring.get("cache") or {}
+    if cache.get("hit"):
+        return f"{cache['type']}_cache"
+    return "coalesced" if monitoring.get("coalesced") else "approach"
+
+
+def observe_response(labels: dict, r: dict) -> None:
+    """Aggregate the monitoring of a response."""
+    monitoring = r["monitoring"]
+    source = get_source(monitoring)
+    REQUESTS.labels(**labels, status="200", source=source).inc()
+    REQUEST_DURATION.labels(**labels).observe(monitoring["time"]["total"])
+    for item in monitoring["time"]["items"]:
+        STEP_DURATION.labels(**labels, step=get_step(item)).observe(item["value"])
+    if source != "approach":
+        # The tokens were spent by the request that ran the approach
+        return
+    for item in monitoring["cost"]["items"]:
+        COST.labels(**labels, step=get_step(item)).inc(item["value"])
+    for item in monitoring["usage"]:
+        for kind in ["prompt_tokens", "completion_tokens"]:
+            TOKENS.labels(**labels, step=get_step(item), kind=kind).inc(item["value"].get(kind, 0))
+    if "admission" in monitoring:
+        QUOTA_WAIT.labels(**labels).observe(monitoring["admission"]["wait_time"])
+
+
+def observe_error(labels: dict, status: int) -> None:
+    """Count a failed request."""
+    REQUESTS.labels(**labels, status=str(status), source="approach").inc()
+
+
+class StatsCollector:
+    """Export the counters of connection pools, coalescing and admission control at scrape time."""
+
+    def collect(self):
+        """Yield gauges of the current counters."""
+        for prefix, label, stats in [
+            ("hr_buddy_pool", "pool", pool_stats()),
+            ("hr_buddy_coalescing", "level", coalescing_stats()),
+            ("hr_buddy_admission", "deployment", admission_stats()),
+        ]:
+            families = {}
+            for name, values in stats.items():
+                for key, value in values.items():
+                    if key not in families:
+                        families[key] = GaugeMetricFamily(
+                            f"{prefix}_{key}", f"{prefix} {key}", labels=[label]
+                        )
+                    families[key].add_metric([name], value)
+            yield from families.values()
+
+
+REGISTRY.register(StatsCollector())
+
+
+def render_metrics() -> tuple:
+    """Render all metrics in the Prometheus text format, returning the body and content type."""
+    return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
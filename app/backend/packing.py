@@ -0,0 +1,127 @@
+"""Packing of retrieved contents into the context window of a deployment.
+
+The retrieved chunks are added to the prompt in rank order for as long as they fit in
+what the rest of the prompt and the answer (`max_tokens`) leave of the context window.
+Chunks are counted with the `num_tokens` stored at index time when known, and only the
+chunk that no longer fits is tokenized, to be cut at a sentence boundary ("。" or ".").
+
+This module only depends on tiktoken and constants.py, so that the evaluation scripts pack
+their prompts the same way as the backend.
+"""
+import dataclasses
+import re
+from typing import Callable, List, Optional, Tuple
+
+import tiktoken
+from constants import OPENAI_CONTEXT_LENGTH
+
+# Tokenizer shared by gpt-35-turbo, gpt-4 and text-embedding-ada-002
+ENCODER = tiktoken.get_encoding("cl100k_base")
+
+# Tokens left unused, for the estimates of the stored counts and the chat format
+CONTEXT_TOKENS_BUFFER = 32
+# Tokens of the "- " bullet and the newline that join a chunk to the others
+CHUNK_SEPARATOR_TOKENS = 2
+# A sentence ends with "。" (or a full-width period), or with "." before a space, so that
+# decimal points and abbreviations inside words do not end it
+SENTENCE = re.compile(r".+?(?:[。．]|\.(?=\s)|$)\s*", re.DOTALL)
+
+
+def count_tokens(text: str) -> int:
+    """Count the number of tokens in a given text."""
+    return len(ENCODER.encode(text, disallowed_special=()))
+
+
+def count_message_tokens(messages: list) -> int:
+    """Estimate prompt tokens of chat messages (4 tokens per message + 3 for the reply priming)."""
+    return sum(4 + count_tokens(message["content"]) for message in messages) + 3
+
+
+def get_context_length(deployment: str) -> int:
+    """Return the context window of a deployment, assuming the smallest one if unknown."""
+    return OPENAI_CONTEXT_LENGTH.get(deployment) or min(OPENAI_CONTEXT_LENGTH.values())
+
+
+@dataclasses.dataclass(frozen=True)
+class Chunk:
+    """Retrieved content, with its number of tokens if known from the index."""
+
+    text: str
+    num_tokens: Optional[int] = None
+
+    def count_tokens(self) -> int:
+        """Return the tokens the chunk takes in the prompt."""
+        if isinstance(self.num_tokens, int) and self.num_tokens > 0:
+            return self.num_tokens + CHUNK_SEPARATOR_TOKENS
+        return count_tokens(self.text) + 1
+
+
+@dataclasses.dataclass
+class PackedContext:
+    """Retrieved contents packed into a token budget."""
+
+    text: str
+    num_tokens: int
+    budget: int
+    # Chunks in the text, the last of which may be cut
+    num_chunks: int
+    # Whether a chunk was cut or left out
+    truncated: bool
+
+
+def truncate_sentences(text: str, max_tokens: int) -> Tuple[str, int]:
+    """Keep the leading sentences of a text that fit in max_tokens, with their number of tokens."""
+    kept = []
+    num_tokens = 0
+    for sentence in SENTENCE.findall(text):
+        num_sentence_tokens = count_tokens(sentence)
+        if num_tokens + num_sentence_tokens > max_tokens:
+            break
+        kept.append(sentence)
+        num_tokens += num_sentence_tokens
+    return "".join(kept).rstrip(), num_tokens
+
+
+def pack_context(chunks: List[Chunk], budget: int) -> PackedContext:
+    """Join the chunks in order while they fit in the budget, cutting the first one that does not."""
+    texts = []
+    num_tokens = 0
+    truncated = False
+    for chunk in chunks:
+        num_chunk_tokens = chunk.count_tokens()
+        if num_tokens + num_chunk_tokens > budget:
+            # Count the sentences that fit, which may still be all of them if the stored count was high
+            text, num_text_tokens = truncate_sentences(chunk.text, budget - num_tokens - 1)
+            if text != chunk.text.rstrip():
+                truncated = True
+                if text:
+                    texts.append(text)
+                    num_tokens += num_text_tokens + 1
+                break
+            num_chunk_tokens = num_text_tokens + 1
+        texts.append(chunk.text)
+        num_tokens += num_chunk_tokens
+    return PackedContext(
+        text="\n".join(texts),
+        num_tokens=num_tokens,
+        budget=budget,
+        num_chunks=len(texts),
+        truncated=truncated,
+    )
+
+
+def pack_messages(
+    create_messages: Callable[[str], list],
+    chunks: List[Chunk],
+    context_length: int,
+    max_tokens: int,
+    buffer: int = CONTEXT_TOKENS_BUFFER,
+) -> Tuple[list, PackedContext]:
+    """Create chat messages whose source is as many chunks as the context window leaves room for.
+
+    `create_messages` creates the messages from the source text; the budget of the source
+    is what the messages without it, `max_tokens` and the buffer leave of `context_length`.
+    """
+    budget = context_length - count_message_tokens(create_messages("")) - max_tokens - buffer
+    packed = pack_context(chunks, max(budget, 0))
+    return create_messages(packed.text), packed
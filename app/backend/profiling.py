@@ -0,0 +1,149 @@
+"""Opt-in statistical profiling of single requests.
+
+A request is profiled when it sends the `X-Profile: 1` header or the override
+`profile: true`, or when it is drawn by PROFILE_SAMPLE_RATE. While its approach runs,
+a daemon thread samples the stacks of the event loop thread and of the worker threads
+of `asyncio.to_thread` (where e.g. language detection runs). Time the event loop spends
+in `select` is time spent waiting for the network.
+
+Profiles are written to PROFILE_DIR as collapsed stacks (`<request ID>.folded`, readable
+by flamegraph.pl and speedscope) with a summary of the top self-time functions
+(`<request ID>.txt`). Only one request is profiled at a time.
+"""
+import collections
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+from pathlib import Path
+from typing import Optional
+
+PROFILE_SAMPLE_RATE = float(os.environ.get("PROFILE_SAMPLE_RATE") or 0)
+PROFILE_INTERVAL_IN_MS = float(os.environ.get("PROFILE_INTERVAL_IN_MS") or 1)
+PROFILE_DIR = os.environ.get("PROFILE_DIR") or str(
+    Path(__file__).resolve().parents[2].joinpath("output", "profiles")
+)
+PROFILE_HEADER = "X-Profile"
+PROFILE_TOP_SIZE = 15
+
+# Threads of asyncio's default executor, which runs asyncio.to_thread
+EXECUTOR_THREAD_PREFIX = "asyncio"
+# Files whose frames on top of a worker stack mean that the worker is idle
+IDLE_FILES = {"threading.py", "queue.py", "thread.py"}
+
+PROFILE_LOCK = threading.Lock()
+
+
+def should_profile(overrides: dict, requested: bool = False) -> bool:
+    """Decide whether to profile a request."""
+    return requested or overrides.get("profile") is True or random.random() < PROFILE_SAMPLE_RATE
+
+
+def is_profile_requested(headers) -> bool:
+    """Return true if the request headers ask for a profile."""
+    return (headers.get(PROFILE_HEADER) or "").lower() in {"1", "true", "yes"}
+
+
+def describe_frame(frame) -> str:
+    """Describe the function of a frame."""
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class SamplingProfiler:
+    """Sample the stacks of the event loop thread and executor threads at a fixed interval."""
+
+    def __init__(self, request_id: str, interval_in_ms: float = PROFILE_INTERVAL_IN_MS):
+        """Initialize class."""
+        self.request_id = request_id
+        self.interval_in_sec = interval_in_ms / 1000
+        self.loop_thread_id = threading.get_ident()
+        self.stacks = collections.Counter()
+        self.num_samples = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="profiler", daemon=True)
+        self.start_time = None
+        self.elapsed_time = None
+
+    def start(self) -> "SamplingProfiler":
+        """Start sampling."""
+        self.start_time = time.perf_counter()
+        self.thread.start()
+        return self
+
+    def stop(self) -> None:
+        """Stop sampling and let the next request be profiled."""
+        self.stopped.set()
+        self.thread.join()
+        self.elapsed_time = time.perf_counter() - self.start_time
+        PROFILE_LOCK.release()
+
+    def run(self) -> None:
+        """Take samples until stopped."""
+        thread_names = {}
+        while not self.stopped.wait(self.interval_in_sec):
+            self.num_samples += 1
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id not in thread_names:
+                    thread_names.update({thread.ident: thread.name for thread in threading.enumerate()})
+                name = thread_names.get(thread_id, "")
+                if thread_id != self.loop_thread_id and not name.startswith(EXECUTOR_THREAD_PREFIX):
+                    continue
+                filename = os.path.basename(frame.f_code.co_filename)
+                if thread_id != self.loop_thread_id and filename in IDLE_FILES:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(describe_frame(frame))
+                    frame = frame.f_back
+                stack.append("event-loop" if thread_id == self.loop_thread_id else "executor")
+                self.stacks[tuple(reversed(stack))] += 1
+
+    def summarize(self) -> list:
+        """Return the functions with the most self time."""
+        self_samples = collections.Counter()
+        for stack, count in self.stacks.items():
+            self_samples[stack[-1]] += count
+        total = sum(self_samples.values()) or 1
+        return [
+            {
+                "function": function,
+                "self_time": round(count * self.interval_in_sec, 4),
+                "percent": round(100 * count / total, 1),
+            }
+            for function, count in self_samples.most_common(PROFILE_TOP_SIZE)
+        ]
+
+    def save(self) -> dict:
+        """Write the collapsed stacks and the summary, returning the summary for monitoring."""
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        path = os.path.join(PROFILE_DIR, self.request_id)
+        with open(f"{path}.folded", mode="w") as fout:
+            for stack, count in self.stacks.most_common():
+                fout.write(f"{';'.join(stack)} {count}\n")
+
+        top = self.summarize()
+        with open(f"{path}.txt", mode="w") as fout:
+            fout.write(
+                f"Request {self.request_id}: {self.elapsed_time:.3f}s, {self.num_samples} samples "
+                f"every {self.interval_in_sec * 1000:g}ms\n\n"
+            )
+            fout.write(f"{'self time':>10} {'%':>6}  function\n")
+            for item in top:
+                fout.write(f"{item['self_time']:>9.3f}s {item['percent']:>5.1f}%  {item['function']}\n")
+
+        return {
+            "id": self.request_id,
+            "path": f"{path}.folded",
+            "samples": self.num_samples,
+            "top": top[:5],
+        }
+
+
+def start_profiler(request_id: Optional[str] = None) -> Optional[SamplingProfiler]:
+    """Start profiling on the current (event loop) thread, or return None if a profile is running."""
+    if not PROFILE_LOCK.acquire(blocking=False):
+        return None
+    return SamplingProfiler(request_id or uuid.uuid4().hex).start()
@@ -0,0 +1,506 @@
+"""HTTP serving layer shared by app.py and app_no_cld.py.
+
+`SERVER_MODE` selects how requests are served at startup:
+
+- "sync" (default): Flask on a WSGI server. The approaches run on one long-lived
+  background event loop, so worker threads only block while waiting for the result.
+- "async": Quart on an ASGI server (e.g. `hypercorn app:app`). The approaches run on
+  the server's own event loop, so a single process can hold many in-flight questions.
+
+The /ask request/response contract is identical in both modes. /ask/stream takes the same
+request and answers with server-sent events instead: `data_points` as soon as the contents
+are retrieved, `delta` for every answer token, `reset` when an approach discards the answer
+streamed so far, and finally `answer`, `thoughts` and `monitoring`.
+
+Concurrent requests for the same question share one execution of the approach (see
+coalescing.py); `monitoring.coalesced` tells whether a response was shared. Azure OpenAI
+calls wait for the deployment's quota (see admission.py); the waits are reported in
+`monitoring.admission`, and requests that cannot be admitted get a 503. Sampled requests
+are traced (see tracing.py) and report their `monitoring.trace_id`; requests with the
+`X-Profile: 1` header are profiled (see profiling.py) and report `monitoring.profile`.
+Every request is recorded in the request ledger (see ledger.py).
+
+Answers are cached by question and settings, matching the normalized question and, with
+SEMANTIC_CACHE=on, paraphrases of it in requests with a vector search (see caching.py).
+A cached answer skips the approach entirely and is reported in `monitoring.cache`; the
+override `use_cache: false` bypasses the caches.
+"""
+import asyncio
+import copy
+import dataclasses
+import json
+import logging
+import os
+import threading
+import time
+from datetime import datetime
+from typing import AsyncIterator, Awaitable, Callable, Iterator, Optional
+
+from admission import ADMISSIONS, AdmissionRejected, admission_stats, summarize_admissions
+from approaches.approach import Approach, RequestContext
+from approaches.registry import ApproachRegistry
+from approaches.retrieve_read import RetrieveReadApproach
+from caching import (
+    IndexVersion,
+    create_answer_cache,
+    create_cache_key,
+    create_semantic_cache,
+    create_settings_key,
+)
+from coalescing import SingleFlight, coalescing_stats
+from constants import (
+    OPENAI_DEPLOYMENT_GPT_4,
+    OPENAI_DEPLOYMENT_GPT_35_TURBO,
+    AnalysisPanelLabel,
+    SearchOption,
+)
+from fanout import create_search_client
+from ledger import record_error, record_response
+from metrics import get_labels, observe_error, observe_response, render_metrics
+from profiling import is_profile_requested, should_profile, start_profiler
+from rich import print
+from tracing import current_trace_id, end_trace, should_sample, span, start_trace, use_span
+from transport import close_pools, create_requests_session, open_pools, pool_stats
+from utils import generate_embeddings
+
+SERVER_MODE_SYNC = "sync"
+SERVER_MODE_ASYNC = "async"
+SERVER_MODE = os.environ.get("SERVER_MODE") or SERVER_MODE_SYNC
+
+AZURE_OPENAI_GPT_DEPLOYMENT_DEFAULT = "gpt-35-turbo"
+
+# Keep-alive connections to the frontend dev server
+proxy_session = create_requests_session()
+
+
+class EventLoopThread:
+    """Event loop running forever in a daemon thread, shared by all WSGI workers."""
+
+    def __init__(self):
+        """Initialize class."""
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name="event-loop", daemon=True)
+        self.thread.start()
+
+    def run(self, coro: Awaitable) -> any:
+        """Run a coroutine on the shared loop and block until it finishes."""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    def iterate(self, agen: AsyncIterator) -> Iterator:
+        """Iterate an async generator on the shared loop from a worker thread."""
+        try:
+            while True:
+                try:
+                    yield self.run(agen.__anext__())
+                except StopAsyncIteration:
+                    return
+        finally:
+            self.run(agen.aclose())
+
+
+def proxy(host, path):
+    """Finalize HTTP response for serving static files."""
+    response = proxy_session.get(f"{host}{path}")
+    excluded_headers = [
+        "content-encoding",
+        "content-length",
+        "transfer-encoding",
+        "connection",
+    ]
+    headers = {
+        name: value
+        for name, value in response.raw.headers.items()
+        if name.lower() not in excluded_headers
+    }
+    return (response.content, response.status_code, headers)
+
+
+def create_registry(search_clients: dict) -> ApproachRegistry:
+    """Build the approaches shared by all requests."""
+    return ApproachRegistry(
+        create_search_client(search_clients),
+        deployments=[OPENAI_DEPLOYMENT_GPT_35_TURBO, OPENAI_DEPLOYMENT_GPT_4],
+    )
+
+
+def format_sse(event: str, data=None) -> str:
+    """Format a server-sent event."""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+@dataclasses.dataclass
+class CacheLookup:
+    """Result of a missed cache lookup, needed to cache the fresh answer."""
+
+    key: Optional[str] = None
+    settings_key: Optional[str] = None
+    embedding: Optional[list] = None
+    similarity: Optional[float] = None
+    elapsed_time: float = 0.0
+
+
+class AskService:
+    """Answer user questions for /ask and /ask/stream, independently of the serving mode."""
+
+    def __init__(
+        self,
+        search_clients: dict,
+        after_ask: Optional[Callable] = None,
+    ):
+        """Initialize class."""
+        self.registry = create_registry(search_clients)
+        self.index_version = IndexVersion()
+        self.answer_cache = create_answer_cache(self.index_version)
+        self.semantic_cache = create_semantic_cache(self.index_version)
+        self.ask_flight = SingleFlight("ask")
+        self.after_ask = after_ask
+
+    def get_approach(self, body: dict) -> Optional[Approach]:
+        """Look up the approach requested by the user, or None if it or the deployment is unknown."""
+        approach = body.get("approach", RetrieveReadApproach.KEY)
+        deployment = body.get("deployment", AZURE_OPENAI_GPT_DEPLOYMENT_DEFAULT)
+        return self.registry.get(approach, deployment)
+
+    async def lookup_cache(self, prompting_strategy: Approach, body: dict, start_time: float) -> tuple:
+        """Look up a cached answer, returning it (or None) and the lookup needed to cache a fresh one."""
+        lookup = CacheLookup()
+        overrides = body.get("overrides") or {}
+        if overrides.get("use_cache") is False:
+            return None, lookup
+
+        approach, deployment = prompting_strategy.KEY, prompting_strategy.openai_deployment
+        try:
+            if self.answer_cache is not None:
+                lookup.key = create_cache_key(body["question"], approach, deployment, overrides)
+                # The store may be a SQLite file
+                if r := await asyncio.to_thread(self.answer_cache.get_response, lookup.key, start_time):
+                    return r, lookup
+            # Only vector searches, whose retrieval embeds the question anyway: the embedding is
+            # memoized by generate_embeddings, so the retrieval reuses it instead of a second call
+            if self.semantic_cache is not None and prompting_strategy.is_vector_search(overrides):
+                lookup.settings_key = create_settings_key(approach, deployment, overrides)
+                lookup.embedding = await generate_embeddings(body["question"])
+                r, lookup.similarity = self.semantic_cache.get_response(
+                    lookup.settings_key, approach, body["question"], lookup.embedding, start_time
+                )
+                if r:
+                    return r, lookup
+        except Exception as e:
+            # Answer the question anyway
+            print(f"[WARNING] Answer cache lookup failed: {e}")
+        lookup.elapsed_time = round(time.time() - start_time, 2)
+        return None, lookup
+
+    async def run(
+        self, prompting_strategy: Approach, body: dict, ctx: RequestContext, profile: bool = False
+    ) -> tuple:
+        """Run the approach, sharing one execution among identical in-flight questions.
+
+        Returns the response and whether it was shared. Only the first request streams
+        its events; the others get the final response.
+        """
+        overrides = body.get("overrides") or {}
+        key = create_cache_key(
+            body["question"], prompting_strategy.KEY, prompting_strategy.openai_deployment, overrides
+        )
+
+        async def run_approach():
+            # Collect the quota waits of this execution for monitoring
+            admissions = []
+            ADMISSIONS.set(admissions)
+            profiler = start_profiler(current_trace_id()) if should_profile(overrides, profile) else None
+            try:
+                r = await prompting_strategy.run(body["question"], overrides, ctx)
+            finally:
+                if profiler:
+                    profiler.stop()
+            r["monitoring"]["admission"] = summarize_admissions(admissions)
+            if profiler:
+                r["monitoring"]["profile"] = await asyncio.to_thread(profiler.save)
+            return r
+
+        r, coalesced = await self.ask_flight.do(key, run_approach)
+        # Each request gets its own copy of the shared response
+        return copy.deepcopy(r), coalesced
+
+    async def finish(self, question: str, r: dict, lookup: CacheLookup, coalesced: bool) -> None:
+        """Report the cache miss, cache the fresh answer and run the after_ask hook."""
+        r["monitoring"]["cache"] = {"hit": False, "similarity": lookup.similarity}
+        r["monitoring"]["coalesced"] = coalesced
+        if lookup.elapsed_time:
+            time_items = r["monitoring"]["time"]["items"] + [
+                {"label": AnalysisPanelLabel.ANSWER_CACHE, "value": lookup.elapsed_time}
+            ]
+            r["monitoring"]["time"] = {
+                "total": round(r["monitoring"]["time"]["total"] + lookup.elapsed_time, 2),
+                "items": sorted(time_items, key=lambda item: item["value"], reverse=True),
+            }
+        # Coalesced requests share the answer cached by the first one
+        if not coalesced and lookup.key is not None:
+            await asyncio.to_thread(self.answer_cache.set_response, lookup.key, r)
+        if not coalesced and lookup.embedding is not None:
+            self.semantic_cache.set_response(lookup.settings_key, question, lookup.embedding, r)
+        if self.after_ask:
+            self.after_ask(r)
+
+    def start_trace(self, prompting_strategy: Approach, body: dict):
+        """Start the trace of a request if it is sampled."""
+        overrides = body.get("overrides") or {}
+        return start_trace(
+            "ask",
+            should_sample(overrides),
+            approach=prompting_strategy.KEY,
+            deployment=prompting_strategy.openai_deployment,
+            search_option=int(overrides.get("search_option", SearchOption.BM25)),
+        )
+
+    async def respond(
+        self, prompting_strategy: Approach, body: dict, ctx: RequestContext, profile: bool
+    ) -> tuple:
+        """Answer from the caches or by running the approach.
+
+        Returns the response and whether it was replayed, i.e. no events were streamed for it.
+        """
+        start_time = time.time()
+        with span("cache_lookup") as s:
+            r, lookup = await self.lookup_cache(prompting_strategy, body, start_time)
+            if s:
+                s.set(hit=r is not None, similarity=lookup.similarity)
+        if r:
+            return r, True
+        r, coalesced = await self.run(prompting_strategy, body, ctx, profile)
+        with span("finish"):
+            await self.finish(body["question"], r, lookup, coalesced)
+        return r, coalesced
+
+    async def answer(self, body: dict, profile: bool = False) -> tuple:
+        """Respond user questions, returning the response body and HTTP status."""
+        prompting_strategy = self.get_approach(body)
+        if prompting_strategy is None:
+            return {"error": "unknown approach or deployment"}, 400
+
+        labels = get_labels(
+            prompting_strategy.KEY, prompting_strategy.openai_deployment, body.get("overrides") or {}
+        )
+        root = self.start_trace(prompting_strategy, body)
+        try:
+            with use_span(root):
+                r, _ = await self.respond(prompting_strategy, body, RequestContext(), profile)
+            if root:
+                r["monitoring"]["trace_id"] = root.trace_id
+            observe_response(labels, r)
+            record_response(labels, r)
+            return r, 200
+        except AdmissionRejected as e:
+            observe_error(labels, 503)
+            record_error(labels, 503)
+            return {"error": str(e), "retry_after": round(e.retry_after)}, 503
+        except Exception as e:
+            logging.exception("Exception in /ask")
+            observe_error(labels, 500)
+            record_error(labels, 500)
+            return {"error": str(e)}, 500
+        finally:
+            end_trace(root)
+
+    async def answer_stream(
+        self, prompting_strategy: Approach, body: dict, profile: bool = False
+    ) -> AsyncIterator[str]:
+        """Respond user questions as server-sent events."""
+        labels = get_labels(
+            prompting_strategy.KEY, prompting_strategy.openai_deployment, body.get("overrides") or {}
+        )
+        root = self.start_trace(prompting_strategy, body)
+        events = asyncio.Queue()
+        ctx = RequestContext(events=events)
+
+        async def run():
+            # The trace is bound to this task, as the steps of an async generator may run in
+            # different contexts
+            try:
+                with use_span(root):
+                    return await self.respond(prompting_strategy, body, ctx, profile)
+            finally:
+                events.put_nowait(None)
+
+        task = asyncio.create_task(run())
+        try:
+            while (event := await events.get()) is not None:
+                yield format_sse(*event)
+            r, replayed = await task
+        except AdmissionRejected as e:
+            observe_error(labels, 503)
+            record_error(labels, 503)
+            yield format_sse("error", {"error": str(e), "retry_after": round(e.retry_after)})
+            return
+        except Exception as e:
+            logging.exception("Exception in /ask/stream")
+            observe_error(labels, 500)
+            record_error(labels, 500)
+            yield format_sse("error", {"error": str(e)})
+            return
+        finally:
+            # The client went away before the answer was complete
+            task.cancel()
+            end_trace(root)
+
+        if root:
+            r["monitoring"]["trace_id"] = root.trace_id
+        observe_response(labels, r)
+        record_response(labels, r)
+        if replayed:
+            # Cached and coalesced answers were not streamed
+            yield format_sse("data_points", r["data_points"])
+        yield format_sse("answer", r["answer"])
+        yield format_sse("thoughts", r["thoughts"])
+        yield format_sse("monitoring", r["monitoring"])
+
+
+def create_sync_app(
+    search_clients: dict,
+    after_ask: Optional[Callable] = None,
+):
+    """Create a Flask (WSGI) app whose approaches run on a background event loop."""
+    from flask import Flask, Response, jsonify, request
+
+    app = Flask(__name__)
+    event_loop = EventLoopThread()
+    event_loop.run(open_pools())
+    service = AskService(search_clients, after_ask)
+
+    @app.route("/", defaults={"path": "index.html"})
+    @app.route("/<path:path>")
+    def static_file(path: str):
+        """Send target file to the user."""
+        print(f"[DEBUG] {datetime.now().strftime('%Y-%m-%d %H:%M:%S')} | static_file")
+        if os.environ.get("FLASK_DEBUG"):
+            return proxy("http://localhost:5173", request.path)
+        return app.send_static_file(path)
+
+    @app.route("/ask", methods=["POST"])
+    def ask():
+        """Respond user questions."""
+        print(f"[DEBUG] {datetime.now().strftime('%Y-%m-%d %H:%M:%S')} | ask")
+        r, status = event_loop.run(service.answer(request.json, is_profile_requested(request.headers)))
+        return jsonify(r), status
+
+    @app.route("/ask/stream", methods=["POST"])
+    def ask_stream():
+        """Respond user questions as server-sent events."""
+        print(f"[DEBUG] {datetime.now().strftime('%Y-%m-%d %H:%M:%S')} | ask_stream")
+        prompting_strategy = service.get_approach(request.json)
+        if prompting_strategy is None:
+            return jsonify({"error": "unknown approach or deployment"}), 400
+        events = service.answer_stream(
+            prompting_strategy, request.json, is_profile_requested(request.headers)
+        )
+        return Response(event_loop.iterate(events), mimetype="text/event-stream")
+
+    @app.route("/pools", methods=["GET"])
+    def pools():
+        """Report connection pool metrics."""
+        return jsonify(pool_stats())
+
+    @app.route("/coalescing", methods=["GET"])
+    def coalescing():
+        """Report request coalescing counters."""
+        return jsonify(coalescing_stats())
+
+    @app.route("/admission", methods=["GET"])
+    def admission():
+        """Report Azure OpenAI admission control metrics."""
+        return jsonify(admission_stats())
+
+    @app.route("/metrics", methods=["GET"])
+    def metrics():
+        """Expose metrics to Prometheus."""
+        body, content_type = render_metrics()
+        return Response(body, content_type=content_type)
+
+    return app
+
+
+def create_async_app(
+    search_clients: dict,
+    after_ask: Optional[Callable] = None,
+):
+    """Create a Quart (ASGI) app whose approaches run on the server's event loop."""
+    from quart import Quart, jsonify, make_response, request
+
+    app = Quart(__name__)
+    service = AskService(search_clients, after_ask)
+
+    @app.before_serving
+    async def startup():
+        """Open connection pools on the server's event loop."""
+        await open_pools()
+
+    @app.after_serving
+    async def shutdown():
+        """Close connection pools."""
+        await close_pools()
+
+    @app.route("/", defaults={"path": "index.html"})
+    @app.route("/<path:path>")
+    async def static_file(path: str):
+        """Send target file to the user."""
+        print(f"[DEBUG] {datetime.now().strftime('%Y-%m-%d %H:%M:%S')} | static_file")
+        if os.environ.get("FLASK_DEBUG"):
+            return await asyncio.to_thread(proxy, "http://localhost:5173", request.path)
+        return await app.send_static_file(path)
+
+    @app.route("/ask", methods=["POST"])
+    async def ask():
+        """Respond user questions."""
+        print(f"[DEBUG] {datetime.now().strftime('%Y-%m-%d %H:%M:%S')} | ask")
+        r, status = await service.answer(await request.get_json(), is_profile_requested(request.headers))
+        return jsonify(r), status
+
+    @app.route("/ask/stream", methods=["POST"])
+    async def ask_stream():
+        """Respond user questions as server-sent events."""
+        print(f"[DEBUG] {datetime.now().strftime('%Y-%m-%d %H:%M:%S')} | ask_stream")
+        body = await request.get_json()
+        prompting_strategy = service.get_approach(body)
+        if prompting_strategy is None:
+            return jsonify({"error": "unknown approach or deployment"}), 400
+        events = service.answer_stream(prompting_strategy, body, is_profile_requested(request.headers))
+        response = await make_response(events, {"Content-Type": "text/event-stream"})
+        response.timeout = None
+        return response
+
+    @app.route("/pools", methods=["GET"])
+    async def pools():
+        """Report connection pool metrics."""
+        return jsonify(pool_stats())
+
+    @app.route("/coalescing", methods=["GET"])
+    async def coalescing():
+        """Report request coalescing counters."""
+        return jsonify(coalescing_stats())
+
+    @app.route("/admission", methods=["GET"])
+    async def admission():
+        """Report Azure OpenAI admission control metrics."""
+        return jsonify(admission_stats())
+
+    @app.route("/metrics", methods=["GET"])
+    async def metrics():
+        """Expose metrics to Prometheus."""
+        body, content_type = render_metrics()
+        return body, 200, {"Content-Type": content_type}
+
+    return app
+
+
+def create_app(
+    search_clients: dict,
+    after_ask: Optional[Callable] = None,
+):
+    """Create the backend app for the serving mode selected by SERVER_MODE."""
+    print(f"[DEBUG] {SERVER_MODE=}")
+    if SERVER_MODE == SERVER_MODE_ASYNC:
+        return create_async_app(search_clients, after_ask)
+    if SERVER_MODE == SERVER_MODE_SYNC:
+        return create_sync_app(search_clients, after_ask)
+    raise ValueError(f"Unknown SERVER_MODE '{SERVER_MODE}'")
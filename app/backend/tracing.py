@@ -0,0 +1,236 @@
+"""Per-request tracing with nested spans.
+
+A sampled request gets a root span; every traced step below it (approach runs,
+language detection, embeddings, quota waits, ACS searches, LLM calls and response
+building) opens a child span of the span that is current in its task, so nested
+approaches and concurrent steps keep their parent/child links. Finished traces are
+exported from a background thread, either as JSON lines to a local file or as OTLP/JSON
+to a collector.
+
+Requests that are not sampled carry no current span, and `span()` then costs one
+context variable lookup.
+"""
+import contextlib
+import contextvars
+import json
+import os
+import queue
+import random
+import secrets
+import threading
+import time
+from pathlib import Path
+from typing import Iterator, Optional
+
+from rich import print
+from transport import create_requests_session
+
+TRACE_SAMPLE_RATE = float(os.environ.get("TRACE_SAMPLE_RATE") or 0)
+TRACE_EXPORTER = os.environ.get("TRACE_EXPORTER") or "json"  # "json" or "otlp"
+TRACE_FILE = os.environ.get("TRACE_FILE") or str(
+    Path(__file__).resolve().parents[2].joinpath("output", "traces.jsonl")
+)
+TRACE_OTLP_ENDPOINT = os.environ.get("TRACE_OTLP_ENDPOINT") or "http://localhost:4318/v1/traces"
+TRACE_SERVICE_NAME = "hr-buddy-backend"
+
+CURRENT_SPAN = contextvars.ContextVar("current_span", default=None)
+
+
+class Trace:
+    """Finished spans of a traced request."""
+
+    __slots__ = ("trace_id", "spans")
+
+    def __init__(self):
+        """Initialize class."""
+        self.trace_id = secrets.token_hex(16)
+        self.spans = []
+
+
+class Span:
+    """Timed step of a traced request."""
+
+    __slots__ = ("trace", "name", "span_id", "parent_id", "attributes", "start_time", "end_time", "error")
+
+    def __init__(self, trace: Trace, name: str, parent_id: Optional[str], attributes: dict):
+        """Initialize class."""
+        self.trace = trace
+        self.name = name
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent_id
+        self.attributes = attributes
+        self.start_time = time.time_ns()
+        self.end_time = None
+        self.error = None
+
+    @property
+    def trace_id(self) -> str:
+        """Return the ID of the trace."""
+        return self.trace.trace_id
+
+    def set(self, **attributes) -> None:
+        """Add attributes."""
+        self.attributes.update(attributes)
+
+    def end(self) -> None:
+        """Finish the span and add it to its trace."""
+        self.end_time = time.time_ns()
+        self.trace.spans.append(self)
+
+    def to_dict(self) -> dict:
+        """Convert to a plain dictionary."""
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start_time": self.start_time / 1e9,
+            "duration": round((self.end_time - self.start_time) / 1e9, 4),
+            "attributes": self.attributes,
+            "error": self.error,
+        }
+
+
+def should_sample(overrides: dict) -> bool:
+    """Decide whether to trace a request; the override `trace: true` forces it."""
+    return overrides.get("trace") is True or random.random() < TRACE_SAMPLE_RATE
+
+
+def start_trace(name: str, sampled: bool, **attributes) -> Optional[Span]:
+    """Start the root span of a request, or return None if it is not sampled."""
+    if not sampled:
+        return None
+    return Span(Trace(), name, None, attributes)
+
+
+def end_trace(root: Optional[Span]) -> None:
+    """Finish the root span and export the trace."""
+    if root is None:
+        return
+    root.end()
+    EXPORTER.submit(root.trace.spans)
+
+
+def current_trace_id() -> Optional[str]:
+    """Return the ID of the current trace, or None if the request is not traced."""
+    current = CURRENT_SPAN.get()
+    return current.trace_id if current is not None else None
+
+
+@contextlib.contextmanager
+def use_span(current: Optional[Span]) -> Iterator[None]:
+    """Make a span current in this context, e.g. the root span inside a request's task."""
+    token = CURRENT_SPAN.set(current)
+    try:
+        yield
+    finally:
+        CURRENT_SPAN.reset(token)
+
+
+@contextlib.contextmanager
+def span(name: str, **attributes) -> Iterator[Optional[Span]]:
+    """Trace a step as a child of the current span; yields None if the request is not traced."""
+    parent = CURRENT_SPAN.get()
+    if parent is None:
+        yield None
+        return
+
+    child = Span(parent.trace, name, parent.span_id, attributes)
+    token = CURRENT_SPAN.set(child)
+    try:
+        yield child
+    except BaseException as e:
+        child.error = repr(e)
+        raise
+    finally:
+        CURRENT_SPAN.reset(token)
+        child.end()
+
+
+def to_otlp_value(value) -> dict:
+    """Convert an attribute value to an OTLP AnyValue."""
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def to_otlp(spans: list) -> dict:
+    """Convert the spans of a trace to an OTLP/JSON export request."""
+    return {
+        "resourceSpans": [{
+            "resource": {
+                "attributes": [{"key": "service.name", "value": {"stringValue": TRACE_SERVICE_NAME}}],
+            },
+            "scopeSpans": [{
+                "scope": {"name": "hr-buddy"},
+                "spans": [
+                    {
+                        "traceId": s.trace_id,
+                        "spanId": s.span_id,
+                        "parentSpanId": s.parent_id or "",
+                        "name": s.name,
+                        "kind": 1,
+                        "startTimeUnixNano": str(s.start_time),
+                        "endTimeUnixNano": str(s.end_time),
+                        "attributes": [
+                            {"key": k, "value": to_otlp_value(v)} for k, v in s.attributes.items()
+                        ],
+                        "status": {"code": 2, "message": s.error} if s.error else {"code": 1},
+                    }
+                    for s in spans
+                ],
+            }],
+        }]
+    }
+
+
+class TraceExporter:
+    """Export finished traces from a daemon thread, off the request path."""
+
+    def __init__(self, exporter: str):
+        """Initialize class."""
+        self.exporter = exporter
+        self.traces = queue.Queue(maxsize=1000)
+        self.session = None
+        self.thread = threading.Thread(target=self.run, name="trace-exporter", daemon=True)
+        self.thread.start()
+
+    def submit(self, spans: list) -> None:
+        """Queue a trace for export, dropping it if the exporter falls behind."""
+        try:
+            self.traces.put_nowait(spans)
+        except queue.Full:
+            print("[WARNING] Trace export queue is full, dropping a trace")
+
+    def run(self) -> None:
+        """Export queued traces."""
+        while True:
+            spans = self.traces.get()
+            try:
+                if self.exporter == "otlp":
+                    self.export_otlp(spans)
+                else:
+                    self.export_json(spans)
+            except Exception as e:
+                print(f"[WARNING] Failed to export a trace: {e}")
+
+    def export_json(self, spans: list) -> None:
+        """Append a trace to the JSON lines file."""
+        os.makedirs(os.path.dirname(TRACE_FILE), exist_ok=True)
+        with open(TRACE_FILE, mode="a") as fout:
+            trace = {"trace_id": spans[0].trace_id, "spans": [s.to_dict() for s in spans]}
+            fout.write(json.dumps(trace, ensure_ascii=False, default=str) + "\n")
+
+    def export_otlp(self, spans: list) -> None:
+        """Post a trace to an OTLP/HTTP collector."""
+        if self.session is None:
+            self.session = create_requests_session()
+        response = self.session.post(TRACE_OTLP_ENDPOINT, json=to_otlp(spans), timeout=5)
+        response.raise_for_status()
+
+
+EXPORTER = TraceExporter(TRACE_EXPORTER)
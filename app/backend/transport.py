@@ -0,0 +1,188 @@
+"""Pooled, keep-alive HTTP transports for Cognitive Search and Azure OpenAI.
+
+Each upstream service gets one `HTTPPool`: an aiohttp session whose connector keeps
+TLS connections open between requests, so that requests only pay for the handshake
+when the pool has to grow. While a pool sits idle, a warm-up ping keeps its
+connections from being closed by the server.
+
+Note that neither the OpenAI SDK nor the Azure SDK can speak HTTP/2 over aiohttp,
+so connections are HTTP/1.1 with keep-alive.
+"""
+import asyncio
+import os
+import time
+from typing import Optional
+
+import aiohttp
+import requests
+from azure.core.pipeline.transport import AioHttpTransport
+from requests.adapters import HTTPAdapter
+from rich import print
+
+HTTP_POOL_SIZE = int(os.environ.get("HTTP_POOL_SIZE") or 100)
+HTTP_POOL_SIZE_PER_HOST = int(os.environ.get("HTTP_POOL_SIZE_PER_HOST") or 0)  # 0 means no per-host limit
+HTTP_KEEPALIVE_TIMEOUT_IN_SEC = float(os.environ.get("HTTP_KEEPALIVE_TIMEOUT_IN_SEC") or 120)
+HTTP_WARMUP_INTERVAL_IN_SEC = float(os.environ.get("HTTP_WARMUP_INTERVAL_IN_SEC") or 60)
+
+
+class HTTPPool:
+    """Shared aiohttp session with connection pool metrics and idle-time warm-up."""
+
+    def __init__(self, name: str, warmup_url: Optional[str] = None):
+        """Initialize class."""
+        self.name = name
+        self.warmup_url = warmup_url
+        self.session = None
+        self.warmup_task = None
+        self.last_used = 0.0
+
+        self.num_requests = 0
+        self.num_in_flight = 0
+        self.num_connections_created = 0
+        self.num_connections_reused = 0
+        self.num_waits = 0
+        self.total_wait_time = 0.0
+        self.max_wait_time = 0.0
+
+    def create_trace_config(self) -> aiohttp.TraceConfig:
+        """Collect pool metrics from aiohttp's connection events."""
+        trace_config = aiohttp.TraceConfig()
+
+        async def on_request_start(session, context, params):
+            self.num_requests += 1
+            self.num_in_flight += 1
+            self.last_used = time.time()
+
+        async def on_request_end(session, context, params):
+            self.num_in_flight -= 1
+
+        async def on_connection_create_end(session, context, params):
+            self.num_connections_created += 1
+
+        async def on_connection_reuseconn(session, context, params):
+            self.num_connections_reused += 1
+
+        async def on_connection_queued_start(session, context, params):
+            context.queued_at = time.perf_counter()
+
+        async def on_connection_queued_end(session, context, params):
+            wait_time = time.perf_counter() - context.queued_at
+            self.num_waits += 1
+            self.total_wait_time += wait_time
+            self.max_wait_time = max(self.max_wait_time, wait_time)
+
+        trace_config.on_request_start.append(on_request_start)
+        trace_config.on_request_end.append(on_request_end)
+        trace_config.on_request_exception.append(on_request_end)
+        trace_config.on_connection_create_end.append(on_connection_create_end)
+        trace_config.on_connection_reuseconn.append(on_connection_reuseconn)
+        trace_config.on_connection_queued_start.append(on_connection_queued_start)
+        trace_config.on_connection_queued_end.append(on_connection_queued_end)
+        return trace_config
+
+    async def get_session(self) -> aiohttp.ClientSession:
+        """Return the pooled session, creating it on the running event loop if needed."""
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=HTTP_POOL_SIZE,
+                limit_per_host=HTTP_POOL_SIZE_PER_HOST,
+                keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT_IN_SEC,
+                ttl_dns_cache=300,
+            )
+            self.session = aiohttp.ClientSession(
+                connector=connector,
+                trace_configs=[self.create_trace_config()],
+                trust_env=True,
+            )
+            if self.warmup_url and HTTP_WARMUP_INTERVAL_IN_SEC > 0:
+                self.warmup_task = asyncio.create_task(self.keep_warm())
+        return self.session
+
+    async def keep_warm(self):
+        """Ping the service whenever the pool has been idle, so that connections stay open."""
+        while True:
+            idle_time = time.time() - self.last_used
+            if idle_time >= HTTP_WARMUP_INTERVAL_IN_SEC:
+                try:
+                    # Any response keeps the connection alive, even 401/404
+                    async with self.session.head(self.warmup_url) as response:
+                        await response.read()
+                except aiohttp.ClientError as e:
+                    print(f"[WARNING] warm-up of '{self.name}' failed: {e}")
+                idle_time = 0.0
+            await asyncio.sleep(HTTP_WARMUP_INTERVAL_IN_SEC - idle_time)
+
+    async def close(self):
+        """Close the session and stop warming it up."""
+        if self.warmup_task is not None:
+            self.warmup_task.cancel()
+            self.warmup_task = None
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    def stats(self) -> dict:
+        """Return pool metrics."""
+        num_connections = self.num_connections_created + self.num_connections_reused
+        return {
+            "requests": self.num_requests,
+            "connections_created": self.num_connections_created,
+            "connections_reused": self.num_connections_reused,
+            "reuse_ratio": (
+                round(self.num_connections_reused / num_connections, 3) if num_connections else 0.0
+            ),
+            "waits": self.num_waits,
+            "wait_time_avg": round(self.total_wait_time / self.num_waits, 4) if self.num_waits else 0.0,
+            "wait_time_max": round(self.max_wait_time, 4),
+            "in_flight": self.num_in_flight,
+            "limit": HTTP_POOL_SIZE,
+        }
+
+
+class PooledAioHttpTransport(AioHttpTransport):
+    """Azure SDK transport that sends requests through an `HTTPPool`."""
+
+    def __init__(self, pool: HTTPPool, **kwargs):
+        """Initialize class."""
+        super().__init__(**kwargs)
+        self.pool = pool
+
+    async def open(self):
+        """Borrow the pool's session instead of opening a new one."""
+        if not self.session or self.session.closed:
+            self.session = await self.pool.get_session()
+            # The pool owns the session, so the SDK must not close it
+            self._session_owner = False
+        await super().open()
+
+
+# Pools shared by all requests. app.py sets their warm-up URLs.
+OPENAI_POOL = HTTPPool("openai")
+SEARCH_POOL = HTTPPool("search")
+POOLS = {pool.name: pool for pool in [OPENAI_POOL, SEARCH_POOL]}
+
+
+async def open_pools():
+    """Open all pools on the running event loop so that warm-up starts before the first request."""
+    for pool in POOLS.values():
+        await pool.get_session()
+
+
+async def close_pools():
+    """Close all pools."""
+    for pool in POOLS.values():
+        await pool.close()
+
+
+def pool_stats() -> dict:
+    """Return metrics of all pools."""
+    return {name: pool.stats() for name, pool in POOLS.items()}
+
+
+def create_requests_session() -> requests.Session:
+    """Create a `requests` session with a connection pool for synchronous calls."""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=10, pool_maxsize=HTTP_POOL_SIZE)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
@@ -1,20 +1,57 @@
 """Utility functions."""
+import asyncio
+import contextvars
+import os
+import re
+import weakref
+from collections import OrderedDict
+from typing import Callable, Optional
+
 import openai
-import spacy
+from admission import admit
+from coalescing import SingleFlight
 from constants import OPENAI_DEPLOYMENT_TEXT_EMBEDDING_ADA_002, OPENAI_PRICING_PER_TOKEN
-from spacy.language import Language
-from spacy_langdetect import LanguageDetector
+from packing import count_message_tokens, count_tokens
+from tracing import span
+from transport import OPENAI_POOL
+
+# "script" decides en vs ja from Unicode script ratios and never loads spaCy, "hybrid" falls
+# back to spaCy for ambiguous text, and "spacy" always runs the spaCy pipeline
+LANGUAGE_DETECTOR = os.environ.get("LANGUAGE_DETECTOR") or "hybrid"
+# Japanese share of letters above/below which a text is ja/en; in between it is ambiguous
+LANGUAGE_JA_RATIO_MIN = 0.6
+LANGUAGE_EN_RATIO_MAX = 0.3
+# One kana or kanji carries about as much text as this many Latin letters
+LANGUAGE_JA_CHAR_WEIGHT = 3
+# Script ratios are stable after a few sentences, so long contexts are only sampled
+LANGUAGE_DETECTION_MAX_CHARS = 2000
+# Language of text without letters, e.g. numbers only, when spaCy is not loaded
+LANGUAGE_DEFAULT = "ja"
+
+JA_CHARS = re.compile(r"[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uff66-\uff9f]")
+LATIN_CHARS = re.compile(r"[A-Za-z\uff21-\uff3a\uff41-\uff5a]")
+
+
+def load_language_pipeline():
+    """Load a spaCy pipeline with the language detection component."""
+    import spacy
+    from spacy.language import Language
+    from spacy_langdetect import LanguageDetector
 
+    # The detector only reads the text and its sentences, so no trained components are needed
+    Language.factory("language_detector", func=lambda nlp, name: LanguageDetector())
+    nlp = spacy.blank("en")
+    nlp.add_pipe("sentencizer")
+    nlp.add_pipe("language_detector", last=True)
+    return nlp
 
-def create_lang_detector(nlp, name):
-    """Instatiate spacy language detector."""
-    return LanguageDetector()
 
-Language.factory("language_detector", func=create_lang_detector)
+nlp = load_language_pipeline() if LANGUAGE_DETECTOR != "script" else None
 
-# Load SpaCy model with language detection component
-nlp = spacy.load("en_core_web_sm")
-nlp.add_pipe('language_detector', last=True)
+EMBEDDING_CACHE_SIZE = int(os.environ.get("EMBEDDING_CACHE_SIZE") or 1000)
+EMBEDDING_BATCH_WINDOW_IN_MS = float(os.environ.get("EMBEDDING_BATCH_WINDOW_IN_MS") or 5)
+# Azure OpenAI accepts at most 16 inputs per embedding request
+EMBEDDING_BATCH_MAX_SIZE = int(os.environ.get("EMBEDDING_BATCH_MAX_SIZE") or 16)
 
 
 def nonewlines(s: str) -> str:
@@ -22,16 +59,227 @@ def nonewlines(s: str) -> str:
     return s.replace("\n", " ").replace("\r", " ")
 
 
-def generate_embeddings(text: str):
-    """Generate text embeddings using Azure OpenAI text-embedding-ada-002."""
-    response = openai.Embedding.create(
-        input=text,
-        engine=OPENAI_DEPLOYMENT_TEXT_EMBEDDING_ADA_002
-    )
-    embeddings = response["data"][0]["embedding"]
+class EmbeddingBatcher:
+    """Send concurrent embedding requests as one batched Embedding call.
+
+    The first request of a batch waits `window_in_ms` for others to join, so that
+    concurrent questions share a single round trip to Azure OpenAI.
+    """
+
+    def __init__(self, window_in_ms: float, max_size: int):
+        """Initialize class."""
+        self.window_in_sec = window_in_ms / 1000
+        self.max_size = max_size
+        self.pending = {}  # Futures by text
+        self.flush_handle = None
+
+        self.num_requests = 0
+        self.num_batches = 0
+
+    async def embed(self, text: str) -> list:
+        """Return the embedding of a text once its batch has been sent."""
+        loop = asyncio.get_running_loop()
+        self.num_requests += 1
+        future = self.pending.get(text)
+        if future is None:
+            future = self.pending[text] = loop.create_future()
+            if len(self.pending) >= self.max_size:
+                self.flush()
+            elif self.flush_handle is None:
+                self.flush_handle = loop.call_later(self.window_in_sec, self.flush)
+        # Shield the batch from the cancellation of one of its requests
+        return await asyncio.shield(future)
+
+    def flush(self) -> None:
+        """Send the pending requests."""
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        batch, self.pending = self.pending, {}
+        if batch:
+            self.num_batches += 1
+            asyncio.ensure_future(self.send(batch))
+
+    async def send(self, batch: dict) -> None:
+        """Embed a batch of texts and resolve their futures."""
+        texts = list(batch)
+
+        async def call():
+            openai.aiosession.set(await OPENAI_POOL.get_session())
+            return await openai.Embedding.acreate(
+                input=texts,
+                engine=OPENAI_DEPLOYMENT_TEXT_EMBEDDING_ADA_002
+            )
+
+        try:
+            estimated_tokens = sum(count_tokens(text) for text in texts)
+            response = await admit(
+                OPENAI_DEPLOYMENT_TEXT_EMBEDDING_ADA_002,
+                estimated_tokens,
+                call,
+                lambda r: r["usage"]["total_tokens"],
+            )
+            for item in response["data"]:
+                future = batch[texts[item["index"]]]
+                if not future.done():
+                    future.set_result(item["embedding"])
+        except Exception as e:
+            for future in batch.values():
+                if not future.done():
+                    future.set_exception(e)
+        finally:
+            # A text missing from the response (or a cancelled send) must not leave its requests
+            # waiting forever
+            for future in batch.values():
+                if not future.done():
+                    future.set_exception(RuntimeError("Azure OpenAI returned no embedding for the text"))
+
+
+# One batcher per event loop, as futures cannot be shared across loops
+EMBEDDING_BATCHERS = weakref.WeakKeyDictionary()
+# Query embeddings by text, least recently used first
+EMBEDDING_CACHE = OrderedDict()
+# Identical texts share one embedding request across batches
+EMBEDDING_FLIGHT = SingleFlight("embedding")
+# Usage of the ChatCompletions of the current task, collected for work that may be
+# cancelled before it reports its own cost
+COMPLETION_USAGE = contextvars.ContextVar("completion_usage", default=None)
+
+
+async def generate_embeddings(text: str):
+    """Generate text embeddings using Azure OpenAI text-embedding-ada-002.
+
+    Recent embeddings are memoized, and concurrent calls are batched into one request.
+    """
+    embeddings = EMBEDDING_CACHE.get(text)
+    if embeddings is not None:
+        EMBEDDING_CACHE.move_to_end(text)
+        return embeddings
+
+    loop = asyncio.get_running_loop()
+    batcher = EMBEDDING_BATCHERS.get(loop)
+    if batcher is None:
+        batcher = EmbeddingBatcher(EMBEDDING_BATCH_WINDOW_IN_MS, EMBEDDING_BATCH_MAX_SIZE)
+        EMBEDDING_BATCHERS[loop] = batcher
+    with span("embedding") as s:
+        embeddings, coalesced = await EMBEDDING_FLIGHT.do(text, lambda: batcher.embed(text))
+        if s:
+            s.set(coalesced=coalesced)
+
+    EMBEDDING_CACHE[text] = embeddings
+    EMBEDDING_CACHE.move_to_end(text)
+    while len(EMBEDDING_CACHE) > EMBEDDING_CACHE_SIZE:
+        EMBEDDING_CACHE.popitem(last=False)
     return embeddings
 
 
+async def create_chat_completion(
+    on_token: Optional[Callable[[str], None]] = None,
+    should_abort: Optional[Callable[[str], bool]] = None,
+    **kwargs,
+):
+    """Call Azure OpenAI ChatCompletion without blocking the event loop.
+
+    If `on_token` is given, the completion is streamed and every token is passed to it
+    as soon as it arrives. If `should_abort` is given, the completion is streamed and cut
+    short as soon as it returns true for the content so far. Streamed responses carry no
+    usage, so it is estimated with tiktoken. The call waits for the deployment's quota
+    (see admission.py).
+    """
+    sent = False
+    # Tokens of a streamed completion received so far, billed if the call is cancelled
+    received = []
+
+    async def call():
+        nonlocal sent
+        sent = True
+        openai.aiosession.set(await OPENAI_POOL.get_session())
+        if on_token is None and should_abort is None:
+            return await openai.ChatCompletion.acreate(**kwargs)
+        return await stream_chat_completion(on_token, should_abort, received, **kwargs)
+
+    # Azure counts max_tokens against the quota until the completion is done
+    prompt_tokens = count_message_tokens(kwargs["messages"])
+    estimated_tokens = prompt_tokens + (kwargs.get("max_tokens") or 0)
+    spent = COMPLETION_USAGE.get()
+    stream = on_token is not None or should_abort is not None
+    with span("chat_completion", deployment=kwargs["engine"], stream=stream) as s:
+        try:
+            completion = await admit(
+                kwargs["engine"],
+                estimated_tokens,
+                call,
+                lambda completion: completion["usage"]["total_tokens"],
+            )
+        except asyncio.CancelledError:
+            if spent is not None and sent:
+                # A request that was already sent is billed for its prompt and its completion: Azure stops
+                # a streamed completion when the connection closes, but generates the others to the end
+                if stream:
+                    completion_tokens = count_tokens("".join(received))
+                else:
+                    completion_tokens = kwargs.get("max_tokens") or 0
+                spent.append({
+                    "prompt_tokens": prompt_tokens,
+                    "completion_tokens": completion_tokens,
+                    "total_tokens": prompt_tokens + completion_tokens,
+                })
+            raise
+        if spent is not None:
+            spent.append(dict(completion["usage"]))
+        if s:
+            s.set(**completion["usage"])
+        return completion
+
+
+async def stream_chat_completion(
+    on_token: Optional[Callable[[str], None]],
+    should_abort: Optional[Callable[[str], bool]],
+    received: Optional[list] = None,
+    **kwargs,
+):
+    """Stream a ChatCompletion, passing every token to `on_token` and stopping once `should_abort`.
+
+    Tokens are also appended to `received`, if given, as they arrive.
+    """
+    content = ""
+    finish_reason = "stop"
+    stream = await openai.ChatCompletion.acreate(stream=True, **kwargs)
+    try:
+        async for chunk in stream:
+            if not chunk.choices:
+                # Azure sends content filter results in a chunk without choices
+                continue
+            token = chunk.choices[0].delta.get("content")
+            if token:
+                content += token
+                if received is not None:
+                    received.append(token)
+                if on_token is not None:
+                    on_token(token)
+                if should_abort is not None and should_abort(content):
+                    finish_reason = "aborted"
+                    break
+    finally:
+        # Closing the stream closes the connection, so Azure stops generating
+        await stream.aclose()
+
+    prompt_tokens = count_message_tokens(kwargs["messages"])
+    completion_tokens = count_tokens(content)
+    return openai.openai_object.OpenAIObject.construct_from({
+        "choices": [{
+            "index": 0,
+            "message": {"role": "assistant", "content": content},
+            "finish_reason": finish_reason,
+        }],
+        "usage": {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+        },
+    })
+
+
 def calculate_cost(model: str, usage: dict):
     """Calculate estimated cost based on the # of tokens."""
     cost = 0
@@ -40,12 +288,50 @@ def calculate_cost(model: str, usage: dict):
     return round(cost, 2)
 
 
-def detect_language(text):
-    """Detect language of input text."""
-    Language.factory("language_detector", func=create_lang_detector)
+def count_script_chars(text: str) -> tuple:
+    """Count kana and kanji (weighted) and Latin letters in the beginning of a text."""
+    text = text[:LANGUAGE_DETECTION_MAX_CHARS]
+    return len(JA_CHARS.findall(text)) * LANGUAGE_JA_CHAR_WEIGHT, len(LATIN_CHARS.findall(text))
+
+
+def detect_script_language(text: str) -> Optional[str]:
+    """Detect en or ja from the share of kana and kanji among letters, or return None if ambiguous."""
+    num_ja, num_latin = count_script_chars(text)
+    if num_ja + num_latin == 0:
+        return None
+    ratio = num_ja / (num_ja + num_latin)
+    if ratio >= LANGUAGE_JA_RATIO_MIN:
+        return "ja"
+    if ratio <= LANGUAGE_EN_RATIO_MAX:
+        return "en"
+    return None
+
+
+def detect_spacy_language(text: str) -> str:
+    """Detect language of input text with spaCy."""
     doc = nlp(text)
 
     # Access the language detected
-    detected_language = doc._.language["language"]
+    return doc._.language["language"]
+
+
+async def detect_language(text: str) -> str:
+    """Detect language of input text.
+
+    Script ratios decide in microseconds; spaCy only runs in a worker thread for
+    ambiguous text (or for every text if LANGUAGE_DETECTOR is "spacy").
+    """
+    with span("language_detection", length=len(text)) as s:
+        method = "script"
+        detected_language = None if LANGUAGE_DETECTOR == "spacy" else detect_script_language(text)
+        if detected_language is None and nlp is not None:
+            method = "spacy"
+            detected_language = await asyncio.to_thread(detect_spacy_language, text)
+        elif detected_language is None:
+            # Lean towards the majority script, if any
+            num_ja, num_latin = count_script_chars(text)
+            detected_language = "en" if num_latin > num_ja else LANGUAGE_DEFAULT
+        if s:
+            s.set(language=detected_language, method=method)
 
     return detected_language
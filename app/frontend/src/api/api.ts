@@ -1,7 +1,7 @@
 import { AskRequest, AskResponse } from "./models";
 
-export async function askApi(options: AskRequest): Promise<AskResponse> {
-    const response = await fetch("/ask", {
+export async function askApi(options: AskRequest, onUpdate?: (partialResponse: AskResponse) => void): Promise<AskResponse> {
+    const response = await fetch("/ask/stream", {
         method: "POST",
         headers: {
             "Content-Type": "application/json"
@@ -25,12 +25,63 @@ export async function askApi(options: AskRequest): Promise<AskResponse> {
         })
     });
 
-    const parsedResponse: AskResponse = await response.json();
-    if (response.status > 299 || !response.ok) {
+    if (response.status > 299 || !response.ok || !response.body) {
+        const parsedResponse: AskResponse = await response.json();
         throw Error(parsedResponse.error || "Unknown error");
     }
 
-    return parsedResponse;
+    // "thoughts" and "monitoring" only arrive with the final events
+    const partialResponse = { approach: options.approach, answer: "", data_points: [] } as unknown as AskResponse;
+    const reader = response.body.pipeThrough(new TextDecoderStream()).getReader();
+    let buffer = "";
+    for (;;) {
+        const { value, done } = await reader.read();
+        if (done) {
+            throw Error("Stream ended before the answer was complete");
+        }
+        buffer += value;
+        const messages = buffer.split("\n\n");
+        buffer = messages.pop() || "";
+        for (const message of messages) {
+            const { event, data } = parseServerSentEvent(message);
+            switch (event) {
+                case "data_points":
+                    partialResponse.data_points = data;
+                    break;
+                case "delta":
+                    partialResponse.answer += data;
+                    break;
+                case "reset":
+                    partialResponse.answer = "";
+                    break;
+                case "answer":
+                    partialResponse.answer = data;
+                    break;
+                case "thoughts":
+                    partialResponse.thoughts = data;
+                    break;
+                case "monitoring":
+                    partialResponse.monitoring = data;
+                    return { ...partialResponse };
+                case "error":
+                    throw Error(data.error || "Unknown error");
+            }
+            onUpdate && onUpdate({ ...partialResponse });
+        }
+    }
+}
+
+function parseServerSentEvent(message: string): { event: string; data: any } {
+    let event = "message";
+    const dataLines: string[] = [];
+    for (const line of message.split("\n")) {
+        if (line.startsWith("event:")) {
+            event = line.slice("event:".length).trim();
+        } else if (line.startsWith("data:")) {
+            dataLines.push(line.slice("data:".length).trim());
+        }
+    }
+    return { event, data: JSON.parse(dataLines.join("\n")) };
 }
 
 export function getCitationFilePath(citation: string): string {
@@ -60,7 +60,11 @@ const OneShot = () => {
                     temperature: temperature
                 }
             };
-            const result = await askApi(request);
+            const result = await askApi(request, partialResponse => {
+                // Show retrieved contents and answer tokens as they arrive
+                setAnswer(partialResponse);
+                setIsLoading(false);
+            });
             setAnswer(result);
         } catch (e) {
             setError(e);
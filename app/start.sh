@@ -43,7 +43,6 @@ if [ "$1" = "$installPackages" ]; then
 
     echo "$0: [STEP 5/6] Restoring backend python packages"
     ./backend_env/bin/python -m pip install -r requirements.txt
-    ./backend_env/bin/python -m spacy download en_core_web_sm
     if [ $? -ne 0 ]; then
         echo "Failed to restore backend python packages"
         exit $?
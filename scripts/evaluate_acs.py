@@ -1,5 +1,7 @@
 """Evaluate ACS."""
 import argparse
+import json
+import math
 from datetime import datetime
 from pathlib import Path
 
@@ -51,6 +53,15 @@ def process_args():
         default=None,
         help="OpenAI instance name",
     )
+    parser.add_argument(
+        "--gate-recall",
+        default=1.0,
+        type=float,
+        help=(
+            "Share of the test cases whose expected documents are retrieved that the calibrated "
+            "retrieval score threshold must still let through"
+        ),
+    )
     parser.add_argument(
         "--num-of-test-cases",
         default=None,
@@ -74,7 +85,14 @@ def process_args():
         print("[WARNING] No valid search_option is provided.")
         exit(1)
 
-    return args.search_service, args.index, search_options, args.top, args.openai_service, args.num_of_test_cases
+    if not 0 < args.gate_recall <= 1:
+        print("[ERROR] Set --gate-recall within (0, 1]")
+        exit(1)
+
+    return (
+        args.search_service, args.index, search_options, args.top, args.openai_service,
+        args.num_of_test_cases, args.gate_recall,
+    )
 
 
 def retrieve(
@@ -120,6 +138,21 @@ def retrieve(
     return search_results
 
 
+def calibrate_score_threshold(eval_results: list, gate_recall: float) -> float:
+    """Calibrate the retrieval score threshold of the backend's gate.
+
+    Returns the highest threshold on the top score that still lets through `gate_recall`
+    of the test cases whose expected documents are retrieved, or None without such cases.
+    """
+    top_scores = sorted(
+        result["top_score"] for result in eval_results
+        if result["evaluation_score"] == 1 and result["top_score"] is not None
+    )
+    if not top_scores:
+        return None
+    return top_scores[math.floor((1 - gate_recall) * len(top_scores))]
+
+
 def _evaluate(
     search_service: str,
     index: str,
@@ -127,6 +160,7 @@ def _evaluate(
     test_cases: list,
     top: int,
     openai_service: str = None,
+    gate_recall: float = 1.0,
 ) -> list:
     """Get search results for test_cases."""
     
@@ -179,6 +213,7 @@ def _evaluate(
             "num_of_expected_items": num_of_expected_items,
             "num_of_matches": num_of_matches,
             "evaluation_score": evaluation_score,
+            "top_score": max((doc["score"] for doc in search_result), default=None),
         })
 
         for idx, doc in enumerate(search_result):
@@ -198,7 +233,21 @@ def _evaluate(
         "accuracy[%]": round(acc_numerator/acc_denominator * 100, 2) if acc_denominator else "n/a",
     }
 
+    # Calibrate the retrieval score gate, and count the test cases it would answer without OpenAI
+    score_threshold = calibrate_score_threshold(eval_results, gate_recall)
+    num_of_gated = sum(
+        1 for result in eval_results
+        if score_threshold is not None
+        and (result["top_score"] is None or result["top_score"] < score_threshold)
+    )
+    summary["score_threshold"] = score_threshold
+    summary["gated"] = f"{num_of_gated}/{len(eval_results)}"
+
     print(f"[INFO] Accuracy ({search_option}): {summary['accuracy']} ({summary['accuracy[%]']})")
+    print(
+        f"[INFO] Score threshold ({search_option}): {score_threshold} "
+        f"(gates {summary['gated']} test cases)"
+    )
 
     return eval_results, search_results, summary
 
@@ -212,6 +261,7 @@ def evaluate(
     output_dir: Path,
     output_file_suffix: str,
     openai_service: str = None,
+    gate_recall: float = 1.0,
 ):
     """Run evaluation and save results."""
     eval_results, search_results, summary = _evaluate(
@@ -221,6 +271,7 @@ def evaluate(
         test_cases=test_cases,
         top=top,
         openai_service=openai_service,
+        gate_recall=gate_recall,
     )
 
     # Save results
@@ -233,7 +284,9 @@ def evaluate(
 
 def main():
     """Orchestrate evaluation"""
-    search_service, index, search_options, top, openai_service, num_of_test_cases = process_args()
+    (
+        search_service, index, search_options, top, openai_service, num_of_test_cases, gate_recall
+    ) = process_args()
 
     # Extract test cases
     test_cases = extract_test_cases(max_count=num_of_test_cases)
@@ -256,6 +309,7 @@ def main():
                 output_dir=output_dir,
                 output_file_suffix=timestamp,
                 top=top,
+                gate_recall=gate_recall,
             )
             eval_summary.append(summary)
         else:
@@ -267,6 +321,7 @@ def main():
                 output_dir=output_dir,
                 output_file_suffix=timestamp,
                 top=top,
+                gate_recall=gate_recall,
             )
             eval_summary.append(summary)
 
@@ -274,5 +329,13 @@ def main():
     to_csv(eval_summary, output_dir.joinpath(f"_summary_{timestamp}.csv"))
     print(f"[INFO] Output files saved at {output_dir}")
 
+    # Thresholds to set as RETRIEVAL_SCORE_THRESHOLDS of the backend
+    score_thresholds = {
+        SearchOption(summary["search_option"]).name: summary["score_threshold"]
+        for summary in eval_summary
+        if summary["score_threshold"] is not None
+    }
+    print(f"[INFO] RETRIEVAL_SCORE_THRESHOLDS='{json.dumps(score_thresholds)}'")
+
 if __name__ == "__main__":
     main()
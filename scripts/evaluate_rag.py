@@ -21,15 +21,15 @@ Requirements:
 import argparse
 import os
 import re
+import sys
 import time
 import unicodedata
 from datetime import datetime
 from pathlib import Path
-from typing import List, Optional, Tuple
+from typing import Callable, List, Optional, Tuple
 from enum import IntEnum
 
 import openai
-import tiktoken
 from azure.core.credentials import AzureKeyCredential
 from azure.search.documents import SearchClient
 from azure.search.documents.models import QueryType, Vector
@@ -40,6 +40,10 @@ from rich.progress import track
 from utils import nonewlines, to_csv, count_tokens
 from prepdocs import generate_embeddings
 
+# Pack prompts the same way as the backend
+sys.path.append(str(Path(__file__).resolve().parents[1].joinpath("app", "backend")))
+from packing import CONTEXT_TOKENS_BUFFER, Chunk, get_context_length, pack_messages  # noqa: E402
+
 load_dotenv(find_dotenv())
 
 # Set up Open AI
@@ -48,7 +52,6 @@ openai.api_key = os.environ.get("OPENAI_API_KEY")
 openai.api_base = os.environ.get("OPENAI_API_ENDPOINT")
 openai.api_version = "2023-07-01-preview"
 AZURE_OPENAI_GPT_DEPLOYMENT_NAME = "gpt-35-turbo"
-ENCODER = tiktoken.encoding_for_model("text-embedding-ada-002")
 
 # Set up clients for Azure Cognitive Search
 # INDEX_NAMES = ["kitchat-searchindex-pdf", "kitchat-searchindex-html"]
@@ -66,10 +69,10 @@ SEARCH_CLIENTS = {
 }
 SLEEP_BEFORE_TALKING_TO_LLM = 1
 
-CONTEXT_LENGTHS = {
-    "gpt-4": 8192,
-    "gpt-35-turbo": 4096,
-}
+# e.g. "This model's maximum context length is 4096 tokens. However, you requested 4100 tokens ..."
+CONTEXT_LENGTH_EXCEEDED = re.compile(
+    r"maximum context length is (\d+) tokens\. However, you requested (\d+) tokens"
+)
 
 SYSTEM_PROMPT_GENERATE_ANSWER = """
 You are a AI assistant. Please output your response based on the following information.
@@ -167,7 +170,7 @@ def retrieve(
 
     # Parse search results
     data_points = []
-    contents = []
+    chunks = []
     for doc in search_results:
         data_points.append(
             {
@@ -182,42 +185,43 @@ def retrieve(
                 "modified_from_source": doc.get("modified_from_source", ""),
             }
         )
-        contents.append("- " + nonewlines(doc["content"]))
+        chunks.append(Chunk("- " + nonewlines(doc["content"]), doc.get("num_tokens")))
 
-    out_text = "\n".join(contents)
-
-    return data_points, out_text
+    return data_points, chunks
 
 
 def talk_to_llm(
-    message: List[dict],
+    create_message: Callable[[str], List[dict]],
+    sources: List[Chunk] = (),
     temperature: int = 0.,
     deployment: str = "gpt-4",
     max_num_retries: int = 5,
     sleep_time: float = 8,
     max_output_tokens: int = 1024,
-    num_tokens_buffer: int = 8,
+    num_tokens_buffer: int = CONTEXT_TOKENS_BUFFER,
 ) -> Optional[str]:
     """Talk to LLM to answer user question.
 
+    `create_message` creates the message from the source text, which is packed from
+    `sources` by the backend's packer (see app/backend/packing.py).
+
     Note that
 
     1. LLM context windows count the input and output combined.
     2. As API returns the following message, we introduced 'num_tokens_buffer',
-       a variable to leave a buffer in token limits
+       a variable to leave a buffer in token limits. When the API still reports it,
+       the sources are packed again with the excess added to the buffer.
        > This model's maximum context length is 4096 tokens. However, you requested 4096
        > tokens (2060 in the messages, 2036 in the completion). Please reduce the length
        > of the messages or completion..
     """
     time.sleep(sleep_time)
-    context_length = CONTEXT_LENGTHS[deployment]
-    num_tokens = sum([len(ENCODER.encode(m["content"])) for m in message])
-    num_tokens_excess = - (context_length - num_tokens + max_output_tokens + num_tokens_buffer)
-    if num_tokens_excess > 0:
-        text = message[-1]["content"]
-        text = ENCODER.decode(ENCODER.encode(text)[:-num_tokens_excess])
+    context_length = get_context_length(deployment)
     retry = 0
     while retry < max_num_retries:
+        message, _ = pack_messages(
+            create_message, sources, context_length, max_output_tokens, num_tokens_buffer
+        )
         try:
             completion = openai.ChatCompletion.create(
                 engine=deployment,
@@ -230,6 +234,9 @@ def talk_to_llm(
         except Exception as err:
             timestamp = datetime.now().strftime('%Y/%m/%d %H:%M:%S')
             print(f"[WARNING] [{retry + 1}] [{timestamp}] {err}. Retrying...")
+            exceeded = CONTEXT_LENGTH_EXCEEDED.search(str(err))
+            if exceeded:
+                num_tokens_buffer += int(exceeded.group(2)) - int(exceeded.group(1))
             time.sleep(2)
         retry += 1
     return None
@@ -328,17 +335,18 @@ def generate_answer(question: str, index_name: str, verbose: bool = False) -> Tu
     references = "\n".join(references)
 
     # Step 4: Generate answer based on the question & retrieved contents
-    message = [
-        {
-            "role": "system",
-            "content": SYSTEM_PROMPT_GENERATE_ANSWER
-        },
-        {
-            "role": "user",
-            "content": USER_PROMPT_GENERATE_ANSWER.format(source=retrieved, question=question)
-        },
-    ]
-    answer = talk_to_llm(message)
+    def create_message(source: str) -> List[dict]:
+        return [
+            {
+                "role": "system",
+                "content": SYSTEM_PROMPT_GENERATE_ANSWER
+            },
+            {
+                "role": "user",
+                "content": USER_PROMPT_GENERATE_ANSWER.format(source=source, question=question)
+            },
+        ]
+    answer = talk_to_llm(create_message, retrieved)
 
     # Step 5: Confirm that the generated answer is acceptable
     message = [
@@ -349,7 +357,7 @@ def generate_answer(question: str, index_name: str, verbose: bool = False) -> Tu
             )
         },
     ]
-    # confirmation_response = talk_to_llm(message)
+    # confirmation_response = talk_to_llm(lambda _: message)
     # cleaned_confirmation_response = clean_text(confirmation_response)
 
     # if cleaned_confirmation_response == "はい":
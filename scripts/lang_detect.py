@@ -9,8 +9,9 @@ def create_lang_detector(nlp, name):
 Language.factory("language_detector", func=create_lang_detector)
 
 
-# Load SpaCy model with language detection component
-nlp = spacy.load("en_core_web_sm")
+# Blank English pipeline with sentence splitting and language detection, as in the backend
+nlp = spacy.blank("en")
+nlp.add_pipe("sentencizer")
 nlp.add_pipe('language_detector', last=True)
 
 
@@ -24,8 +24,6 @@ python -m pip config set global.cert $CERT_PATH
 
 echo '[4] Installing dependencies from "requirements.txt" into virtual environment'
 python -m pip install -r scripts/requirements.txt
-python -m pip install https://github.com/explosion/spacy-models/releases/download/en_core_web_sm-3.7.1/en_core_web_sm-3.7.1-py3-none-any.whl
-python -m spacy download en_core_web_sm
 
 echo '[5] Clean up output folder'
 rm -f output/*.json
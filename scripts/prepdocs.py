@@ -44,16 +44,33 @@ from rich import print
 from rich.progress import track
 from utils import count_tokens, get_filenames, is_input_dir_valid, load_json, load_names, to_json
 
+# Share the token refresher and cache invalidation with the backend
+sys.path.append(str(Path(__file__).resolve().parents[1].joinpath("app", "backend")))
+from caching import write_index_version  # noqa: E402
+from credentials import TokenRefresher  # noqa: E402
+
 load_dotenv(find_dotenv())
 
 
 
+def set_openai_api_key(token: str) -> None:
+    """Swap in a refreshed Open AI token."""
+    openai.api_key = token
+
+
 azd_credential = AzureDeveloperCliCredential()
-openai.api_type = "azure_ad"
-openai_token = azd_credential.get_token("https://cognitiveservices.azure.com/.default")
-openai.api_key = openai_token.token
-openai.api_base = os.environ.get("OPENAI_API_ENDPOINT")
-openai.api_version = "2023-05-15"
+# Started by main(), so that the evaluation scripts importing this module keep their own OpenAI settings
+openai_token_refresher = None
+
+
+def configure_openai() -> None:
+    """Authenticate to Azure OpenAI with Azure AD, keeping the token fresh in the background."""
+    global openai_token_refresher
+    openai.api_type = "azure_ad"
+    openai.api_base = os.environ.get("OPENAI_API_ENDPOINT")
+    openai.api_version = "2023-05-15"
+    # Keep the token fresh in the background during hour-long embedding runs
+    openai_token_refresher = TokenRefresher(azd_credential, on_refresh=set_openai_api_key).start()
 
 
 ACS_ENDPOINT = os.environ.get("SEARCH_ENDPOINT")
@@ -190,14 +207,6 @@ def process_args() -> argparse.Namespace:
     return parser.parse_args()
 
 
-def set_openai_token() -> None:
-    """Refresh Open AI token."""
-    global openai_token
-    openai_token = azd_credential.get_token("https://cognitiveservices.azure.com/.default")
-    openai.api_key = openai_token.token
-    print("[DEBUG] OpenAI token is set")
-
-
 def generate_embeddings(text: str, limit_text_len: bool = True) -> List[float]:
     """Generate embeddings for the input text using text-embedding-ada-002."""
     time.sleep(SLEEP_TIME_FOR_EMBEDDING_IN_SEC)
@@ -216,7 +225,8 @@ def generate_embeddings(text: str, limit_text_len: bool = True) -> List[float]:
             return embeddings
         except openai.error.APIError as err:
             print(f"[WARNING] '{err}'. Retrying to generate embeddings.")
-            set_openai_token()
+            if openai_token_refresher is not None:
+                openai_token_refresher.refresh()
         retry += 1
     return None
 
@@ -506,6 +516,11 @@ def populate_index(
     if verbose:
         print(f"[INFO] Indexed {len(results)} chunks, {num_success} succeeded")
 
+    # Answers cached by the backend are based on the previous contents
+    version = write_index_version(index_name)
+    if verbose:
+        print(f"[INFO] Index '{index_name}' is now at version {version}")
+
 
 def display_doc_stats(
     loaded_data: List[KnowledgeFormat],
@@ -538,6 +553,7 @@ def main():
     """Orchestrate KitChat knowledge preprocessing, chunking and ACS indexing."""
     # Parse input arguments
     args = process_args()
+    configure_openai()
     path_to_docs = Path(args.files)
     path_to_pii = Path(args.postprocess)  # path to file with employee information
     path_to_chunkstores = Path(args.path_to_chunkstores)  # path to chhunkstore
@@ -0,0 +1,149 @@
+"""Report latency and cost rollups from the backend's request ledger."""
+import argparse
+import re
+import sys
+import time
+from pathlib import Path
+
+from rich import print
+from rich.table import Table
+
+# Read the ledger written by the backend
+sys.path.append(str(Path(__file__).resolve().parents[1].joinpath("app", "backend")))
+from ledger import LEDGER_PATH, connect  # noqa: E402
+
+DURATION_UNITS_IN_SEC = {"m": 60, "h": 3600, "d": 86400}
+
+
+def parse_duration(value: str) -> float:
+    """Parse a duration such as 30m, 24h or 7d into seconds."""
+    match = re.fullmatch(r"(\d+(?:\.\d+)?)([mhd])", value)
+    if not match:
+        raise argparse.ArgumentTypeError(f"invalid duration '{value}', expected e.g. 30m, 24h or 7d")
+    return float(match.group(1)) * DURATION_UNITS_IN_SEC[match.group(2)]
+
+
+def process_args():
+    """Process command line args."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--path",
+        default=LEDGER_PATH,
+        help="Path of the ledger database",
+    )
+    parser.add_argument(
+        "--since",
+        default="24h",
+        type=parse_duration,
+        help="Time window to report, e.g. 30m, 24h or 7d",
+    )
+    parser.add_argument(
+        "--top",
+        default=10,
+        type=int,
+        help="The number of slowest steps to report",
+    )
+    return parser.parse_args()
+
+
+def percentile(values: list, q: float) -> float:
+    """Return the q-th percentile of sorted values (nearest rank)."""
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(q / 100 * len(values)))]
+
+
+def report_requests(connection, since: float) -> Table:
+    """Roll up requests, latency, tokens and cost per approach and deployment."""
+    table = Table(title="Requests per approach")
+    for column in [
+        "approach", "deployment", "requests", "errors", "cached", "p50[s]", "p95[s]",
+        "tokens/request", "cost[JPY]", "cost/request[JPY]",
+    ]:
+        table.add_column(column, justify="left" if column in {"approach", "deployment"} else "right")
+
+    rows = connection.execute(
+        """
+        SELECT approach, deployment, COUNT(*), SUM(status != 200), SUM(cache IS NOT NULL),
+               AVG(prompt_tokens + completion_tokens), SUM(cost_total), AVG(cost_total)
+        FROM requests WHERE created_at >= ?
+        GROUP BY approach, deployment ORDER BY COUNT(*) DESC
+        """,
+        (since,),
+    ).fetchall()
+    for approach, deployment, num_requests, num_errors, num_cached, tokens, cost, cost_avg in rows:
+        durations = [row[0] for row in connection.execute(
+            """
+            SELECT time_total FROM requests
+            WHERE created_at >= ? AND approach = ? AND deployment = ? AND status = 200
+            ORDER BY time_total
+            """,
+            (since, approach, deployment),
+        )]
+        table.add_row(
+            approach, deployment, str(num_requests), str(num_errors), str(num_cached),
+            f"{percentile(durations, 50):.2f}", f"{percentile(durations, 95):.2f}",
+            f"{tokens or 0:.0f}", f"{cost or 0:.2f}", f"{cost_avg or 0:.2f}",
+        )
+    return table
+
+
+def report_steps(connection, since: float, top: int) -> Table:
+    """Roll up the slowest pipeline steps."""
+    table = Table(title=f"Slowest {top} steps")
+    for column in ["approach", "step", "count", "avg[s]", "max[s]", "total[s]"]:
+        table.add_column(column, justify="left" if column in {"approach", "step"} else "right")
+
+    rows = connection.execute(
+        """
+        SELECT r.approach, s.step, COUNT(*), AVG(s.value), MAX(s.value), SUM(s.value)
+        FROM steps s JOIN requests r ON r.id = s.request_id
+        WHERE r.created_at >= ? AND s.kind = 'time'
+        GROUP BY r.approach, s.step ORDER BY AVG(s.value) DESC LIMIT ?
+        """,
+        (since, top),
+    ).fetchall()
+    for approach, step, count, avg, maximum, total in rows:
+        table.add_row(approach, step, str(count), f"{avg:.2f}", f"{maximum:.2f}", f"{total:.2f}")
+    return table
+
+
+def report_fallbacks(connection, since: float) -> Table:
+    """Roll up how often `rrrt` falls back to Approach 2."""
+    table = Table(title="rrrt fallback to Approach 2")
+    for column in ["deployment", "search_option", "answered", "fallbacks", "rate"]:
+        table.add_column(column, justify="left" if column in {"deployment", "search_option"} else "right")
+
+    rows = connection.execute(
+        """
+        SELECT deployment, search_option, COUNT(*), SUM(fallback)
+        FROM requests
+        WHERE created_at >= ? AND approach = 'rrrt' AND fallback IS NOT NULL
+        GROUP BY deployment, search_option ORDER BY COUNT(*) DESC
+        """,
+        (since,),
+    ).fetchall()
+    for deployment, search_option, num_answered, num_fallbacks in rows:
+        table.add_row(
+            deployment, search_option, str(num_answered), str(num_fallbacks),
+            f"{100 * num_fallbacks / num_answered:.1f}%",
+        )
+    return table
+
+
+def main():
+    """Print the rollups of the time window."""
+    args = process_args()
+    if not Path(args.path).exists():
+        print(f"[WARNING] No ledger at {args.path}")
+        sys.exit(1)
+
+    since = time.time() - args.since
+    connection = connect(args.path)
+    print(report_requests(connection, since))
+    print(report_steps(connection, since, args.top))
+    print(report_fallbacks(connection, since))
+
+
+if __name__ == "__main__":
+    main()
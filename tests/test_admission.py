@@ -0,0 +1,78 @@
+import asyncio
+
+import admission
+import openai
+import pytest
+from admission import AdmissionRejected, DeploymentLimiter, TokenBucket, admit, get_limiter, get_retry_after
+
+
+def rate_limit_error(headers: dict) -> openai.error.RateLimitError:
+    return openai.error.RateLimitError("Too Many Requests", http_status=429, headers=headers)
+
+
+def test_token_bucket_waits_for_the_missing_tokens():
+    bucket = TokenBucket(60)
+    bucket.take(60)
+    assert bucket.time_until(1) == pytest.approx(1, abs=0.05)
+    bucket.give(60)
+    assert bucket.time_until(60) == 0
+
+
+def test_token_bucket_admits_calls_larger_than_its_capacity_when_full():
+    bucket = TokenBucket(60)
+    assert bucket.time_until(100) == 0
+    bucket.take(100)
+    assert bucket.level == -40
+
+
+def test_limiter_rejects_calls_that_would_wait_too_long(monkeypatch):
+    monkeypatch.setattr(admission, "ADMISSION_MAX_WAIT_IN_SEC", 0.1)
+    limiter = DeploymentLimiter("test-wait", 60, 60)
+    limiter.tokens.take(60)
+
+    with pytest.raises(AdmissionRejected) as e:
+        asyncio.run(limiter.acquire(30))
+    assert e.value.retry_after == pytest.approx(30, abs=0.1)
+    assert limiter.stats()["rejected"] == 1
+
+
+@pytest.mark.parametrize("headers, retry_after", [
+    ({"retry-after-ms": "250"}, 0.25),
+    ({"retry-after": "3"}, 3.0),
+    ({"retry-after": "soon"}, admission.DEFAULT_RETRY_AFTER_IN_SEC),
+    (None, admission.DEFAULT_RETRY_AFTER_IN_SEC),
+])
+def test_retry_after_is_read_from_the_response_headers(headers, retry_after):
+    assert get_retry_after(rate_limit_error(headers)) == retry_after
+
+
+def test_admit_retries_after_a_429_once_the_deployment_is_unblocked():
+    responses = [rate_limit_error({"retry-after-ms": "50"}), {"usage": 10}]
+
+    async def call():
+        response = responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    async def main():
+        start_time = asyncio.get_running_loop().time()
+        response = await admit("test-retry", 100, call, lambda r: r["usage"])
+        return response, asyncio.get_running_loop().time() - start_time
+
+    response, elapsed_time = asyncio.run(main())
+    assert response == {"usage": 10}
+    assert elapsed_time >= 0.05
+    assert get_limiter("test-retry").stats()["throttled"] == 1
+
+
+def test_admit_rejects_with_the_retry_after_when_retries_are_exhausted(monkeypatch):
+    monkeypatch.setattr(admission, "OPENAI_MAX_RETRIES", 1)
+
+    async def call():
+        raise rate_limit_error({"retry-after-ms": "20"})
+
+    with pytest.raises(AdmissionRejected) as e:
+        asyncio.run(admit("test-exhausted", 100, call, lambda r: 0))
+    assert e.value.retry_after == 0.02
+    assert get_limiter("test-exhausted").stats()["throttled"] == 2
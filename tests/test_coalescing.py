@@ -0,0 +1,95 @@
+import asyncio
+
+from coalescing import SingleFlight
+
+
+def test_concurrent_calls_share_one_execution():
+    flight = SingleFlight("test_share")
+    calls = []
+
+    async def work():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return "result"
+
+    async def main():
+        return await asyncio.gather(*[flight.do("key", work) for _ in range(3)])
+
+    results = asyncio.run(main())
+    assert results == [("result", False), ("result", True), ("result", True)]
+    assert len(calls) == 1
+    assert flight.stats() == {"calls": 3, "coalesced": 2, "in_flight": 0}
+
+
+def test_different_keys_run_separately():
+    flight = SingleFlight("test_keys")
+
+    async def main():
+        return await asyncio.gather(
+            flight.do("a", lambda: asyncio.sleep(0, "a")), flight.do("b", lambda: asyncio.sleep(0, "b"))
+        )
+
+    assert asyncio.run(main()) == [("a", False), ("b", False)]
+
+
+def test_cancelled_waiter_does_not_cancel_the_shared_execution():
+    flight = SingleFlight("test_shield")
+    cancelled = []
+
+    async def work():
+        try:
+            await asyncio.sleep(0.05)
+        except asyncio.CancelledError:
+            cancelled.append(1)
+            raise
+        return "result"
+
+    async def main():
+        first = asyncio.create_task(flight.do("key", work))
+        second = asyncio.create_task(flight.do("key", work))
+        await asyncio.sleep(0.01)
+        first.cancel()
+        result = await second
+        assert first.cancelled()
+        return result
+
+    assert asyncio.run(main()) == ("result", True)
+    assert cancelled == []
+
+
+def test_execution_is_cancelled_with_its_last_waiter():
+    flight = SingleFlight("test_cancel")
+    cancelled = []
+
+    async def work():
+        try:
+            await asyncio.sleep(1)
+        except asyncio.CancelledError:
+            cancelled.append(1)
+            raise
+
+    async def main():
+        waiters = [asyncio.create_task(flight.do("key", work)) for _ in range(2)]
+        await asyncio.sleep(0.01)
+        for waiter in waiters:
+            waiter.cancel()
+        await asyncio.gather(*waiters, return_exceptions=True)
+        await asyncio.sleep(0)
+        assert flight.stats()["in_flight"] == 0
+
+    asyncio.run(main())
+    assert cancelled == [1]
+
+
+def test_failure_is_raised_to_every_waiter():
+    flight = SingleFlight("test_failure")
+
+    async def work():
+        await asyncio.sleep(0.01)
+        raise RuntimeError("boom")
+
+    async def main():
+        return await asyncio.gather(*[flight.do("key", work) for _ in range(2)], return_exceptions=True)
+
+    errors = asyncio.run(main())
+    assert [str(error) for error in errors] == ["boom", "boom"]
@@ -0,0 +1,48 @@
+from compression import compress_chunks, extract_terms, score_sentences
+from packing import Chunk, count_tokens
+
+JA_CHUNKS = [
+    Chunk("- 年次有給休暇は入社6か月後に10日付与される。通勤手当は実費を支給する。"),
+    Chunk("- 有給休暇の申請は3日前までに行う。社員食堂は12時に開く。"),
+]
+
+
+def test_japanese_text_is_split_into_character_bigrams():
+    assert extract_terms("有給休暇") == ["有給", "給休", "休暇"]
+    assert extract_terms("年") == ["年"]
+
+
+def test_latin_words_are_normalized_and_split_from_japanese_runs():
+    assert extract_terms("ＨＲ Portal の36協定") == ["hr", "portal", "36", "の", "協定"]
+
+
+def test_sentences_sharing_bigrams_with_the_question_score_higher():
+    sentences = ["有給休暇の申請は3日前までに行う。", "社員食堂は12時に開く。"]
+    scores = score_sentences("有給休暇の申請方法", sentences)
+    assert scores[0] > 0
+    assert scores[1] == 0
+
+
+def test_compression_keeps_the_relevant_sentences_in_their_order():
+    max_tokens = count_tokens("年次有給休暇は入社6か月後に10日付与される。") + count_tokens(
+        "有給休暇の申請は3日前までに行う。"
+    )
+    compressed, compression = compress_chunks("有給休暇の申請", JA_CHUNKS, max_tokens)
+    assert [chunk.text for chunk in compressed] == [
+        "- 年次有給休暇は入社6か月後に10日付与される。",
+        "- 有給休暇の申請は3日前までに行う。",
+    ]
+    assert compression.num_tokens_after == max_tokens == sum(chunk.num_tokens for chunk in compressed)
+    assert (compression.num_sentences, compression.num_kept_sentences) == (4, 2)
+
+
+def test_chunks_that_fit_are_kept_as_they_are():
+    compressed, compression = compress_chunks("有給休暇の申請", JA_CHUNKS, 10_000)
+    assert compressed == JA_CHUNKS
+    assert compression.num_tokens_after == compression.num_tokens_before
+
+
+def test_chunks_without_a_term_of_the_question_are_kept_as_they_are():
+    compressed, compression = compress_chunks("How do I apply for paid leave?", JA_CHUNKS, 1)
+    assert compressed == JA_CHUNKS
+    assert compression.num_kept_sentences == compression.num_sentences
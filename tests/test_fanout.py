@@ -0,0 +1,70 @@
+import asyncio
+
+import pytest
+from fanout import FanOutSearchClient, FusedResults, fuse_rankings
+
+
+def docs(*ids: str) -> list:
+    return [{"id": doc_id, "@search.score": 1.0} for doc_id in ids]
+
+
+class FakeSearchClient:
+    def __init__(self, index_name: str, results: list, delay: float = 0, error: Exception = None):
+        self._index_name = index_name
+        self.results = results
+        self.delay = delay
+        self.error = error
+
+    async def search(self, **payload) -> FusedResults:
+        await asyncio.sleep(self.delay)
+        if self.error:
+            raise self.error
+        return FusedResults(self.results)
+
+
+def search(client: FanOutSearchClient, **payload) -> list:
+    async def main():
+        return [doc["id"] async for doc in await client.search(**payload)]
+
+    return asyncio.run(main())
+
+
+def test_documents_ranked_high_by_several_indexes_come_first():
+    rankings = [docs("a", "b", "c"), docs("c", "d", "a")]
+    assert [doc["id"] for doc in fuse_rankings(rankings, top=4)] == ["a", "c", "b", "d"]
+
+
+def test_ties_keep_the_order_of_the_indexes_and_top_is_applied():
+    assert [doc["id"] for doc in fuse_rankings([docs("a"), docs("b")], top=1)] == ["a"]
+
+
+def test_documents_keep_the_score_of_the_first_index_they_are_in():
+    first, second = docs("a"), [{"id": "a", "@search.score": 9.0}]
+    assert fuse_rankings([first, second], top=1)[0] is first[0]
+
+
+def test_all_indexes_are_searched_and_fused():
+    client = FanOutSearchClient([
+        FakeSearchClient("pdf", docs("a", "b")),
+        FakeSearchClient("html", docs("b", "c")),
+    ])
+    assert client._index_name == "pdf+html"
+    assert search(client, top=3) == ["b", "a", "c"]
+
+
+def test_an_index_that_times_out_or_fails_is_left_out():
+    client = FanOutSearchClient([
+        FakeSearchClient("pdf", docs("a"), delay=1),
+        FakeSearchClient("html", docs("b", "c")),
+        FakeSearchClient("faq", docs("d"), error=RuntimeError("boom")),
+    ], timeout_in_sec=0.05)
+    assert search(client, top=3) == ["b", "c"]
+
+
+def test_the_search_fails_when_every_index_fails():
+    client = FanOutSearchClient([
+        FakeSearchClient("pdf", docs("a"), delay=1),
+        FakeSearchClient("html", docs("b"), error=RuntimeError("boom")),
+    ], timeout_in_sec=0.05)
+    with pytest.raises(asyncio.TimeoutError):
+        search(client, top=3)
@@ -0,0 +1,82 @@
+from packing import (
+    SENTENCE,
+    Chunk,
+    count_message_tokens,
+    count_tokens,
+    pack_context,
+    pack_messages,
+    truncate_sentences,
+)
+
+TEXT = "Employees may take family care leave. The leave is 93 days in total. Apply via the HR portal."
+JA_TEXT = "時間外労働は月45時間までです。申請が必要です。上長の承認を得てください。"
+
+
+def count_sentence_tokens(text: str, num_sentences: int) -> int:
+    return sum(count_tokens(sentence) for sentence in SENTENCE.findall(text)[:num_sentences])
+
+
+def test_sentences_end_with_periods_but_not_with_decimal_points():
+    assert SENTENCE.findall("Leave is 3.5 days. Apply early.") == ["Leave is 3.5 days. ", "Apply early."]
+    assert SENTENCE.findall(JA_TEXT) == [
+        "時間外労働は月45時間までです。", "申請が必要です。", "上長の承認を得てください。"
+    ]
+
+
+def test_truncate_sentences_keeps_the_leading_sentences_that_fit():
+    max_tokens = count_sentence_tokens(TEXT, 2)
+    assert truncate_sentences(TEXT, max_tokens) == (
+        "Employees may take family care leave. The leave is 93 days in total.", max_tokens
+    )
+    assert truncate_sentences(TEXT, max_tokens - 1)[0] == "Employees may take family care leave."
+    max_tokens = count_sentence_tokens(JA_TEXT, 1)
+    assert truncate_sentences(JA_TEXT, max_tokens) == ("時間外労働は月45時間までです。", max_tokens)
+
+
+def test_chunks_that_fit_are_joined_whole():
+    chunks = [Chunk(TEXT), Chunk(JA_TEXT)]
+    packed = pack_context(chunks, sum(chunk.count_tokens() for chunk in chunks))
+    assert packed.text == f"{TEXT}\n{JA_TEXT}"
+    assert packed.num_chunks == 2
+    assert not packed.truncated
+
+
+def test_the_first_chunk_that_does_not_fit_is_cut_at_a_sentence_boundary():
+    first = Chunk(JA_TEXT)
+    budget = first.count_tokens() + 1 + count_sentence_tokens(TEXT, 2)
+    packed = pack_context([first, Chunk(TEXT), Chunk(JA_TEXT)], budget)
+    assert packed.text == f"{JA_TEXT}\nEmployees may take family care leave. The leave is 93 days in total."
+    assert packed.num_tokens == budget
+    assert packed.num_chunks == 2
+    assert packed.truncated
+
+
+def test_a_chunk_without_a_sentence_that_fits_is_left_out():
+    first = Chunk(JA_TEXT)
+    packed = pack_context([first, Chunk(TEXT)], first.count_tokens() + 1)
+    assert packed.text == JA_TEXT
+    assert packed.num_chunks == 1
+    assert packed.truncated
+
+
+def test_stored_token_counts_are_used_without_tokenizing():
+    assert Chunk("unused", num_tokens=10).count_tokens() == 12
+    # A stored count above the budget is checked against the actual sentences
+    packed = pack_context([Chunk(TEXT, num_tokens=10_000)], count_tokens(TEXT) + 10)
+    assert packed.text == TEXT
+    assert not packed.truncated
+
+
+def test_pack_messages_leaves_room_for_the_prompt_and_the_answer():
+    def create_messages(source: str) -> list:
+        return [
+            {"role": "system", "content": "Answer from the sources."},
+            {"role": "user", "content": source},
+        ]
+
+    # Room for the first sentence only, after the prompt, max_tokens and the buffer
+    budget = count_sentence_tokens(TEXT, 1) + 1
+    context_length = count_message_tokens(create_messages("")) + 100 + 8 + budget
+    messages, packed = pack_messages(create_messages, [Chunk(TEXT)], context_length, 100, buffer=8)
+    assert messages[1]["content"] == "Employees may take family care leave."
+    assert packed.truncated
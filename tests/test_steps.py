@@ -0,0 +1,99 @@
+import asyncio
+
+import pytest
+from approaches.steps import Step, StepGraph, StopRun
+
+
+class FakeApproach:
+    def create_time_item(self, ctx, label: str, start_time: float) -> dict:
+        return {"label": label, "ctx": ctx}
+
+
+def run(graph: StepGraph, ctx=None) -> tuple:
+    return asyncio.run(graph.run(FakeApproach(), ctx))
+
+
+def test_steps_are_sorted_after_their_dependencies():
+    graph = StepGraph([
+        Step("answer", lambda message: message + "!", after=("message",)),
+        Step("message", lambda question, search: f"{question} {search}", after=("question", "search")),
+        Step("search", lambda question: question.upper(), after=("question",)),
+        Step("question", lambda: "q"),
+    ])
+    names = [step.name for step in graph.order]
+    assert names.index("question") < names.index("search") < names.index("message") < names.index("answer")
+
+    results, _ = run(graph)
+    assert results == {"answer": "q Q!", "message": "q Q", "search": "Q", "question": "q"}
+
+
+def test_independent_steps_run_concurrently():
+    async def sleep(**_):
+        await asyncio.sleep(0.1)
+
+    async def main():
+        start_time = asyncio.get_running_loop().time()
+        await StepGraph([Step("a", sleep), Step("b", sleep), Step("c", sleep, after=("a", "b"))]).run(
+            FakeApproach(), None
+        )
+        return asyncio.get_running_loop().time() - start_time
+
+    assert asyncio.run(main()) < 0.28
+
+
+@pytest.mark.parametrize("steps", [
+    [Step("a", lambda: None), Step("a", lambda: None)],
+    [Step("a", lambda b: None, after=("b",))],
+    [Step("a", lambda b: None, after=("b",)), Step("b", lambda a: None, after=("a",))],
+])
+def test_invalid_graphs_are_rejected(steps):
+    with pytest.raises(ValueError):
+        StepGraph(steps)
+
+
+def test_a_failing_step_cancels_the_other_steps():
+    cancelled = []
+
+    async def slow():
+        try:
+            await asyncio.sleep(1)
+        except asyncio.CancelledError:
+            cancelled.append("slow")
+            raise
+
+    async def fail():
+        await asyncio.sleep(0.01)
+        raise RuntimeError("boom")
+
+    graph = StepGraph([
+        Step("slow", slow),
+        Step("fail", fail),
+        Step("after_fail", lambda fail: cancelled.append("after_fail"), after=("fail",)),
+    ])
+    with pytest.raises(RuntimeError, match="boom"):
+        run(graph)
+    assert cancelled == ["slow"]
+
+
+def test_stop_run_skips_the_remaining_steps_and_reports_the_time_of_the_done_steps():
+    def gate(search):
+        raise StopRun()
+
+    graph = StepGraph([
+        Step("search", list, label="search"),
+        Step("gate", gate, after=("search",), label="gate"),
+        Step("answer", lambda gate: pytest.fail("answer must not run"), after=("gate",), label="answer"),
+    ])
+    with pytest.raises(StopRun) as e:
+        run(graph, ctx="ctx")
+    assert e.value.time_items == [{"label": "search", "ctx": "ctx"}, {"label": "gate", "ctx": "ctx"}]
+
+
+def test_steps_are_skipped_unless_their_condition_holds():
+    graph = StepGraph([
+        Step("cache", lambda: "cached"),
+        Step("search", lambda cache: "searched", after=("cache",), when=lambda cache: cache is None),
+        Step("blocking", lambda cache: cache.upper(), after=("cache",), blocking=True),
+    ])
+    results, _ = run(graph)
+    assert results == {"cache": "cached", "search": None, "blocking": "CACHED"}